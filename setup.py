@@ -7,7 +7,7 @@ from testr.setup_helper import cmdclass
 name = "ska_shell"
 namespace = "Ska.Shell"
 
-packages = ["ska_shell", "ska_shell.tests"]
+packages = ["ska_shell", "ska_shell.benchmarks", "ska_shell.tests"]
 package_dir = {name: name}
 
 duplicate_package_info(packages, name, namespace)
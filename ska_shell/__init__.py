@@ -1,9 +1,56 @@
 # Licensed under a 3-clause BSD style license - see LICENSE.rst
-import ska_helpers
+import importlib
 
 from .shell import *
 
-__version__ = ska_helpers.get_version("ska_shell")
+# Attributes from submodules that are imported on first use to keep
+# ``import ska_shell`` fast for scripts that only run a command.
+_LAZY_ATTRS = {
+    "ShellSession": "session",
+    "ShellPool": "pool",
+    "CommandCache": "cache",
+    "EnvCache": "cache",
+    "JobResult": "batch",
+    "iter_many": "batch",
+    "run_many": "batch",
+    "SeparateOutput": "buffers",
+    "OutputLine": "buffers",
+    "SpillBuffer": "buffers",
+    "TailBuffer": "buffers",
+    "PipelineResult": "pipelines",
+    "StageResult": "pipelines",
+    "pipeline": "pipelines",
+    "tee": "pipelines",
+    "ShellResult": "result",
+    "run_shell_result": "result",
+    "BufferedSink": "sinks",
+    "BackgroundSink": "sinks",
+    "MetricsCollector": "metrics",
+    "MetricsRegistry": "metrics",
+    "TextfileWriter": "metrics",
+    "ChromeTraceWriter": "tracing",
+    "MemoryCollector": "tracing",
+    "start_forkserver": "forkserver",
+    "stop_forkserver": "forkserver",
+}
+
+
+def __getattr__(name):
+    if name == "__version__":
+        import ska_helpers
+
+        value = ska_helpers.get_version("ska_shell")
+    elif name in _LAZY_ATTRS:
+        module = importlib.import_module(f".{_LAZY_ATTRS[name]}", __name__)
+        value = getattr(module, name)
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_ATTRS) | {"__version__"})
 
 
 def test(*args, **kwargs):
@@ -0,0 +1,109 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Fork server helper process started by ``ska_shell.start_forkserver()``.
+
+This is run as a script (``python -I _forkserver_helper.py SOCKET_PATH``) so that
+it imports only the standard library and stays small.  It listens on a Unix
+socket and handles each connection in a thread:
+
+- Request: 8-byte ASCII length with the stdin, stdout and stderr file descriptors
+  attached (SCM_RIGHTS), followed by a JSON object with ``args``, ``env``, ``cwd``,
+  ``shell`` and ``start_new_session``.
+- Reply: a JSON line ``{"pid": pid}`` (or ``{"error": ..., "errno": ...}``) once the
+  command is started, then ``{"returncode": ..., "rusage": [...]}`` when it exits.
+
+The helper exits when its stdin is closed, i.e. when the parent process exits.
+"""
+
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+
+HEADER_SIZE = 8
+
+
+def _recv_exact(conn, size):
+    data = b""
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            raise EOFError
+        data += chunk
+    return data
+
+
+def _send(conn, msg):
+    conn.sendall(json.dumps(msg).encode() + b"\n")
+
+
+def _handle(conn):
+    with conn:
+        header, fds, _, _ = socket.recv_fds(conn, HEADER_SIZE, 3)
+        try:
+            header += _recv_exact(conn, HEADER_SIZE - len(header))
+            req = json.loads(_recv_exact(conn, int(header)))
+            try:
+                proc = subprocess.Popen(
+                    req["args"],
+                    stdin=fds[0],
+                    stdout=fds[1],
+                    stderr=fds[2],
+                    env=req["env"],
+                    cwd=req["cwd"],
+                    shell=req["shell"],
+                    start_new_session=req["start_new_session"],
+                )
+            except Exception as err:
+                _send(
+                    conn,
+                    {
+                        "error": getattr(err, "strerror", None) or str(err),
+                        "errno": getattr(err, "errno", None),
+                        "filename": getattr(err, "filename", None),
+                    },
+                )
+                return
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+        _send(conn, {"pid": proc.pid})
+        _, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        try:
+            _send(
+                conn,
+                {
+                    "returncode": proc.returncode,
+                    "rusage": [rusage.ru_utime, rusage.ru_stime, rusage.ru_maxrss],
+                },
+            )
+        except OSError:
+            # Client went away
+            pass
+
+
+def _watch_parent():
+    """Exit when the parent closes our stdin"""
+    while os.read(0, 1024):
+        pass
+    os._exit(0)
+
+
+def main(path):
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(64)
+    threading.Thread(target=_watch_parent, daemon=True).start()
+    sys.stdout.write("ready\n")
+    sys.stdout.flush()
+    while True:
+        conn, _ = server.accept()
+        threading.Thread(target=_handle, args=(conn,), daemon=True).start()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1])
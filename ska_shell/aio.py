@@ -0,0 +1,302 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Asyncio versions of the ska_shell functions for running subprocesses.
+
+These have the same arguments and return values as the functions of the same name
+in ``ska_shell`` but are coroutines, so many commands can run concurrently in one
+event loop.  Each child process is started in its own process group, and if the
+calling task is cancelled (or an ``AsyncSpawn`` times out) then the whole group
+is killed, including any processes started by the command.
+
+Example::
+
+  >>> import asyncio
+  >>> from ska_shell import aio
+  >>> async def main():
+  ...     return await asyncio.gather(*(aio.bash(f"echo {i}") for i in range(100)))
+  >>> outputs = asyncio.run(main())
+"""
+
+import asyncio
+import os
+import signal
+import subprocess
+
+from .shell import (
+    ResourceUsage,
+    RunTimeoutError,
+    Spawn,
+    _check_shell,
+    _env_nul_ok,
+    _EnvFile,
+    _finish_shell,
+    _get_log_level,
+    _join_cmdstr,
+    _LineSplitter,
+    _log_cmdstr,
+    _log_lines,
+    _make_environ,
+    _READ_SIZE,
+    _shell_args,
+    _updated_env,
+)
+
+__all__ = [
+    "AsyncSpawn",
+    "bash",
+    "communicate",
+    "getenv",
+    "importenv",
+    "run_shell",
+    "tcsh",
+]
+
+
+async def _kill(process):
+    """Kill the process group of ``process`` (started with ``start_new_session=True``)
+    and wait for ``process`` to exit"""
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+    await process.wait()
+
+
+async def communicate(process, logfile=None, logger=None, log_level=None):
+    """
+    Real-time reading of an asyncio subprocess stdout.
+
+    :param process: process returned by asyncio.create_subprocess_exec
+    :param logfile: append output to the suppplied file object
+    :param logger: log output to the supplied logging.Logger
+    :param log_level: log level for logger
+
+    :rtype: list of output lines
+    """
+    log_level = _get_log_level(log_level)
+    splitter = _LineSplitter()
+
+    lines = []
+    while True:
+        data = await process.stdout.read(_READ_SIZE)
+        batch = splitter.feed(data) if data else splitter.close()
+        if logfile or logger is not None:
+            _log_lines(batch, logfile, logger, log_level)
+        lines.extend(batch)
+        if not data:
+            break
+
+    await process.wait()
+    return lines
+
+
+async def run_shell(
+    cmdstr,
+    shell="bash",
+    logfile=None,
+    importenv=False,
+    getenv=False,
+    env=None,
+    logger=None,
+    log_level=None,
+    check=None,
+):
+    """Run the command string ``cmdstr`` in a ``shell`` ('bash' or 'tcsh').  See
+    ``ska_shell.run_shell`` for options.
+
+    :rtype: (outlines, deltaenv)
+    """
+    check = check if check is not None else True
+
+    environ = _make_environ(env)
+    # These run a subprocess the first time, which must not block the event loop
+    await asyncio.to_thread(_check_shell, shell)
+    if importenv or getenv:
+        await asyncio.to_thread(_env_nul_ok)
+
+    with _EnvFile(importenv or getenv) as envfile:
+        cmdstr = _join_cmdstr(cmdstr, envfile)
+        args = _shell_args(cmdstr, shell, check)
+        proc = await asyncio.create_subprocess_exec(
+            *args,
+            env=environ,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            start_new_session=True,
+        )
+        _log_cmdstr(logfile, shell, cmdstr)
+        try:
+            stdout = await communicate(
+                proc, logfile=logfile, logger=logger, log_level=log_level
+            )
+        except BaseException:
+            await _kill(proc)
+            raise
+        _log_cmdstr(logfile, shell)
+        newenv = envfile.read()
+
+    return _finish_shell(
+        proc.returncode,
+        stdout,
+        cmdstr,
+        args[0],
+        check,
+        importenv,
+        getenv,
+        newenv,
+        env=env,
+    )
+
+
+async def bash(
+    cmdstr, logfile=None, importenv=False, env=None, logger=None, log_level=None, check=None
+):
+    """Run the ``cmdstr`` string in a bash shell.  See ``run_shell`` for options.
+
+    :returns: bash output
+    """
+    outlines, _ = await run_shell(
+        cmdstr,
+        shell="bash",
+        logfile=logfile,
+        importenv=importenv,
+        env=env,
+        logger=logger,
+        log_level=log_level,
+        check=check,
+    )
+    return outlines
+
+
+async def tcsh(
+    cmdstr, logfile=None, importenv=False, env=None, logger=None, log_level=None, check=None
+):
+    """Run the ``cmdstr`` string in a tcsh shell.  See ``run_shell`` for options.
+
+    :returns: tcsh output
+    """
+    outlines, _ = await run_shell(
+        cmdstr,
+        shell="tcsh",
+        logfile=logfile,
+        importenv=importenv,
+        env=env,
+        logger=logger,
+        log_level=log_level,
+        check=check,
+    )
+    return outlines
+
+
+async def getenv(cmdstr, shell="bash", importenv=False, env=None):
+    """Run the ``cmdstr`` string in ``shell``.  See ``run_shell`` for options.
+
+    :returns: Dict of environment vars update produced by ``cmdstr``, or
+        ``Environment`` if ``env`` is an ``Environment``
+    """
+    _, newenv = await run_shell(
+        cmdstr, shell=shell, importenv=importenv, env=env, getenv=True, check=False
+    )
+    return _updated_env(env, newenv)
+
+
+async def importenv(cmdstr, shell="bash", env=None):
+    """Run ``cmdstr`` in a shell and import the environment updates into the
+    current python environment (os.environ).
+
+    :returns: Dict of environment vars update produced by ``cmdstr``
+    """
+    return await getenv(cmdstr, importenv=True, env=env, shell=shell)
+
+
+class AsyncSpawn(Spawn):
+    """
+    Asyncio version of ``Spawn`` where ``run()`` is a coroutine.  The timeout
+    is implemented with ``asyncio.wait_for`` so it works for any number of
+    concurrent runs in any thread.
+
+    Example::
+
+      >>> spawn = AsyncSpawn(stdout=None)
+      >>> status = await spawn.run(["echo", "hello"])
+
+    See ``Spawn`` for the constructor arguments.  With ``stderr=None`` the
+    process stderr is discarded, so ``errlines`` is always empty.  ``usage`` only
+    has the wall time because asyncio reaps the process.
+    """
+
+    async def _run(self, cmd, shell):
+        # stderr = None is taken to mean discard stderr
+        stderr = self.stderr or subprocess.DEVNULL
+        if shell:
+            self.process = await asyncio.create_subprocess_shell(
+                cmd, stdout=subprocess.PIPE, stderr=stderr, start_new_session=True
+            )
+        else:
+            args = [cmd] if isinstance(cmd, str) else cmd
+            self.process = await asyncio.create_subprocess_exec(
+                *args, stdout=subprocess.PIPE, stderr=stderr, start_new_session=True
+            )
+        try:
+            splitter = _LineSplitter(universal_newlines=True, keepends=True)
+            while True:
+                data = await self.process.stdout.read(_READ_SIZE)
+                lines = splitter.feed(data) if data else splitter.close()
+                if lines:
+                    self._write_files("".join(lines))
+                    self.outlines.extend(lines)
+                if not data:
+                    break
+            returncode = await self.process.wait()
+            self.usage._end()
+            return returncode
+        except BaseException:
+            await _kill(self.process)
+            self.usage._end()
+            raise
+
+    async def run(self, cmd, timeout=None, catch=None, shell=None):
+        """Run the command ``cmd`` and abort if timeout is exceeded.
+
+        See ``Spawn.run`` for arguments and attributes set after running.
+
+        :rtype: process exit value
+        """
+        if timeout is None:
+            timeout = self.timeout
+        if catch is None:
+            catch = self.catch
+        if shell is None:
+            shell = self.shell
+
+        self.outlines = []
+        self.errlines = []
+        self.exitstatus = None
+        self.process = None
+        self.usage = ResourceUsage()
+        self.usage._begin()
+
+        try:
+            try:
+                self.exitstatus = await asyncio.wait_for(
+                    self._run(cmd, shell), timeout or None
+                )
+            except asyncio.TimeoutError:
+                raise RunTimeoutError(
+                    "Process pid=%d timed out after %g secs"
+                    % (self.process.pid if self.process else -1, timeout)
+                ) from None
+
+        except RunTimeoutError as e:
+            if catch:
+                self._write("Warning - RunTimeoutError: %s\n" % e)
+            else:
+                raise
+
+        except OSError as e:
+            if catch:
+                self._write("Warning - OSError: %s\n" % e)
+            else:
+                raise
+
+        return self.exitstatus
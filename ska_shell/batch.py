@@ -0,0 +1,189 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""Run many shell commands concurrently"""
+
+import concurrent.futures
+import io
+import os
+import threading
+
+from .shell import ResourceUsage, run_shell
+
+
+class JobResult:
+    """
+    Result of one command run by ``run_many()`` or ``iter_many()``.
+
+    Attributes:
+     - index: position of the command in the input ``cmds``
+     - cmdstr: command string
+     - outlines: list of output lines (partial output if the command failed)
+     - deltaenv: environment changes if ``getenv=True`` (else empty dict)
+     - exception: exception raised by the command or None
+     - usage: ``ResourceUsage`` with the wall time, CPU time and maximum memory of
+       the command
+    """
+
+    def __init__(
+        self, index, cmdstr, outlines=None, deltaenv=None, exception=None, usage=None
+    ):
+        self.index = index
+        self.cmdstr = cmdstr
+        self.outlines = outlines if outlines is not None else []
+        self.deltaenv = deltaenv if deltaenv is not None else {}
+        self.exception = exception
+        self.usage = usage if usage is not None else ResourceUsage()
+
+    @property
+    def ok(self):
+        """True if the command completed without an exception"""
+        return self.exception is None
+
+    def __repr__(self):
+        status = "ok" if self.ok else type(self.exception).__name__
+        return f"<JobResult index={self.index} {status} cmdstr={self.cmdstr!r}>"
+
+
+class _LogRecords:
+    """Logger stand-in that stores records to be replayed in one block"""
+
+    def __init__(self):
+        self.records = []
+
+    def log(self, level, msg):
+        self.records.append((level, msg))
+
+
+def _run_job(index, cmdstr, logfile, logger, log_lock, kwargs):
+    # A logfile name pattern gets a separate file per job.  A shared file object or
+    # logger gets the output of each job in one block when the job finishes.
+    if isinstance(logfile, str):
+        job_logfile = open(logfile.format(index=index), "w")
+    else:
+        job_logfile = io.StringIO() if logfile else None
+    job_logger = _LogRecords() if logger is not None else None
+
+    result = JobResult(index, cmdstr)
+    try:
+        result.outlines, result.deltaenv = run_shell(
+            cmdstr,
+            logfile=job_logfile,
+            logger=job_logger,
+            usage=result.usage,
+            **kwargs,
+        )
+    except Exception as exc:
+        result.exception = exc
+        result.outlines = getattr(exc, "lines", [])
+    finally:
+        if isinstance(logfile, str):
+            job_logfile.close()
+        with log_lock:
+            if logfile and not isinstance(logfile, str):
+                logfile.write(job_logfile.getvalue())
+            if logger is not None:
+                for level, msg in job_logger.records:
+                    logger.log(level, msg)
+    return result
+
+
+def iter_many(
+    cmds,
+    shell="bash",
+    max_workers=None,
+    env=None,
+    check=None,
+    getenv=False,
+    fail_fast=False,
+    logfile=None,
+    logger=None,
+    log_level=None,
+):
+    """
+    Run each of the command strings in ``cmds`` with ``run_shell()`` using up to
+    ``max_workers`` concurrent shells, and yield a ``JobResult`` for each one in the
+    order they complete.
+
+    A command that fails does not stop the others; its exception is stored in
+    ``JobResult.exception``.  With ``fail_fast=True`` the commands that have not
+    started are cancelled and the first exception is raised once the running
+    commands finish.
+
+    Output of each command is kept together.  If ``logfile`` is a string, it is used
+    as a file name pattern where ``{index}`` is replaced by the command index, giving
+    one log file per command.  If ``logfile`` is a file object or ``logger`` is
+    given then each command's output is written in one block when it finishes.
+
+    :param cmds: list of command strings
+    :param shell: shell for commands -- 'bash' (default) or 'tcsh'
+    :param max_workers: maximum number of concurrent commands (default: number of
+        CPUs)
+    :param env: set environment using ``env`` dict prior to running commands
+    :param check: treat non-zero exit status as a failure (default: True)
+    :param getenv: get the environent changes after running each command
+    :param fail_fast: stop at the first failure
+    :param logfile: file object or file name pattern for command output
+    :param logger: log output to the supplied logging.Logger
+    :param log_level: log level for logger
+
+    :returns: iterator of ``JobResult``
+    """
+    kwargs = dict(shell=shell, env=env, check=check, getenv=getenv, log_level=log_level)
+    log_lock = threading.Lock()
+    max_workers = max_workers or os.cpu_count()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        futures = [
+            executor.submit(_run_job, index, cmdstr, logfile, logger, log_lock, kwargs)
+            for index, cmdstr in enumerate(cmds)
+        ]
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                result = future.result()
+                if fail_fast and not result.ok:
+                    raise result.exception
+                yield result
+        finally:
+            # Early exit, exception or generator closed by the caller
+            for future in futures:
+                future.cancel()
+
+
+def run_many(
+    cmds,
+    shell="bash",
+    max_workers=None,
+    env=None,
+    check=None,
+    getenv=False,
+    fail_fast=False,
+    logfile=None,
+    logger=None,
+    log_level=None,
+):
+    """
+    Run each of the command strings in ``cmds`` with ``run_shell()`` using up to
+    ``max_workers`` concurrent shells.  See ``iter_many`` for options.
+
+    Example::
+
+      >>> from ska_shell import run_many
+      >>> results = run_many([f"gzip {name}" for name in names], max_workers=8)
+      >>> failed = [result for result in results if not result.ok]
+
+    :returns: list of ``JobResult`` in the same order as ``cmds``
+    """
+    results = list(
+        iter_many(
+            cmds,
+            shell=shell,
+            max_workers=max_workers,
+            env=env,
+            check=check,
+            getenv=getenv,
+            fail_fast=fail_fast,
+            logfile=logfile,
+            logger=logger,
+            log_level=log_level,
+        )
+    )
+    return sorted(results, key=lambda result: result.index)
@@ -0,0 +1,2 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""Benchmarks for ska_shell.  These are not run as part of the unit tests."""
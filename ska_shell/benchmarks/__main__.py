@@ -0,0 +1,74 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""Run the ska_shell benchmark suite and optionally compare with a saved baseline"""
+
+import argparse
+import dataclasses
+import json
+import sys
+
+from ska_shell.benchmarks import suite
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("names", nargs="*", help="benchmarks to run (default: all)")
+    parser.add_argument("--save", help="save results as a JSON baseline file")
+    parser.add_argument("--compare", help="compare results with a JSON baseline file")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="allowed fractional regression relative to baseline (default: 0.2)",
+    )
+    parser.add_argument(
+        "--scale",
+        type=float,
+        default=1.0,
+        help="scale factor for the number of iterations (default: 1.0)",
+    )
+    parser.add_argument("--list", action="store_true", help="list benchmarks")
+    opt = parser.parse_args(args)
+
+    if opt.list:
+        for name, func in suite.BENCHMARKS.items():
+            print(f"{name:26s} {func.__doc__}")
+        return 0
+
+    unknown = set(opt.names) - set(suite.BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(sorted(unknown))}")
+
+    baseline = {}
+    if opt.compare:
+        with open(opt.compare) as fh:
+            baseline = {
+                name: suite.Result(**vals) for name, vals in json.load(fh).items()
+            }
+
+    results = suite.run(opt.names, scale=opt.scale)
+    for name, result in results.items():
+        line = f"{name:26s} {result.value:10.3f} {result.unit:9s}"
+        if name in baseline:
+            change = result.value / baseline[name].value - 1
+            line += f" {change:+7.1%} vs baseline"
+        print(line)
+
+    if opt.save:
+        with open(opt.save, "w") as fh:
+            json.dump(
+                {name: dataclasses.asdict(res) for name, res in results.items()},
+                fh,
+                indent=2,
+            )
+
+    regressions = suite.compare(results, baseline, opt.tolerance)
+    for name, result, base in regressions:
+        print(
+            f"REGRESSION {name}: {result.value:.3f} {result.unit} "
+            f"(baseline {base.value:.3f} {base.unit})"
+        )
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
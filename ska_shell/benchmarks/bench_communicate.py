@@ -0,0 +1,61 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Benchmark throughput of ``communicate()`` for a child that writes many lines.
+
+Usage::
+
+  python -m ska_shell.benchmarks.bench_communicate --nlines 2000000
+"""
+
+import argparse
+import subprocess
+import time
+
+from ska_shell.shell import communicate
+
+
+def _communicate_readline(process):
+    """Line-at-a-time reader equivalent to the original ``communicate()``"""
+    lines = []
+    while True:
+        if process.poll() is not None:
+            break
+        line = process.stdout.readline()
+        line = line.decode() if isinstance(line, bytes) else line
+        if line:
+            lines.append(line[:-1])
+    for line in process.stdout.readlines():
+        line = line.decode() if isinstance(line, bytes) else line
+        if line:
+            lines.append(line[:-1])
+    return lines
+
+
+def bench_communicate(nlines, reader=communicate):
+    """Return lines/sec for ``reader`` on a child printing ``nlines`` lines"""
+    t0 = time.perf_counter()
+    proc = subprocess.Popen(
+        ["seq", str(nlines)], stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+    )
+    lines = reader(proc)
+    proc.wait()
+    dt = time.perf_counter() - t0
+    assert len(lines) == nlines
+    return nlines / dt
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--nlines", type=int, default=2_000_000)
+    opt = parser.parse_args(args)
+
+    for name, reader in (
+        ("communicate", communicate),
+        ("readline (original)", _communicate_readline),
+    ):
+        rate = bench_communicate(opt.nlines, reader)
+        print(f"{name:20s} {rate / 1e6:8.2f} million lines/sec")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Benchmark per-call latency of ``tcsh()`` run directly versus through the former
+bash wrapper (``bash -c "tcsh -e -f -c '...'"``).
+
+Usage::
+
+  python -m ska_shell.benchmarks.bench_tcsh --ncalls 200
+"""
+
+import argparse
+import shutil
+import subprocess
+import time
+
+from ska_shell.shell import communicate, tcsh
+
+
+def _tcsh_wrapper(cmdstr):
+    """Run ``cmdstr`` the way ``run_shell`` formerly ran tcsh commands"""
+    proc = subprocess.Popen(
+        ["bash", "-c", f"tcsh -e -f -c '{cmdstr}'"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+    )
+    return communicate(proc)
+
+
+def bench_latency(func, ncalls, cmdstr="echo hello"):
+    """Return mean seconds per call of ``func(cmdstr)``"""
+    func(cmdstr)  # warm up
+    t0 = time.perf_counter()
+    for _ in range(ncalls):
+        func(cmdstr)
+    return (time.perf_counter() - t0) / ncalls
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--ncalls", type=int, default=200)
+    opt = parser.parse_args(args)
+
+    if shutil.which("tcsh") is None:
+        print("tcsh not found, skipping")
+        return
+
+    for name, func in (("tcsh (direct)", tcsh), ("bash wrapper", _tcsh_wrapper)):
+        latency = bench_latency(func, opt.ncalls)
+        print(f"{name:20s} {latency * 1000:8.2f} ms/call")
+
+
+if __name__ == "__main__":
+    main()
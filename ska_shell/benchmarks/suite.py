@@ -0,0 +1,189 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Benchmark suite for ska_shell hot paths.
+
+Each benchmark is a function that returns a ``Result`` and is registered with the
+``@benchmark`` decorator.  All benchmarks run offline using only standard Linux
+commands.  Run the suite with::
+
+  python -m ska_shell.benchmarks                      # print results
+  python -m ska_shell.benchmarks --save base.json     # save a baseline
+  python -m ska_shell.benchmarks --compare base.json  # fail on regressions
+"""
+
+import os
+import shutil
+import time
+from dataclasses import dataclass
+
+from ska_shell.batch import run_many
+from ska_shell.benchmarks.bench_communicate import bench_communicate
+from ska_shell.shell import (
+    Spawn,
+    _fix_paths,
+    _parse_env0,
+    _parse_keyvals,
+    bash,
+    getenv,
+    tcsh,
+)
+
+BENCHMARKS = {}
+
+
+@dataclass
+class Result:
+    """Benchmark result.
+
+    :param value: measured value
+    :param unit: unit of ``value``
+    :param higher_is_better: True for rates, False for times
+    """
+
+    value: float
+    unit: str
+    higher_is_better: bool = False
+
+
+def benchmark(func):
+    """Register ``func`` as a benchmark named after the function"""
+    BENCHMARKS[func.__name__.removeprefix("bench_")] = func
+    return func
+
+
+def _seconds_per_call(func, ncalls):
+    func()  # warm up
+    t0 = time.perf_counter()
+    for _ in range(ncalls):
+        func()
+    return (time.perf_counter() - t0) / ncalls
+
+
+@benchmark
+def bench_bash_latency(scale=1.0):
+    """Per-call latency of bash() for a trivial command"""
+    dt = _seconds_per_call(lambda: bash("true"), int(100 * scale) or 1)
+    return Result(dt * 1000, "ms")
+
+
+@benchmark
+def bench_tcsh_latency(scale=1.0):
+    """Per-call latency of tcsh() for a trivial command"""
+    if shutil.which("tcsh") is None:
+        return None
+    dt = _seconds_per_call(lambda: tcsh("true"), int(100 * scale) or 1)
+    return Result(dt * 1000, "ms")
+
+
+@benchmark
+def bench_spawn_latency(scale=1.0):
+    """Per-call latency of Spawn.run() for a trivial command"""
+    spawn = Spawn(stdout=None)
+    dt = _seconds_per_call(lambda: spawn.run(["true"]), int(100 * scale) or 1)
+    return Result(dt * 1000, "ms")
+
+
+@benchmark
+def bench_communicate_throughput(scale=1.0):
+    """Throughput of communicate() for a child printing many lines"""
+    rate = bench_communicate(int(1_000_000 * scale) or 1)
+    return Result(rate / 1e6, "Mlines/s", higher_is_better=True)
+
+
+@benchmark
+def bench_getenv_large_env(scale=1.0):
+    """Per-call cost of getenv() with 2000 extra environment vars"""
+    env = {f"SKA_SHELL_BENCH_{i}": "x" * 100 for i in range(2000)}
+    dt = _seconds_per_call(
+        lambda: getenv("export SKA_SHELL_BENCH=1", env=env), int(20 * scale) or 1
+    )
+    return Result(dt * 1000, "ms")
+
+
+def _long_path(npaths=10_000):
+    # Half of the entries are duplicates
+    return ":".join(f"/opt/dir{i % (npaths // 2)}/bin" for i in range(npaths))
+
+
+@benchmark
+def bench_fix_paths(scale=1.0):
+    """_fix_paths() on PATH-like variables with 10000 entries"""
+    path = _long_path()
+
+    def func():
+        envs = {key: path for key in ("PATH", "LD_LIBRARY_PATH", "PYTHONPATH")}
+        _fix_paths(envs)
+
+    dt = _seconds_per_call(func, int(20 * scale) or 1)
+    return Result(dt * 1000, "ms")
+
+
+@benchmark
+def bench_parse_keyvals(scale=1.0):
+    """_parse_keyvals() on printenv output with long PATH-like variables"""
+    path = _long_path()
+    keyvals = [f"VAR{i}={path if i % 10 == 0 else 'value'}" for i in range(1000)]
+    dt = _seconds_per_call(lambda: _parse_keyvals(keyvals), int(20 * scale) or 1)
+    return Result(dt * 1000, "ms")
+
+
+@benchmark
+def bench_parse_env0(scale=1.0):
+    """_parse_env0() on ``env -0`` output with long PATH-like variables"""
+    path = _long_path()
+    data = b"".join(
+        f"VAR{i}={path if i % 10 == 0 else 'value'}\0".encode() for i in range(1000)
+    )
+    dt = _seconds_per_call(lambda: _parse_env0(data), int(20 * scale) or 1)
+    return Result(dt * 1000, "ms")
+
+
+@benchmark
+def bench_concurrent_scaling(scale=1.0):
+    """Speedup of run_many() with one worker per CPU relative to one worker"""
+    cmds = ["true"] * (int(4 * (os.cpu_count() or 1) * 10 * scale) or 1)
+    times = []
+    for max_workers in (1, os.cpu_count()):
+        t0 = time.perf_counter()
+        run_many(cmds, max_workers=max_workers)
+        times.append(time.perf_counter() - t0)
+    return Result(times[0] / times[1], "x", higher_is_better=True)
+
+
+def run(names=None, scale=1.0):
+    """Run benchmarks and return dict of name: Result.
+
+    :param names: list of benchmark names (default: all)
+    :param scale: scale factor for the number of iterations
+    :rtype: dict
+    """
+    results = {}
+    for name, func in BENCHMARKS.items():
+        if names and name not in names:
+            continue
+        result = func(scale)
+        if result is not None:
+            results[name] = result
+    return results
+
+
+def compare(results, baseline, tolerance=0.2):
+    """Compare ``results`` to ``baseline`` and return list of regressions.
+
+    :param results: dict of name: Result
+    :param baseline: dict of name: Result
+    :param tolerance: allowed fractional change in the worse direction
+    :rtype: list of (name, result, baseline result)
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        if result.higher_is_better:
+            worse = result.value < base.value * (1 - tolerance)
+        else:
+            worse = result.value > base.value * (1 + tolerance)
+        if worse:
+            regressions.append((name, result, base))
+    return regressions
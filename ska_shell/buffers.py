@@ -0,0 +1,262 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Output buffers that limit the memory used to keep the output of long-running
+commands.  Pass one as the ``retain`` argument of ``run_shell()`` or ``Spawn`` to
+use it instead of a list.
+
+``SeparateOutput`` keeps the stdout and stderr lines of a command run with
+``run_shell(..., separate_stderr=True)``.
+"""
+
+import collections
+import collections.abc
+import itertools
+import tempfile
+import time
+
+__all__ = ["TailBuffer", "SpillBuffer", "SeparateOutput", "OutputLine"]
+
+OutputLine = collections.namedtuple("OutputLine", ["time", "stream", "line"])
+OutputLine.__doc__ = """Output line with the ``time.monotonic()`` time it was read
+and the name of its ``stream`` ("stdout" or "stderr")"""
+
+
+class _OutputBuffer(collections.abc.Sequence):
+    """Base class for output buffers.  Subclasses store lines appended with
+    ``append()`` or ``extend()`` and are emptied by ``clear()``."""
+
+    def __eq__(self, other):
+        if isinstance(other, collections.abc.Sequence) and not isinstance(other, str):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __repr__(self):
+        return f"<{type(self).__name__} nlines={self.nlines} retained={len(self)}>"
+
+    def append(self, line):
+        self.extend([line])
+
+
+class TailBuffer(_OutputBuffer):
+    """
+    Keep only the last ``max_lines`` lines and/or the last ``max_bytes`` of output.
+
+    The size of a line is taken as its number of characters plus one for the
+    newline, so for non-ASCII output ``max_bytes`` is approximate.  The last line
+    is always kept even if it exceeds ``max_bytes``.
+
+    Example::
+
+      >>> from ska_shell import TailBuffer, bash
+      >>> outlines = bash("make all", retain=TailBuffer(max_lines=1000))
+      >>> outlines.nlines  # total number of lines of output
+
+    :param max_lines: maximum number of lines to keep (default: no limit)
+    :param max_bytes: maximum size of lines to keep (default: no limit)
+    """
+
+    def __init__(self, max_lines=None, max_bytes=None):
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+        self.clear()
+
+    def clear(self):
+        """Remove all lines"""
+        self._lines = collections.deque(maxlen=self.max_lines)
+        self._nbytes = 0
+        self.nlines = 0
+
+    @property
+    def dropped(self):
+        """Number of lines that were discarded"""
+        return self.nlines - len(self._lines)
+
+    def extend(self, lines):
+        """Append ``lines`` and discard the oldest lines beyond the limits"""
+        self.nlines += len(lines)
+        if self.max_bytes is None:
+            self._lines.extend(lines)
+            return
+
+        for line in lines:
+            if len(self._lines) == self.max_lines:
+                if not self._lines:
+                    # max_lines=0: nothing is kept
+                    continue
+                self._nbytes -= len(self._lines[0]) + 1
+            self._lines.append(line)
+            self._nbytes += len(line) + 1
+        while self._nbytes > self.max_bytes and len(self._lines) > 1:
+            self._nbytes -= len(self._lines.popleft()) + 1
+
+    def __len__(self):
+        return len(self._lines)
+
+    def __iter__(self):
+        return iter(self._lines)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return list(self._lines)[idx]
+        return self._lines[idx]
+
+
+def _encode_records(lines):
+    """Return ``lines`` as ``SpillBuffer`` file records: the size in bytes of the
+    line, a newline and the line"""
+    records = []
+    for line in lines:
+        data = line.encode("utf-8", "surrogateescape")
+        records.append(b"%d\n" % len(data))
+        records.append(data)
+    return b"".join(records)
+
+
+class SpillBuffer(_OutputBuffer):
+    """
+    Keep output lines in memory until they exceed ``max_bytes``, then write all
+    lines to a temporary file that is read lazily.
+
+    Iterating over the buffer reads the file from the start without loading it
+    into memory.  The last ``tail_lines`` lines are also kept in memory, so
+    indexing or slicing near the end (e.g. ``outlines[-1:]``) does not read the
+    file.  Other indexing reads the file up to the requested line.  Each line is
+    stored with its length, so lines are returned exactly as they were added,
+    with or without a newline (e.g. ``Spawn`` output lines).  The file is deleted
+    by ``close()`` or ``clear()``, which both empty the buffer, or when the buffer
+    is garbage collected.
+
+    :param max_bytes: size of lines to keep in memory before spilling to a file
+        (default: 50 MB).  See ``TailBuffer`` for how size is computed.
+    :param tail_lines: number of lines at the end to also keep in memory
+    :param dir: directory for the temporary file (default: system temp dir)
+    """
+
+    def __init__(self, max_bytes=50_000_000, tail_lines=100, dir=None):
+        self.max_bytes = max_bytes
+        self.tail_lines = tail_lines
+        self.dir = dir
+        self._file = None
+        self.clear()
+
+    def clear(self):
+        """Remove all lines and delete the temporary file"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._lines = []
+        self._tail = collections.deque(maxlen=self.tail_lines)
+        self._nbytes = 0
+        self.nlines = 0
+
+    def close(self):
+        """Delete the temporary file, if any, and remove all lines (the same as
+        ``clear()``)"""
+        self.clear()
+
+    @property
+    def spilled(self):
+        """True if lines have been written to a temporary file"""
+        return self._file is not None
+
+    def extend(self, lines):
+        """Append ``lines``, writing them to the temporary file if it is in use"""
+        self.nlines += len(lines)
+        self._tail.extend(lines)
+        if self._file is not None:
+            self._file.write(_encode_records(lines))
+            return
+
+        self._lines.extend(lines)
+        self._nbytes += sum(len(line) + 1 for line in lines)
+        if self._nbytes > self.max_bytes:
+            self._file = tempfile.NamedTemporaryFile(
+                "wb", dir=self.dir, prefix="ska_shell_", suffix=".out"
+            )
+            self._file.write(_encode_records(self._lines))
+            self._lines = []
+
+    def __len__(self):
+        return self.nlines
+
+    def __iter__(self):
+        if self._file is None:
+            yield from self._lines
+            return
+        self._file.flush()
+        # Separate file object so reading does not move the write position
+        nlines = self.nlines
+        with open(self._file.name, "rb") as fh:
+            for _ in range(nlines):
+                size = int(fh.readline())
+                yield fh.read(size).decode("utf-8", "surrogateescape")
+
+    def __getitem__(self, idx):
+        if self._file is None:
+            return self._lines[idx]
+
+        ntail = len(self._tail)
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(self.nlines)
+            offset = self.nlines - ntail
+            if step > 0 and start >= offset:
+                stop = max(stop, start)
+                return list(self._tail)[start - offset : stop - offset : step]
+            return list(self)[idx]
+
+        if idx < 0:
+            idx += self.nlines
+        if not 0 <= idx < self.nlines:
+            raise IndexError("SpillBuffer index out of range")
+        if idx >= self.nlines - ntail:
+            return self._tail[idx - (self.nlines - ntail)]
+        return next(itertools.islice(iter(self), idx, None))
+
+
+class SeparateOutput(_OutputBuffer):
+    """
+    Output of a command with stdout and stderr read separately.
+
+    This is a sequence of the stdout lines, so it can be used like the list of
+    output lines from ``run_shell()``.  The stderr lines are in ``stderr`` and
+    ``merged`` has all lines as ``OutputLine(time, stream, line)`` in the order they
+    were read.  The time is the ``time.monotonic()`` value when the chunk of output
+    containing the line was read.
+
+    Example::
+
+      >>> from ska_shell import bash
+      >>> outlines = bash("make all", separate_stderr=True, check=False)
+      >>> outlines.stderr[-10:]
+      >>> [(rec.time, rec.line) for rec in outlines.merged if rec.stream == "stderr"]
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        """Remove all lines"""
+        self.stdout = []
+        self.stderr = []
+        self.merged = []
+
+    @property
+    def nlines(self):
+        """Total number of stdout and stderr lines"""
+        return len(self.merged)
+
+    def extend(self, lines, stream="stdout", time_read=None):
+        """Append ``lines`` read from ``stream`` at ``time_read`` (default: now)"""
+        if time_read is None:
+            time_read = time.monotonic()
+        getattr(self, stream).extend(lines)
+        self.merged.extend([OutputLine(time_read, stream, line) for line in lines])
+
+    def __len__(self):
+        return len(self.stdout)
+
+    def __iter__(self):
+        return iter(self.stdout)
+
+    def __getitem__(self, idx):
+        return self.stdout[idx]
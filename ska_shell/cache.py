@@ -0,0 +1,352 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""Persistent on-disk caches for results of shell commands"""
+
+import hashlib
+import json
+import os
+import re
+import tempfile
+import time
+
+from .shell import Environment, _make_environ
+
+__all__ = ["EnvCache", "CommandCache"]
+
+
+def _default_cache_dir(name):
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(base, "ska_shell", name)
+
+
+def _file_hash(path):
+    """Return the SHA-256 hex digest of the contents of ``path`` or None if it
+    cannot be read"""
+    digest = hashlib.sha256()
+    try:
+        with open(path, "rb") as fh:
+            for block in iter(lambda: fh.read(1 << 20), b""):
+                digest.update(block)
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+
+def _file_stamp(path):
+    """Return (mtime_ns, size) of ``path`` or None if it does not exist"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+class _DiskCache:
+    """
+    Directory of JSON files, one per cache key.
+
+    Entries are written to a temporary file and renamed into place so that
+    concurrent readers and writers in other processes never see a partial entry.
+    Reading an entry updates its mtime, which is used to evict the least recently
+    used entries once there are more than ``max_entries`` or they use more than
+    ``max_bytes``.
+
+    :param cache_dir: directory for cache files
+    :param max_age: entries older than this many seconds are ignored and removed
+        (default: no limit)
+    :param max_entries: maximum number of entries to keep (default: no limit)
+    :param max_bytes: maximum total size of the entries (default: no limit)
+    """
+
+    def __init__(self, cache_dir, max_age=None, max_entries=None, max_bytes=None):
+        self.cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def _hash(*parts):
+        text = json.dumps(parts, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".json")
+
+    def _entries(self):
+        """Return list of (mtime, path, size) for all cache entries"""
+        entries = []
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.name.endswith(".json"):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, entry.path, stat.st_size))
+        return entries
+
+    def load(self, key):
+        """Return the value stored for ``key`` or None if missing or expired.
+
+        :param key: cache key
+        """
+        path = self._path(key)
+        try:
+            with open(path) as fh:
+                entry = json.load(fh)
+        except (OSError, ValueError):
+            return None
+        if self.max_age is not None and time.time() - entry["created"] > self.max_age:
+            self._remove(path)
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return entry["value"]
+
+    def store(self, key, value):
+        """Store JSON-serializable ``value`` for ``key``.
+
+        :param key: cache key
+        :param value: value to store
+        """
+        entry = {"created": time.time(), "value": value}
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as fh:
+                json.dump(entry, fh)
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            self._remove(tmp_path)
+            raise
+        self._evict()
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        if self.max_entries is None and self.max_bytes is None:
+            return
+        entries = self._entries()
+        entries.sort()
+        count = len(entries)
+        nbytes = sum(size for _, _, size in entries)
+        for _, path, size in entries:
+            if (self.max_entries is None or count <= self.max_entries) and (
+                self.max_bytes is None or nbytes <= self.max_bytes
+            ):
+                break
+            # Another process may be evicting the same entries
+            self._remove(path)
+            count -= 1
+            nbytes -= size
+
+    def __len__(self):
+        return len(self._entries())
+
+    def clear(self):
+        """Remove all entries from the cache"""
+        for _, path, _ in self._entries():
+            self._remove(path)
+
+
+# Commands that read a file into the current shell
+_RE_SOURCE = re.compile(r"(?:^|[;&|(\s])(?:source|\.)\s+([^\s;&|()]+)")
+
+
+class EnvCache(_DiskCache):
+    """
+    Cache of ``getenv()`` results so that repeating an expensive environment setup
+    (e.g. sourcing the CIAO or ASCDS setup scripts) costs one file read instead of
+    running a shell.
+
+    The cache key is built from the command string, the shell, the complete input
+    environment (``os.environ`` updated by ``env``) and the modification time and
+    size of every file that ``cmdstr`` reads with ``source`` or ``.``.  Changes to
+    files that are read indirectly by those scripts are not detected, so use
+    ``max_age`` or ``invalidate()`` if they can change.
+
+    Example::
+
+      >>> from ska_shell import EnvCache, getenv
+      >>> cache = EnvCache(max_age=86400)
+      >>> envs = getenv(". /soft/ciao/bin/ciao.sh", cache=cache)
+
+    :param cache_dir: directory for cache files (default: ``ska_shell/getenv`` in
+        ``$XDG_CACHE_HOME`` or ``~/.cache``)
+    :param max_age: entries older than this many seconds are not used (default: no
+        limit)
+    :param max_entries: maximum number of entries to keep, evicting the least
+        recently used (default: 100)
+    """
+
+    def __init__(self, cache_dir=None, max_age=None, max_entries=100):
+        if cache_dir is None:
+            cache_dir = _default_cache_dir("getenv")
+        super().__init__(cache_dir, max_age=max_age, max_entries=max_entries)
+
+    @staticmethod
+    def sourced_files(cmdstr):
+        """Return the files read with ``source`` or ``.`` in ``cmdstr``.
+
+        :param cmdstr: command string
+        :rtype: list of str
+        """
+        return [
+            os.path.expandvars(os.path.expanduser(match.group(1).strip("'\"")))
+            for match in _RE_SOURCE.finditer(cmdstr)
+        ]
+
+    def key(self, cmdstr, shell="bash", env=None):
+        """Return the cache key for ``getenv(cmdstr, shell=shell, env=env)``.
+
+        :param cmdstr: command string
+        :param shell: shell for command
+        :param env: ``env`` dict passed to ``getenv``
+        :rtype: str
+        """
+        environ = _make_environ(env)
+        files = {path: _file_stamp(path) for path in self.sourced_files(cmdstr)}
+        return self._hash(cmdstr, shell, environ, files)
+
+    def get(self, cmdstr, shell="bash", env=None):
+        """Return the cached ``deltaenv`` dict or None if there is no valid entry.
+
+        :param cmdstr: command string
+        :param shell: shell for command
+        :param env: ``env`` dict passed to ``getenv``
+        :rtype: dict or None
+        """
+        return self.load(self.key(cmdstr, shell, env))
+
+    def set(self, cmdstr, deltaenv, shell="bash", env=None):
+        """Store the ``deltaenv`` dict produced by ``getenv(cmdstr, ...)``.
+
+        :param cmdstr: command string
+        :param deltaenv: dict of environment vars update produced by ``cmdstr``
+        :param shell: shell for command
+        :param env: ``env`` dict passed to ``getenv``
+        """
+        self.store(self.key(cmdstr, shell, env), deltaenv)
+
+    def invalidate(self, cmdstr, shell="bash", env=None):
+        """Remove the entry for ``getenv(cmdstr, shell=shell, env=env)``.
+
+        :param cmdstr: command string
+        :param shell: shell for command
+        :param env: ``env`` dict passed to ``getenv``
+        """
+        self._remove(self._path(self.key(cmdstr, shell, env)))
+
+
+# Environment variables that commonly change what a command does
+_COMMAND_ENV_VARS = ("PATH", "LD_LIBRARY_PATH", "PYTHONPATH", "HOME", "LANG")
+
+
+class CommandCache(_DiskCache):
+    """
+    Cache of command output so that repeating an expensive command whose inputs
+    have not changed returns the stored output instead of running it again, like
+    ``make``.
+
+    Pass it as the ``cache`` argument of ``run_shell()`` (and its wrappers) or
+    ``Spawn.run()``, together with the files the command reads in
+    ``cache_inputs``.  The cache key is built from the command, the options that
+    change how it is run (e.g. the shell), the working directory, the ``env`` dict
+    passed to ``run_shell()``, the values of the ``env_vars`` environment variables
+    and the modification time and size (or with ``hash_inputs`` the contents) of
+    every input file.
+
+    Only commands that succeed are stored, so a failure is not remembered.  If an
+    input file changes while the command runs then the result is not stored.
+    Entries are written atomically, so any number of processes can share a cache
+    directory.
+
+    Example::
+
+      >>> from ska_shell import CommandCache, bash
+      >>> cache = CommandCache(max_bytes=100_000_000)
+      >>> files = ["acis_evt2.fits"]
+      >>> lines = bash("dmlist acis_evt2.fits blocks", cache=cache, cache_inputs=files)
+
+    :param cache_dir: directory for cache files (default: ``ska_shell/commands`` in
+        ``$XDG_CACHE_HOME`` or ``~/.cache``)
+    :param max_age: entries older than this many seconds are not used (default: no
+        limit)
+    :param max_entries: maximum number of entries to keep, evicting the least
+        recently used (default: 1000)
+    :param max_bytes: maximum total size of the entries, evicting the least
+        recently used (default: no limit)
+    :param env_vars: names of the environment variables that are part of the key
+        (default: PATH, LD_LIBRARY_PATH, PYTHONPATH, HOME and LANG).  Use None to
+        include the whole environment.
+    :param hash_inputs: identify input files by a hash of their contents instead
+        of their modification time and size
+    """
+
+    def __init__(
+        self,
+        cache_dir=None,
+        max_age=None,
+        max_entries=1000,
+        max_bytes=None,
+        env_vars=_COMMAND_ENV_VARS,
+        hash_inputs=False,
+    ):
+        if cache_dir is None:
+            cache_dir = _default_cache_dir("commands")
+        super().__init__(
+            cache_dir, max_age=max_age, max_entries=max_entries, max_bytes=max_bytes
+        )
+        self.env_vars = env_vars
+        self.hash_inputs = hash_inputs
+
+    @staticmethod
+    def _stamps(inputs):
+        """Return dict of absolute path: (mtime, size) for ``inputs``"""
+        paths = [os.path.abspath(path) for path in (inputs or ())]
+        return {path: _file_stamp(path) for path in paths}
+
+    def key(self, cmd, inputs=None, env=None, **options):
+        """Return the cache key for running ``cmd``.
+
+        :param cmd: command string or list of arguments
+        :param inputs: list of files read by ``cmd``
+        :param env: ``env`` dict used to run ``cmd``
+        :param options: other options that change the output of ``cmd``
+        :rtype: str
+        """
+        environ = _make_environ(env)
+        if self.env_vars is not None:
+            environ = {name: environ.get(name) for name in self.env_vars}
+            if isinstance(env, Environment):
+                environ.update(env._overrides())
+            else:
+                environ.update(env or {})
+        if self.hash_inputs:
+            files = {
+                path: _file_hash(path)
+                for path in (os.path.abspath(path) for path in inputs or ())
+            }
+        else:
+            files = self._stamps(inputs)
+        return self._hash(cmd, options, os.getcwd(), environ, files)
+
+    def _lookup(self, cmd, inputs=None, env=None, **options):
+        """Return (key, stamps, value) where ``value`` is the stored result of
+        ``cmd`` or None and ``stamps`` are the input file stamps before running it"""
+        stamps = self._stamps(inputs)
+        key = self.key(cmd, inputs, env, **options)
+        return key, stamps, self.load(key)
+
+    def _save(self, key, stamps, inputs, value):
+        """Store ``value`` for ``key`` unless the inputs changed since ``stamps``"""
+        if self._stamps(inputs) == stamps:
+            self.store(key, value)
@@ -0,0 +1,293 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Fork server that starts commands on behalf of a process with a large memory
+footprint.
+
+Starting a subprocess forks the calling process, which for a Python process
+holding many GB of arrays is slow and can fail when memory overcommit is strict.
+``start_forkserver()`` starts a small helper process that launches commands
+instead.  While it is running, ``run_shell()`` and its wrappers, ``iter_shell()``,
+``run_shell_result()`` and ``Spawn`` use it transparently.  Call it early, before
+the process has grown large::
+
+  >>> import ska_shell
+  >>> ska_shell.start_forkserver()
+  >>> ... load data ...
+  >>> ska_shell.bash("ls")  # started by the fork server
+
+Output pipes are created in the calling process and passed to the helper over a
+Unix socket, so output is read exactly as for a local subprocess.
+"""
+
+import atexit
+import io
+import json
+import locale
+import os
+import select
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+
+from .shell import ShellError
+
+__all__ = ["start_forkserver", "stop_forkserver"]
+
+_HELPER = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "_forkserver_helper.py"
+)
+_HEADER_SIZE = 8
+
+_server = None
+_server_lock = threading.Lock()
+
+
+class ForkServerProcess:
+    """Process started by the fork server, with the subset of the
+    ``subprocess.Popen`` interface used by ska_shell.
+
+    The exit status and resource usage are sent by the fork server when the
+    process exits.
+    """
+
+    def __init__(
+        self,
+        path,
+        args,
+        stdin=None,
+        stdout=None,
+        stderr=None,
+        shell=False,
+        env=None,
+        cwd=None,
+        universal_newlines=False,
+        start_new_session=False,
+    ):
+        self.args = args
+        self.stdin = None
+        self.stdout = None
+        self.stderr = None
+        self.returncode = None
+        self.rusage = None
+        self._buf = b""
+        self._lock = threading.Lock()
+
+        # File descriptors for the child and those to close after sending them
+        child_fds = []
+        close_fds = []
+        try:
+            if stdin == subprocess.PIPE:
+                raise ValueError("stdin=PIPE is not supported by the fork server")
+            child_fds.append(self._child_fd(stdin, "stdin", 0, close_fds))
+            stdout_fd = self._child_fd(stdout, "stdout", 1, close_fds)
+            child_fds.append(stdout_fd)
+            if stderr == subprocess.STDOUT:
+                child_fds.append(stdout_fd)
+            else:
+                child_fds.append(self._child_fd(stderr, "stderr", 2, close_fds))
+
+            request = json.dumps(
+                {
+                    "args": args,
+                    "env": dict(os.environ if env is None else env),
+                    "cwd": cwd or os.getcwd(),
+                    "shell": shell,
+                    "start_new_session": start_new_session,
+                }
+            ).encode()
+
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._sock.connect(path)
+            header = b"%*d" % (_HEADER_SIZE, len(request))
+            socket.send_fds(self._sock, [header], child_fds)
+            self._sock.sendall(request)
+        except BaseException:
+            self._close_pipes()
+            raise
+        finally:
+            for fd in close_fds:
+                os.close(fd)
+
+        try:
+            msg = self._recv()
+        except BaseException:
+            self._sock.close()
+            self._close_pipes()
+            raise
+        if "error" in msg:
+            self._sock.close()
+            self._close_pipes()
+            if msg["errno"] is None:
+                raise ShellError(f"fork server failed to start {args!r}: {msg['error']}")
+            raise OSError(msg["errno"], msg["error"], msg["filename"])
+        self.pid = msg["pid"]
+
+        if universal_newlines:
+            encoding = locale.getpreferredencoding(False)
+            for name in ("stdout", "stderr"):
+                stream = getattr(self, name)
+                if stream is not None:
+                    setattr(self, name, io.TextIOWrapper(stream, encoding))
+
+    def _child_fd(self, spec, name, default_fd, close_fds):
+        """Return the child fd for ``spec`` (PIPE, DEVNULL, None, fd or file) and
+        set ``self.<name>`` to the read end of a pipe for PIPE (output only)."""
+        if spec == subprocess.PIPE:
+            read_fd, write_fd = os.pipe()
+            setattr(self, name, open(read_fd, "rb"))
+            close_fds.append(write_fd)
+            return write_fd
+        if spec == subprocess.DEVNULL:
+            return _devnull(close_fds)
+        if spec is None:
+            return default_fd if _fd_ok(default_fd) else _devnull(close_fds)
+        if isinstance(spec, int):
+            return spec
+        return spec.fileno()
+
+    def _close_pipes(self):
+        for stream in (self.stdout, self.stderr):
+            if stream is not None:
+                stream.close()
+
+    def _recv(self, timeout=None):
+        """Return the next JSON message from the fork server"""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while b"\n" not in self._buf:
+            if deadline is not None:
+                remaining = max(deadline - time.monotonic(), 0)
+                if not select.select([self._sock], [], [], remaining)[0]:
+                    raise subprocess.TimeoutExpired(self.args, timeout)
+            data = self._sock.recv(65536)
+            if not data:
+                raise ShellError("fork server connection closed unexpectedly")
+            self._buf += data
+        line, _, self._buf = self._buf.partition(b"\n")
+        return json.loads(line)
+
+    def wait_rusage(self, timeout=None):
+        """Wait for the process to exit.
+
+        :param timeout: seconds to wait (raises ``subprocess.TimeoutExpired``)
+        :rtype: (returncode, rusage)
+        """
+        with self._lock:
+            if self.returncode is None:
+                msg = self._recv(timeout)
+                utime, stime, maxrss = msg["rusage"]
+                self.rusage = types.SimpleNamespace(
+                    ru_utime=utime, ru_stime=stime, ru_maxrss=maxrss
+                )
+                self.returncode = msg["returncode"]
+                self._sock.close()
+        return self.returncode, self.rusage
+
+    def wait(self, timeout=None):
+        """Wait for the process to exit and return its exit status"""
+        return self.wait_rusage(timeout)[0]
+
+    def poll(self):
+        """Return the exit status or None if the process is still running"""
+        try:
+            return self.wait(0)
+        except subprocess.TimeoutExpired:
+            return None
+
+    def send_signal(self, sig):
+        """Send signal ``sig`` to the process if it is still running"""
+        if self.poll() is None:
+            os.kill(self.pid, sig)
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+
+def _fd_ok(fd):
+    try:
+        os.fstat(fd)
+    except OSError:
+        return False
+    return True
+
+
+def _devnull(close_fds):
+    fd = os.open(os.devnull, os.O_RDWR)
+    close_fds.append(fd)
+    return fd
+
+
+class _ForkServer:
+    """Helper process and the Unix socket it listens on"""
+
+    def __init__(self):
+        self._dir = tempfile.mkdtemp(prefix="ska_shell_fs_")
+        self.path = os.path.join(self._dir, "sock")
+        # The helper exits when its stdin is closed, including when this process
+        # exits.
+        self.process = subprocess.Popen(
+            [sys.executable, "-I", _HELPER, self.path],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        if self.process.stdout.readline() != b"ready\n":
+            self.close()
+            raise ShellError("fork server failed to start")
+
+    def popen(self, args, **kwargs):
+        return ForkServerProcess(self.path, args, **kwargs)
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.stdout.close()
+        try:
+            self.process.wait(5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        shutil.rmtree(self._dir, ignore_errors=True)
+
+
+def start_forkserver():
+    """Start the fork server if it is not running.
+
+    While the fork server is running, commands run by ``run_shell()`` (and its
+    wrappers), ``iter_shell()``, ``run_shell_result()`` and ``Spawn`` are started
+    by a small helper process instead of being forked from this process.
+
+    :returns: process id of the fork server
+    """
+    global _server
+    with _server_lock:
+        if _server is None or _server.process.poll() is not None:
+            _server = _ForkServer()
+        return _server.process.pid
+
+
+def stop_forkserver():
+    """Stop the fork server if it is running.  Commands that it started continue to
+    run until they exit."""
+    global _server
+    with _server_lock:
+        if _server is not None:
+            _server.close()
+            _server = None
+
+
+def _get_server():
+    """Return the running fork server or None"""
+    server = _server
+    if server is not None and server.process.poll() is None:
+        return server
+    return None
+
+
+atexit.register(stop_forkserver)
@@ -0,0 +1,375 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Command metrics in the Prometheus text format.
+
+``MetricsCollector`` counts the commands run by ska_shell, with their latency,
+output size and outcome, using the trace hooks (see ``add_trace_hook()``).  The
+metrics can be written to a file for the node_exporter textfile collector, so no
+server is needed::
+
+  >>> from ska_shell.metrics import MetricsCollector, TextfileWriter
+  >>> collector = MetricsCollector().install()
+  >>> writer = TextfileWriter(
+  ...     collector.registry, "/var/lib/node_exporter/textfile/ska_shell.prom"
+  ... )
+  >>> ... run commands ...
+  >>> writer.close()
+
+Metrics are labeled with ``entry_point`` ("bash", "tcsh", ... for ``run_shell()``,
+its wrappers and ``run_shell_result()``, "getenv", "pipeline" or "Spawn"),
+``shell`` and, for the command count, ``outcome`` ("ok", "NonZeroReturnCode",
+"RunTimeoutError", "OSError" or "error"):
+
+- ``ska_shell_commands_total``: number of commands
+- ``ska_shell_command_duration_seconds``: histogram of command wall time
+- ``ska_shell_command_output_bytes_total``: output size
+- ``ska_shell_command_cache_hits_total``: results that came from a cache
+"""
+
+import bisect
+import os
+import tempfile
+import threading
+
+from .shell import NonZeroReturnCode, RunTimeoutError
+from .tracing import SpanCollector
+
+__all__ = [
+    "Counter",
+    "Histogram",
+    "MetricsRegistry",
+    "MetricsCollector",
+    "TextfileWriter",
+]
+
+DEFAULT_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    300.0,
+    900.0,
+    3600.0,
+)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    items = ",".join(f'{name}="{_escape(value)}"' for name, value in labels)
+    return "{" + items + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class _Metric:
+    """Base class of metrics with a fixed set of label names"""
+
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                f"{self.name} needs labels {self.labelnames}, got {tuple(labels)}"
+            )
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _header(self):
+        return [
+            f"# HELP {self.name} {_escape(self.help)}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+
+    def clear(self):
+        """Remove all values"""
+        with self._lock:
+            self._values.clear()
+
+
+class Counter(_Metric):
+    """
+    Counter with labels.
+
+    :param name: metric name
+    :param help: description
+    :param labelnames: names of the labels
+    """
+
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        """Add ``amount`` to the counter for ``labels``"""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        """Return the value for ``labels`` (0 if never incremented)"""
+        return self._values.get(self._key(labels), 0)
+
+    def render(self):
+        """Return the metric in the Prometheus text format as a list of lines"""
+        lines = self._header()
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            labels = _format_labels(zip(self.labelnames, key))
+            lines.append(f"{self.name}{labels} {_format_value(value)}")
+        return lines
+
+
+class Histogram(_Metric):
+    """
+    Histogram with labels.
+
+    :param name: metric name
+    :param help: description
+    :param labelnames: names of the labels
+    :param buckets: upper bounds of the buckets (default: 5 ms to 1 hour)
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        """Add ``value`` to the histogram for ``labels``"""
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    def get(self, **labels):
+        """Return (count, sum) for ``labels``"""
+        counts, total = self._values.get(self._key(labels), ([0], 0.0))
+        return sum(counts), total
+
+    def render(self):
+        """Return the metric in the Prometheus text format as a list of lines"""
+        lines = self._header()
+        with self._lock:
+            items = sorted((key, (list(c), t)) for key, (c, t) in self._values.items())
+        for key, (counts, total) in items:
+            labels = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = _format_labels(labels + [("le", _format_value(float(bound)))])
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            labels = _format_labels(labels)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Set of metrics that are rendered together.
+
+    Example::
+
+      >>> registry = MetricsRegistry()
+      >>> jobs = registry.counter("jobs_total", "Jobs run", ["status"])
+      >>> jobs.inc(status="ok")
+      >>> print(registry.render())
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _add(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        """Create and register a ``Counter``
+
+        :rtype: Counter
+        """
+        return self._add(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        """Create and register a ``Histogram``
+
+        :rtype: Histogram
+        """
+        return self._add(Histogram(name, help, labelnames, buckets))
+
+    def __getitem__(self, name):
+        return self._metrics[name]
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format
+
+        :rtype: str
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path):
+        """Write the metrics to ``path`` for the node_exporter textfile collector.
+
+        The file is written to a temporary file that is renamed into place, so
+        node_exporter never reads a partial file.
+
+        :param path: output file name, which must end in ``.prom`` for
+            node_exporter
+        """
+        dirname = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(
+            dir=dirname, prefix=".ska_shell_", suffix=".tmp"
+        )
+        try:
+            with os.fdopen(fd, "w") as fh:
+                fh.write(self.render())
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
+def _outcome(span):
+    error = span.error
+    if error is None:
+        return "ok" if not span.returncode else "NonZeroReturnCode"
+    for cls in (NonZeroReturnCode, RunTimeoutError, OSError):
+        if isinstance(error, cls):
+            return cls.__name__
+    return "error"
+
+
+_ENTRY_POINTS = {"getenv": "getenv", "pipeline": "pipeline", "Spawn.run": "Spawn"}
+
+
+class MetricsCollector(SpanCollector):
+    """
+    Count commands run by ska_shell in a ``MetricsRegistry``.
+
+    ``install()`` (or use as a context manager) starts counting.  Only the
+    outermost call is counted, so a ``getenv()`` is not also counted as the
+    ``run_shell()`` that it calls.
+
+    :param registry: ``MetricsRegistry`` to which the metrics are added (default:
+        new registry)
+    :param buckets: histogram buckets for command duration in seconds
+    """
+
+    def __init__(self, registry=None, buckets=DEFAULT_BUCKETS):
+        self.registry = registry if registry is not None else MetricsRegistry()
+        self.commands = self.registry.counter(
+            "ska_shell_commands_total",
+            "Number of commands run by ska_shell",
+            ["entry_point", "shell", "outcome"],
+        )
+        self.duration = self.registry.histogram(
+            "ska_shell_command_duration_seconds",
+            "Wall time of commands run by ska_shell",
+            ["entry_point", "shell"],
+            buckets,
+        )
+        self.output_bytes = self.registry.counter(
+            "ska_shell_command_output_bytes_total",
+            "Output of commands run by ska_shell",
+            ["entry_point", "shell"],
+        )
+        self.cache_hits = self.registry.counter(
+            "ska_shell_command_cache_hits_total",
+            "Command results that came from a cache",
+            ["entry_point", "shell"],
+        )
+
+    def collect(self, span):
+        if span.parent is not None:
+            return
+        shell = span.shell or "none"
+        entry_point = _ENTRY_POINTS.get(span.kind, shell)
+        self.commands.inc(entry_point=entry_point, shell=shell, outcome=_outcome(span))
+        self.duration.observe(span.duration, entry_point=entry_point, shell=shell)
+        self.output_bytes.inc(span.nbytes, entry_point=entry_point, shell=shell)
+        if span.cached:
+            self.cache_hits.inc(entry_point=entry_point, shell=shell)
+
+
+class TextfileWriter:
+    """
+    Write a ``MetricsRegistry`` to a textfile every ``interval`` seconds from a
+    background thread, for long-running processes.
+
+    The file is also written by ``close()``, or at the end of a ``with`` block.
+
+    :param registry: ``MetricsRegistry`` to write
+    :param path: output file name ending in ``.prom``
+    :param interval: seconds between writes (default: 15)
+    """
+
+    def __init__(self, registry, path, interval=15.0):
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self.error = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="ska_shell-TextfileWriter", daemon=True
+        )
+        self._thread.start()
+
+    def _write(self):
+        try:
+            self.registry.write_textfile(self.path)
+        except Exception as err:
+            self.error = err
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._write()
+
+    def close(self):
+        """Stop the thread and write the file"""
+        self._stop.set()
+        self._thread.join()
+        self._write()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
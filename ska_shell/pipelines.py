@@ -0,0 +1,380 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Pipelines of commands connected directly with OS pipes, without a shell.
+
+``pipeline()`` is the equivalent of ``cmd1 | cmd2 | cmd3`` with ``set -o
+pipefail``.  Each command is started from an argument list, so there is no shell
+quoting, and data flows from one command to the next through a kernel pipe
+without passing through Python.  Python callables can be added as filter stages,
+and every stage reports its own exit status and stderr::
+
+  >>> from ska_shell import pipeline
+  >>> result = pipeline(["zcat", "events.gz"], ["grep", "ERROR"], ["sort", "-u"])
+  >>> result.lines
+  >>> result.returncodes
+  [0, 0, 0]
+"""
+
+import os
+import signal
+import subprocess
+import threading
+import time
+
+from .shell import (
+    NonZeroReturnCode,
+    ShellTimeoutError,
+    _get_log_level,
+    _hooks,
+    _iter_line_batches,
+    _iter_multi_line_batches,
+    _kill_process_group,
+    _log_cmdstr,
+    _log_lines,
+    _make_environ,
+    _popen,
+    _span_update,
+    _traced,
+    _wait,
+)
+
+__all__ = ["pipeline", "tee", "PipelineResult", "StageResult"]
+
+
+class StageResult:
+    """
+    Result of one stage of a pipeline.
+
+    Attributes:
+     - stage: argument list of the command or the Python callable
+     - returncode: exit status.  A stage killed by a signal has the negative signal
+       number, e.g. ``-signal.SIGPIPE`` when a later stage exits before reading all
+       of its output.  A Python stage has 0, or 1 if it raised an exception.
+     - stderr: list of stderr lines of a command (empty if stderr is not captured)
+     - error: exception raised by a Python stage (else None)
+    """
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.returncode = None
+        self.stderr = []
+        self.error = None
+
+    def __repr__(self):
+        return f"<StageResult {_stage_name(self.stage)!r} returncode={self.returncode}>"
+
+    @property
+    def ok(self):
+        """True if the exit status is zero"""
+        return self.returncode == 0
+
+
+class PipelineResult:
+    """
+    Result of ``pipeline()``.
+
+    Attributes:
+     - lines: output lines of the last stage (empty if ``stdout`` was given)
+     - stages: list of ``StageResult``, one per stage
+     - duration: wall time in seconds from start to exit of all stages
+    """
+
+    def __init__(self, stages, lines, duration):
+        self.stages = stages
+        self.lines = lines
+        self.duration = duration
+
+    def __repr__(self):
+        return (
+            f"<PipelineResult returncodes={self.returncodes} "
+            f"duration={self.duration:.3f}s>"
+        )
+
+    @property
+    def returncodes(self):
+        """Exit status of each stage, like bash ``PIPESTATUS``"""
+        return [stage.returncode for stage in self.stages]
+
+    @property
+    def returncode(self):
+        """Exit status of the last stage that failed, or 0 (like ``set -o
+        pipefail``)"""
+        failed = self.failed
+        return failed.returncode if failed is not None else 0
+
+    @property
+    def failed(self):
+        """``StageResult`` of the last stage that failed, or None"""
+        for stage in reversed(self.stages):
+            if stage.returncode:
+                return stage
+        return None
+
+    @property
+    def ok(self):
+        """True if all stages succeeded"""
+        return self.failed is None
+
+
+def tee(*files):
+    """Return a pipeline stage that writes each line to ``files`` and passes it on.
+
+    :param files: file-like objects opened for writing text
+    :rtype: callable pipeline stage
+    """
+
+    def _tee(lines):
+        for line in lines:
+            for fh in files:
+                fh.write(line)
+            yield line
+
+    return _tee
+
+
+def _stage_name(stage):
+    if callable(stage):
+        return getattr(stage, "__name__", repr(stage))
+    import shlex
+
+    return shlex.join(stage)
+
+
+def _run_filter(func, in_fd, out_fd, result):
+    """Run Python stage ``func`` in a thread, reading lines from ``in_fd`` (or
+    nothing if None) and writing the lines it returns to ``out_fd``."""
+    out = open(out_fd, "w", encoding="utf-8", newline="")
+    instream = open(in_fd, "rb", buffering=0) if in_fd is not None else None
+
+    def iter_input():
+        if instream is None:
+            return
+        for batch in _iter_line_batches(instream, keepends=True):
+            yield from batch
+            # Pass on what this chunk produced before waiting for the next one
+            out.flush()
+
+    result.returncode = 0
+    try:
+        for line in func(iter_input()):
+            out.write(line)
+        out.flush()
+    except BrokenPipeError:
+        # The next stage exited.  Report it the same way as for a command.
+        result.returncode = -signal.SIGPIPE
+    except Exception as err:
+        result.error = err
+        result.returncode = 1
+    finally:
+        try:
+            out.close()
+        except BrokenPipeError:
+            pass
+        if instream is not None:
+            # Closing the input gives the previous stage SIGPIPE if it is still
+            # writing
+            instream.close()
+
+
+@_traced("pipeline", 0, None)
+def pipeline(
+    *stages,
+    input=None,
+    stdout=None,
+    capture_stderr=True,
+    env=None,
+    cwd=None,
+    logfile=None,
+    logger=None,
+    log_level=None,
+    check=None,
+    timeout=None,
+    kill_grace=5.0,
+):
+    """
+    Run ``stages`` connected by pipes and return a ``PipelineResult``.
+
+    Each stage is either a command, given as a list of arguments that is run
+    without a shell, or a Python callable.  The stdout of each stage is connected
+    to the stdin of the next one with an OS pipe, so the output of one command goes
+    directly to the next without being read by Python.
+
+    A callable stage is called with an iterator over the input lines (str with the
+    newline) and must return an iterable of output lines (with newlines), e.g. a
+    generator function.  It runs in a thread.  ``tee(fh)`` makes a stage that
+    copies the data passing through it to ``fh``.
+
+    The pipeline fails like ``set -o pipefail``: its ``returncode`` is that of the
+    last stage that failed.  With ``check`` (default) a failure raises
+    ``NonZeroReturnCode`` naming the failed stage, with the pipeline output in
+    ``lines`` and the ``PipelineResult`` in ``result``.
+
+    Example::
+
+      >>> from ska_shell import pipeline, tee
+      >>> with open("selected.txt", "w") as fh:
+      ...     result = pipeline(
+      ...         ["cat", "big.log"],
+      ...         ["grep", "-v", "DEBUG"],
+      ...         tee(fh),
+      ...         ["wc", "-l"],
+      ...     )
+      >>> result.lines
+      ['1234']
+
+    :param stages: commands (lists of arguments) and callables
+    :param input: str or iterable of lines (with newlines) written to the stdin of
+        the first stage (default: stdin of this process)
+    :param stdout: file object to which the last stage writes its output instead of
+        returning it in ``lines``
+    :param capture_stderr: keep the stderr of each command in its ``StageResult``
+        (default: True).  Otherwise stderr goes to the stderr of this process.
+    :param env: set environment using ``env`` dict for the commands
+    :param cwd: working directory for the commands
+    :param logfile: append output to the suppplied file object
+    :param logger: log output to the supplied logging.Logger
+    :param log_level: log level for logger
+    :param check: raise an exception if any stage fails (default: True)
+    :param timeout: kill all commands and raise ``ShellTimeoutError`` if the
+        pipeline runs for more than ``timeout`` seconds (default: no limit)
+    :param kill_grace: seconds between SIGTERM and SIGKILL on timeout
+
+    :rtype: PipelineResult
+    """
+    check = check if check is not None else True
+    log_level = _get_log_level(log_level)
+    if not stages:
+        raise ValueError("pipeline needs at least one stage")
+    stages = [stage if callable(stage) else list(stage) for stage in stages]
+    if _hooks:
+        _span_update(cmd=" | ".join(_stage_name(stage) for stage in stages))
+    if input is not None:
+        data = [input] if isinstance(input, str) else input
+        stages.insert(0, lambda lines: data)
+    results = [StageResult(stage) for stage in stages]
+    # The stage that writes ``input`` is not reported
+    visible = results[1:] if input is not None else results
+
+    environ = _make_environ(env)
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    procs = []  # (process, StageResult)
+    threads = []
+    err_streams = []  # (stream, StageResult)
+    out_read = None
+    lines = []
+    # File descriptors owned by this function that are not yet handed over
+    fds = {"in": None, "next": None, "out": None, "err_read": None, "err_write": None}
+
+    def close_fds(*names):
+        for name in names:
+            if fds[name] is not None:
+                os.close(fds[name])
+                fds[name] = None
+
+    t0 = time.monotonic()
+    try:
+        for index, (stage, result) in enumerate(zip(stages, results)):
+            if index == len(stages) - 1 and stdout is not None:
+                fds["out"] = os.dup(stdout.fileno())
+            else:
+                fds["next"], fds["out"] = os.pipe()
+
+            if callable(stage):
+                thread = threading.Thread(
+                    target=_run_filter,
+                    args=(stage, fds["in"], fds["out"], result),
+                    name=f"ska_shell-pipeline-{_stage_name(stage)}",
+                    daemon=True,
+                )
+                # The thread owns its input and output from here on
+                fds["in"] = fds["out"] = None
+                thread.start()
+                threads.append(thread)
+            else:
+                if capture_stderr:
+                    fds["err_read"], fds["err_write"] = os.pipe()
+                proc = _popen(
+                    stage,
+                    stdin=fds["in"],
+                    stdout=fds["out"],
+                    stderr=fds["err_write"],
+                    env=environ,
+                    cwd=cwd,
+                    start_new_session=timeout is not None,
+                )
+                procs.append((proc, result))
+                if _hooks:
+                    _span_update(pid=proc.pid)
+                close_fds("in", "out", "err_write")
+                if capture_stderr:
+                    err_streams.append((open(fds["err_read"], "rb", buffering=0), result))
+                    fds["err_read"] = None
+            fds["in"], fds["next"] = fds["next"], None
+        if fds["in"] is not None:
+            out_read = open(fds["in"], "rb", buffering=0)
+            fds["in"] = None
+
+        streams = ([out_read] if out_read is not None else []) + [
+            stream for stream, _ in err_streams
+        ]
+        # Output of the last stage and stderr of all commands are read together
+        # so no stage can block on a full pipe.
+        offset = 0 if out_read is not None else 1
+        log = logfile or logger is not None
+        _log_cmdstr(logfile, "pipeline", " | ".join(_stage_name(s) for s in stages))
+        try:
+            for index, batch in _iter_multi_line_batches(streams, deadline=deadline):
+                index += offset
+                if index == 0:
+                    if log:
+                        _log_lines(batch, logfile, logger, log_level)
+                    lines.extend(batch)
+                else:
+                    err_streams[index - 1][1].stderr.extend(batch)
+            for proc, result in procs:
+                remaining = (
+                    max(deadline - time.monotonic(), 0) if deadline is not None else None
+                )
+                result.returncode = _wait(proc, timeout=remaining)
+        except (TimeoutError, subprocess.TimeoutExpired):
+            for proc, _ in procs:
+                _kill_process_group(proc, kill_grace)
+            raise ShellTimeoutError(
+                f"Pipeline timed out after {timeout:g} secs", lines
+            ) from None
+        finally:
+            _log_cmdstr(logfile, "pipeline")
+    finally:
+        close_fds(*fds)
+        for stream in [out_read] + [stream for stream, _ in err_streams]:
+            if stream is not None:
+                stream.close()
+        for proc, result in procs:
+            if proc.returncode is None:
+                _kill_process_group(proc, kill_grace)
+                result.returncode = proc.returncode
+        for thread in threads:
+            thread.join()
+
+    pipeline_result = PipelineResult(visible, lines, time.monotonic() - t0)
+    if _hooks:
+        _span_update(
+            returncode=pipeline_result.returncode,
+            nbytes=sum(map(len, lines)) + len(lines),
+        )
+    failed = pipeline_result.failed
+    if check and failed is not None:
+        index = visible.index(failed) + 1
+        if failed.error is not None:
+            detail = f"{type(failed.error).__name__}: {failed.error}"
+        else:
+            detail = " ".join(failed.stderr[-1:])
+        exc = NonZeroReturnCode(
+            f"Pipeline stage {index} ({_stage_name(failed.stage)}) failed with "
+            f"return_code={failed.returncode}: {detail}",
+            return_code=failed.returncode,
+        )
+        exc.lines = lines
+        exc.result = pipeline_result
+        raise exc
+    return pipeline_result
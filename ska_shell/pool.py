@@ -0,0 +1,183 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""Pool of warm shell sessions shared by worker threads"""
+
+import contextlib
+import threading
+import time
+
+from .session import ShellSession
+from .shell import NonZeroReturnCode, ShellError
+
+
+class ShellPool:
+    """
+    Pool of ``ShellSession`` objects that have each already run the same ``init``
+    commands, typically sourcing an expensive setup script.
+
+    Worker threads check out a session, run commands and return it to the pool.
+    Each command runs in a subshell of the session shell (see ``ShellSession``),
+    so one user of a session cannot change the state seen by the next user.  A
+    session is discarded and replaced with a new one when it:
+
+    - fails the health check (``ShellSession.ping()``) on checkout,
+    - has run ``max_commands`` commands,
+    - was checked back in after an exception other than ``NonZeroReturnCode``
+      (e.g. an interrupt while reading its output).
+
+    Example::
+
+      >>> from ska_shell import ShellPool
+      >>> pool = ShellPool(4, init=". /soft/ciao/bin/ciao.sh")
+      >>> with pool.session() as session:
+      ...     outlines, _ = session.run("dmlist evt2.fits blocks")
+      >>> outlines = pool.run("dmkeypar evt2.fits OBS_ID echo+")[0]
+      >>> pool.close()
+
+    :param size: maximum number of sessions in the pool
+    :param shell: shell for commands -- 'bash' (default), 'zsh', 'tcsh' or 'csh'
+    :param init: command string run in each session shell at startup
+    :param env: set environment using ``env`` dict when starting each shell
+    :param max_commands: replace a session after it has run this many commands
+        (default: no limit)
+    :param prestart: start all ``size`` sessions now instead of on demand
+    """
+
+    def __init__(
+        self, size=4, shell="bash", init=None, env=None, max_commands=None, prestart=True
+    ):
+        if size < 1:
+            raise ValueError("size must be at least 1")
+        self.size = size
+        self.shell = shell
+        self.init = init
+        self.env = env
+        self.max_commands = max_commands
+        # Idle sessions (most recently used last) and the number of sessions,
+        # including those being started.  Waiters in checkout() are notified
+        # whenever a session is returned or a slot is freed.
+        self._idle = []
+        self._cond = threading.Condition()
+        self._nsessions = 0
+        self._closed = False
+
+        if prestart:
+            for _ in range(size):
+                self._nsessions += 1
+                self._idle.append(self._new_session())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _new_session(self):
+        try:
+            return ShellSession(self.shell, env=self.env, init=self.init)
+        except BaseException:
+            with self._cond:
+                self._nsessions -= 1
+                self._cond.notify()
+            raise
+
+    def _discard(self, session):
+        session.close()
+        with self._cond:
+            self._nsessions -= 1
+            self._cond.notify()
+
+    def checkout(self, timeout=None):
+        """Get a healthy session from the pool, starting one if needed.
+
+        The session must be returned with ``checkin()``.  The ``session()`` context
+        manager does both.
+
+        :param timeout: seconds to wait for a free session (default: wait forever)
+        :rtype: ShellSession
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise ShellError("ShellPool is closed")
+                    if self._idle:
+                        session = self._idle.pop()
+                        break
+                    if self._nsessions < self.size:
+                        self._nsessions += 1
+                        session = None
+                        break
+                    remaining = (
+                        deadline - time.monotonic() if deadline is not None else None
+                    )
+                    if remaining is not None and remaining <= 0:
+                        raise ShellError(
+                            f"no free {self.shell} session after {timeout} secs"
+                        )
+                    self._cond.wait(remaining)
+
+            if session is None:
+                return self._new_session()
+            if session.ping():
+                return session
+            self._discard(session)
+
+    def checkin(self, session, healthy=True):
+        """Return ``session`` to the pool.
+
+        :param session: session from ``checkout()``
+        :param healthy: False if the session may be in a bad state and must be
+            replaced
+        """
+        if (
+            not healthy
+            or self._closed
+            or not session.alive
+            or (self.max_commands is not None and session.ncommands >= self.max_commands)
+        ):
+            self._discard(session)
+        else:
+            with self._cond:
+                self._idle.append(session)
+                self._cond.notify()
+
+    @contextlib.contextmanager
+    def session(self, timeout=None):
+        """Context manager that checks out a session and returns it to the pool.
+
+        :param timeout: seconds to wait for a free session (default: wait forever)
+        """
+        session = self.checkout(timeout)
+        healthy = False
+        try:
+            yield session
+            healthy = True
+        except NonZeroReturnCode:
+            healthy = True
+            raise
+        finally:
+            self.checkin(session, healthy=healthy)
+
+    def run(self, cmdstr, timeout=None, **kwargs):
+        """Run ``cmdstr`` in a session from the pool.  See ``ShellSession.run`` for
+        options.
+
+        :param cmdstr: command string
+        :param timeout: seconds to wait for a free session (default: wait forever)
+
+        :rtype: (outlines, deltaenv)
+        """
+        with self.session(timeout) as session:
+            return session.run(cmdstr, **kwargs)
+
+    def close(self):
+        """Stop all idle sessions.  Sessions that are checked out are stopped when
+        they are returned, and threads waiting in ``checkout()`` get a
+        ``ShellError``."""
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._cond.notify_all()
+        for session in idle:
+            self._discard(session)
@@ -0,0 +1,247 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""Run a shell command and return the raw output in a ``ShellResult``"""
+
+import functools
+import subprocess
+import time
+
+from .shell import (
+    _check_shell,
+    _EnvFile,
+    _finish_shell,
+    _get_log_level,
+    _hooks,
+    _iter_chunks,
+    _join_cmdstr,
+    _kill_process_group,
+    _LineSplitter,
+    _log_cmdstr,
+    _log_lines,
+    _make_environ,
+    _popen,
+    _raise_nonzero,
+    _shell_args,
+    _span_update,
+    _timeout_error,
+    _traced,
+    _wait,
+)
+
+
+def _split_lines(text):
+    """Split ``text`` into lines the same way as ``run_shell()`` output"""
+    lines = text.split("\n")
+    if lines[-1] == "":
+        lines.pop()
+    return lines
+
+
+class ShellResult:
+    """
+    Result of a shell command from ``run_shell_result()``.
+
+    The output is kept as one ``bytes`` object and is only decoded when ``text`` or
+    ``lines`` is first used, so checking ``returncode`` or ``last_line`` of a command
+    with a lot of output is cheap.
+
+    Attributes:
+     - cmdstr: command string
+     - returncode: shell exit status
+     - duration: wall time in seconds from start to exit
+     - deltaenv: environment changes if ``getenv=True`` (else empty dict)
+
+    :param data: raw output bytes
+    :param cmdstr: command string
+    :param returncode: shell exit status
+    :param duration: wall time in seconds
+    :param deltaenv: dict of environment changes
+    """
+
+    def __init__(self, data, cmdstr, returncode, duration, deltaenv=None):
+        self._data = data
+        self.cmdstr = cmdstr
+        self.returncode = returncode
+        self.duration = duration
+        self.deltaenv = deltaenv if deltaenv is not None else {}
+
+    def __repr__(self):
+        return (
+            f"<ShellResult returncode={self.returncode} nbytes={len(self._data)} "
+            f"duration={self.duration:.3f}s cmdstr={self.cmdstr!r}>"
+        )
+
+    @property
+    def ok(self):
+        """True if the exit status is zero"""
+        return self.returncode == 0
+
+    @property
+    def view(self):
+        """Read-only ``memoryview`` of the output bytes (no copy)"""
+        return memoryview(self._data)
+
+    @property
+    def raw(self):
+        """Output as ``bytes``"""
+        return self._data
+
+    @functools.cached_property
+    def text(self):
+        """Output decoded as UTF-8"""
+        return str(self.view, "utf-8")
+
+    @functools.cached_property
+    def lines(self):
+        """List of output lines without newlines, the same as ``run_shell()``"""
+        return _split_lines(self.text)
+
+    @property
+    def last_line(self):
+        """Last output line, decoded without decoding the rest of the output ("" if
+        there is no output)"""
+        end = len(self._data)
+        if end and self._data[end - 1 : end] == b"\n":
+            end -= 1
+        start = self._data.rfind(b"\n", 0, end) + 1
+        return str(self.view[start:end], "utf-8")
+
+
+def _communicate_raw(
+    process,
+    logfile=None,
+    logger=None,
+    log_level=None,
+    timeout=None,
+    idle_timeout=None,
+    usage=None,
+):
+    """Read all output of ``process`` as bytes.  This is like ``communicate()``
+    except that output is only decoded into lines for ``logfile`` and ``logger``.
+
+    :rtype: bytes
+    """
+    log_level = _get_log_level(log_level)
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    splitter = _LineSplitter() if logfile or logger is not None else None
+
+    chunks = []
+    try:
+        for data in _iter_chunks(process.stdout, deadline, idle_timeout):
+            chunks.append(data)
+            if splitter is not None:
+                _log_lines(splitter.feed(data), logfile, logger, log_level)
+        if splitter is not None:
+            _log_lines(splitter.close(), logfile, logger, log_level)
+        if deadline is not None:
+            _wait(process, usage, max(deadline - time.monotonic(), 0))
+    except (TimeoutError, subprocess.TimeoutExpired) as err:
+        _kill_process_group(process, usage=usage)
+        lines = _split_lines(b"".join(chunks).decode("utf-8", errors="replace"))
+        raise _timeout_error(process, err, timeout, idle_timeout, lines) from None
+
+    _wait(process, usage)
+    return b"".join(chunks)
+
+
+@_traced("run_shell_result", 0, "cmdstr")
+def run_shell_result(
+    cmdstr,
+    shell="bash",
+    logfile=None,
+    importenv=False,
+    getenv=False,
+    env=None,
+    logger=None,
+    log_level=None,
+    check=None,
+    timeout=None,
+    idle_timeout=None,
+    usage=None,
+):
+    """
+    Run the command string ``cmdstr`` in a ``shell`` and return a ``ShellResult``.
+
+    This is the same as ``run_shell()`` except for the return value.  The output is
+    kept as raw bytes that are only decoded when needed.
+
+    Example::
+
+      >>> from ska_shell import run_shell_result
+      >>> result = run_shell_result("make all", check=False)
+      >>> if not result.ok:
+      ...     print(result.last_line)
+
+    :param cmdstr: command string
+    :param shell: shell for command -- 'bash' (default) or 'tcsh'
+    :param logfile: append output to the suppplied file object
+    :param importenv: import any environent changes back to python env
+    :param getenv: get the environent changes after running ``cmdstr``
+    :param env: set environment using ``env`` dict prior to running commands
+    :param logger: log output to the supplied logging.Logger
+    :param log_level: log level for logger
+    :param check: raise an exception if any command fails
+    :param timeout: maximum run time in seconds (default: no limit)
+    :param idle_timeout: maximum time in seconds without any output (default: no
+        limit)
+    :param usage: ``ResourceUsage`` filled in with the resources used by the shell
+
+    :rtype: ShellResult
+    """
+    check = check if check is not None else True
+    if _hooks:
+        _span_update(shell=shell)
+
+    environ = _make_environ(env)
+    _check_shell(shell)
+
+    with _EnvFile(importenv or getenv) as envfile:
+        joined = _join_cmdstr(cmdstr, envfile)
+        args = _shell_args(joined, shell, check)
+        if usage is not None:
+            usage._begin()
+        t0 = time.monotonic()
+        proc = _popen(
+            args,
+            env=environ,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            start_new_session=timeout is not None or idle_timeout is not None,
+        )
+        if _hooks:
+            _span_update(pid=proc.pid)
+
+        _log_cmdstr(logfile, shell, joined)
+        try:
+            data = _communicate_raw(
+                proc,
+                logfile=logfile,
+                logger=logger,
+                log_level=log_level,
+                timeout=timeout,
+                idle_timeout=idle_timeout,
+                usage=usage,
+            )
+        finally:
+            _log_cmdstr(logfile, shell)
+            if _hooks:
+                _span_update(returncode=proc.returncode)
+        if _hooks:
+            _span_update(nbytes=len(data))
+        newenv = envfile.read()
+
+    result = ShellResult(data, cmdstr, proc.returncode, time.monotonic() - t0)
+    if check and result.returncode:
+        _raise_nonzero(result.returncode, result.lines, joined)
+
+    _, result.deltaenv = _finish_shell(
+        result.returncode,
+        [],
+        joined,
+        args[0],
+        False,
+        importenv,
+        getenv,
+        newenv,
+        env=env,
+    )
+    return result
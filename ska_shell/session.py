@@ -0,0 +1,281 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""Persistent shell sessions that run many commands in one shell process"""
+
+import os
+import re
+import shlex
+import subprocess
+import threading
+import uuid
+
+from .shell import (
+    ShellError,
+    _check_shell,
+    _EnvFile,
+    _finish_shell,
+    _get_log_level,
+    _join_cmdstr,
+    _log_cmdstr,
+    _log_line,
+    _make_environ,
+    _raise_nonzero,
+)
+
+# Arguments that start each shell without reading any startup files
+_SHELL_ARGS = {
+    "bash": ["--noprofile", "--norc"],
+    "zsh": ["-f"],
+    "tcsh": ["-f"],
+    "csh": ["-f"],
+}
+
+_RE_ENV_NAME = re.compile(r"[A-Za-z_][A-Za-z0-9_]*$")
+
+
+class ShellSession:
+    """
+    Long-lived shell process that runs a sequence of commands without starting a
+    new shell for each one.
+
+    Each call to ``run()`` sends the command to the shell over stdin, where it is
+    executed in a subshell (``( ... )``).  The end of the output and the exit status
+    are found from a unique marker line that the shell prints after the subshell
+    finishes.  Running in a subshell means that one command cannot change the
+    environment, working directory or shell options seen by the next one, so
+    ``run()`` has the same semantics as ``run_shell()``.  Only the ``init`` commands
+    run directly in the session shell, so any environment they set up is shared by
+    all subsequent commands.
+
+    The environment and working directory of the Python process at the time of each
+    ``run()`` are passed to the subshell, so ``importenv`` and ``os.chdir`` behave as
+    for ``run_shell()``.
+
+    For tcsh and csh the ``-e`` option cannot be applied to a subshell, so with
+    ``check=True`` a failure is detected only from the final status of the command
+    chain (each line of ``cmdstr`` is still joined with ``&&``).
+
+    Example::
+
+      >>> from ska_shell import ShellSession
+      >>> with ShellSession("bash") as session:
+      ...     for name in names:
+      ...         outlines, _ = session.run(f"ls -l {name}")
+
+    :param shell: shell for commands -- 'bash' (default), 'zsh', 'tcsh' or 'csh'
+    :param env: set environment using ``env`` dict when starting the shell
+    :param init: command string run in the session shell itself at startup (e.g.
+        sourcing a setup script)
+    :param logfile: append output of ``init`` to the supplied file object
+    :param logger: log output of ``init`` to the supplied logging.Logger
+    :param log_level: log level for logger
+    """
+
+    def __init__(
+        self, shell="bash", env=None, init=None, logfile=None, logger=None, log_level=None
+    ):
+        if shell not in _SHELL_ARGS:
+            raise ValueError(f"shell must be one of {sorted(_SHELL_ARGS)}")
+        _check_shell(shell)
+
+        self.shell = shell
+        self.ncommands = 0
+        self._lock = threading.Lock()
+        self._marker = f"__SKA_SHELL_{uuid.uuid4().hex}__"
+        self._start_environ = _make_environ(env)
+        self._start_cwd = os.getcwd()
+        self._proc = subprocess.Popen(
+            [shell] + _SHELL_ARGS[shell],
+            env=self._start_environ,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+
+        if init is not None:
+            init = _join_cmdstr(init)
+            status_var = "$?" if self._is_sh else "$status"
+            _log_cmdstr(logfile, shell, init)
+            returncode, outlines = self._send(
+                f"{init}\necho {self._marker} {status_var}\n",
+                logfile=logfile,
+                logger=logger,
+                log_level=log_level,
+            )
+            _log_cmdstr(logfile, shell)
+            if returncode:
+                self.close()
+                _raise_nonzero(returncode, outlines, init)
+
+    @property
+    def _is_sh(self):
+        return self.shell in ("bash", "zsh")
+
+    @property
+    def alive(self):
+        """True if the session shell is still running"""
+        return self._proc.poll() is None
+
+    @property
+    def pid(self):
+        """Process id of the session shell"""
+        return self._proc.pid
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self, timeout=5):
+        """Stop the session shell.
+
+        :param timeout: seconds to wait for the shell to exit before killing it
+        """
+        if self._proc.poll() is None:
+            try:
+                self._proc.stdin.write(b"exit\n")
+                self._proc.stdin.close()
+            except OSError:
+                pass
+            try:
+                self._proc.wait(timeout)
+            except subprocess.TimeoutExpired:
+                self._proc.kill()
+                self._proc.wait()
+        for fh in (self._proc.stdin, self._proc.stdout):
+            if not fh.closed:
+                fh.close()
+
+    def ping(self):
+        """Check that the session shell is running and responding to commands.
+
+        :rtype: bool
+        """
+        with self._lock:
+            try:
+                returncode, _ = self._send(f"echo {self._marker} 0\n")
+            except ShellError:
+                return False
+        return returncode == 0
+
+    def _env_commands(self, env):
+        """Commands that set the subshell environment to ``os.environ`` updated by
+        ``env``, given the environment the session shell was started with."""
+        environ = _make_environ(env)
+        start = self._start_environ
+        cmds = []
+        for key, val in environ.items():
+            if start.get(key) != val and _RE_ENV_NAME.match(key):
+                if self._is_sh:
+                    cmds.append(f"export {key}={shlex.quote(val)}")
+                else:
+                    cmds.append(f"setenv {key} {shlex.quote(val)}")
+        for key in start.keys() - environ.keys():
+            if _RE_ENV_NAME.match(key):
+                cmds.append(f"unset {key}" if self._is_sh else f"unsetenv {key}")
+        return cmds
+
+    def _send(self, script, logfile=None, logger=None, log_level=None):
+        """Send ``script`` to the shell and read output up to the marker line.
+
+        :rtype: (returncode, outlines)
+        """
+        if not self.alive:
+            raise ShellError(f"{self.shell} session (pid={self.pid}) is not running")
+        try:
+            self._proc.stdin.write(script.encode())
+            self._proc.stdin.flush()
+        except OSError as err:
+            raise ShellError(f"{self.shell} session (pid={self.pid}) failed: {err}")
+
+        log_level = _get_log_level(log_level)
+        lines = []
+        try:
+            while True:
+                line = self._proc.stdout.readline()
+                if not line:
+                    raise ShellError(
+                        f"{self.shell} session (pid={self.pid}) exited unexpectedly"
+                    )
+                line = line.decode()
+                if self._marker in line:
+                    # Output that did not end with a newline precedes the marker
+                    line, _, status = line.partition(self._marker)
+                    if line:
+                        _log_line(line, logfile, logger, log_level)
+                        lines.append(line)
+                    return int(status.split()[0]), lines
+                line = line[:-1]
+                _log_line(line, logfile, logger, log_level)
+                lines.append(line)
+        except BaseException:
+            # The rest of the output and the marker are still in the pipe, so the
+            # next command would read them.  Stop the shell so it is not reused.
+            self._proc.kill()
+            self._proc.wait()
+            raise
+
+    def run(
+        self,
+        cmdstr,
+        logfile=None,
+        importenv=False,
+        getenv=False,
+        env=None,
+        logger=None,
+        log_level=None,
+        check=None,
+    ):
+        """Run the command string ``cmdstr`` in the session.  See ``run_shell`` for
+        options.
+
+        :param cmdstr: command string
+        :param logfile: append output to the suppplied file object
+        :param importenv: import any environent changes back to python env
+        :param getenv: get the environent changes after running ``cmdstr``
+        :param env: set environment using ``env`` dict prior to running commands, or
+            use the ``Environment`` as the complete environment
+        :param logger: log output to the supplied logging.Logger
+        :param log_level: log level for logger
+        :param check: raise an exception if any command fails
+
+        :rtype: (outlines, deltaenv)
+        """
+        check = check if check is not None else True
+
+        with _EnvFile(importenv or getenv) as envfile:
+            cmdstr = _join_cmdstr(cmdstr, envfile)
+            setup = self._env_commands(env)
+            cwd = os.getcwd()
+            if cwd != self._start_cwd:
+                setup.insert(0, f"cd {shlex.quote(cwd)}")
+            if self._is_sh and check:
+                setup.append("set -e")
+            prefix = "".join(f"{cmd}; " for cmd in setup)
+            if self._is_sh:
+                script = f"( {prefix}{cmdstr}\n) </dev/null\necho {self._marker} $?\n"
+            else:
+                script = (
+                    f"( {prefix}{cmdstr} ) < /dev/null\necho {self._marker} $status\n"
+                )
+
+            with self._lock:
+                _log_cmdstr(logfile, self.shell, cmdstr)
+                returncode, stdout = self._send(
+                    script, logfile=logfile, logger=logger, log_level=log_level
+                )
+                _log_cmdstr(logfile, self.shell)
+                self.ncommands += 1
+            newenv = envfile.read()
+
+        return _finish_shell(
+            returncode,
+            stdout,
+            cmdstr,
+            self.shell,
+            check,
+            importenv,
+            getenv,
+            newenv,
+            env=env,
+        )
@@ -1,14 +1,21 @@
 # Licensed under a 3-clause BSD style license - see LICENSE.rst
 """Utilities to run subprocesses"""
 
-import datetime
+# Modules that are only needed by some functions (datetime, logging, shlex,
+# tempfile) are imported where they are used to keep ``import ska_shell`` fast.
+import codecs
+import collections
+import collections.abc
 import functools
-import logging
+import io
 import re
 import os
+import selectors
 import sys
 import signal
 import subprocess
+import threading
+import time
 
 
 class ShellError(Exception):
@@ -21,6 +28,21 @@ class NonZeroReturnCode(ShellError):
         self.return_code = return_code
 
 
+class RunTimeoutError(RuntimeError):
+    pass
+
+
+class ShellTimeoutError(ShellError, RunTimeoutError):
+    """Shell command exceeded ``timeout`` or ``idle_timeout`` and was killed.
+
+    The output lines read before the command was killed are in ``lines``.
+    """
+
+    def __init__(self, msg, lines=None):
+        super().__init__(msg)
+        self.lines = lines if lines is not None else []
+
+
 def _fix_paths(
     envs,
     pathvars=(
@@ -56,59 +78,635 @@ def _fix_paths(
         envs[key] = ":".join(reversed(path_outs))
 
 
+_RE_KEYVAL = re.compile(r"([\w_]+) \s* = \s* (.*)", re.VERBOSE)
+
+
 def _parse_keyvals(keyvals):
     """Parse the key=val pairs from the newline-separated string.
 
     :param keyvals: Newline-separated string with key=val pairs
     :rtype: Dict of key=val pairs.
     """
-    re_keyval = re.compile(r"([\w_]+) \s* = \s* (.*)", re.VERBOSE)
     keyvalout = {}
     for keyval in keyvals:
-        m = re.match(re_keyval, keyval)
+        m = _RE_KEYVAL.match(keyval)
         if m:
             key, val = m.groups()
             keyvalout[key] = val
     return keyvalout
 
 
-def communicate(process, logfile=None, logger=None, log_level=None):
+# Numeric values of logging.DEBUG and logging.INFO
+_DEBUG = 10
+_INFO = 20
+
+
+def _get_log_level(log_level):
+    """Return the numeric logging level for ``log_level`` (default INFO)"""
+    if log_level is None:
+        return _INFO
+    if type(log_level) is str:
+        import logging
+
+        return getattr(logging, log_level)
+    return log_level
+
+
+def _log_lines(lines, logfile=None, logger=None, log_level=_INFO):
+    """Send output ``lines`` (without newlines) to ``logfile`` in one write and to
+    ``logger``"""
+    if logfile and lines:
+        logfile.write("".join([line + "\n" for line in lines]))
+    if logger is not None:
+        for line in lines:
+            logger.log(log_level, line)
+
+
+def _log_line(line, logfile=None, logger=None, log_level=_INFO):
+    """Send one output ``line`` (without the newline) to ``logfile`` and ``logger``"""
+    if logfile:
+        logfile.write(line + "\n")
+    if logger is not None:
+        logger.log(log_level, line)
+
+
+# Size of each read from a subprocess pipe
+_READ_SIZE = 65536
+
+
+class _LineSplitter:
+    """Incrementally decode chunks of subprocess output and split them into lines.
+
+    :param encoding: text encoding (default: utf-8)
+    :param universal_newlines: translate '\\r\\n' and '\\r' to '\\n'
+    :param keepends: keep the newline at the end of each line
+    """
+
+    def __init__(self, encoding=None, universal_newlines=False, keepends=False):
+        self._decoder = codecs.getincrementaldecoder(encoding or "utf-8")()
+        if universal_newlines:
+            self._decoder = io.IncrementalNewlineDecoder(self._decoder, translate=True)
+        self._keepends = keepends
+        self._pending = ""
+
+    def feed(self, data):
+        """Return the list of lines completed by the bytes ``data``"""
+        lines = (self._pending + self._decoder.decode(data)).split("\n")
+        self._pending = lines.pop()
+        if self._keepends:
+            lines = [line + "\n" for line in lines]
+        return lines
+
+    def close(self):
+        """Return the final line without a newline as a list (empty if none)"""
+        pending = self._pending + self._decoder.decode(b"", final=True)
+        self._pending = ""
+        return [pending] if pending else []
+
+
+def _iter_multi_chunks(streams, deadline=None, idle_timeout=None):
+    """Read ``streams`` (pipes from subprocess.Popen) until EOF on all of them.
+
+    The pipes are read in large chunks with ``os.read`` when a selector reports that
+    data are available.  This yields ``(index, data)`` with the index of the stream
+    in ``streams``, and ``data`` is ``b""`` at EOF of that stream.
+
+    :param streams: list of binary or text file objects from subprocess.Popen
+    :param deadline: ``time.monotonic()`` value at which to stop reading and raise
+        ``TimeoutError("timeout")`` (default: no limit)
+    :param idle_timeout: raise ``TimeoutError("idle_timeout")`` if no data are read
+        for this many seconds (default: no limit)
+    """
+    with selectors.DefaultSelector() as selector:
+        for index, stream in enumerate(streams):
+            selector.register(stream.fileno(), selectors.EVENT_READ, index)
+        while selector.get_map():
+            if deadline is None and idle_timeout is None:
+                events = selector.select()
+            else:
+                waits = [] if idle_timeout is None else [idle_timeout]
+                if deadline is not None:
+                    waits.append(deadline - time.monotonic())
+                wait = max(min(waits), 0)
+                events = selector.select(wait)
+                if not events:
+                    # Nothing was read for ``wait`` seconds
+                    if deadline is not None and time.monotonic() >= deadline:
+                        raise TimeoutError("timeout")
+                    if idle_timeout is not None and wait >= idle_timeout:
+                        raise TimeoutError("idle_timeout")
+                    continue
+            for key, _ in events:
+                data = os.read(key.fd, _READ_SIZE)
+                if not data:
+                    selector.unregister(key.fd)
+                yield key.data, data
+
+
+def _iter_chunks(stream, deadline=None, idle_timeout=None):
+    """Read ``stream`` (a pipe from subprocess.Popen) until EOF and yield the bytes.
+
+    See ``_iter_multi_chunks`` for parameters.
+    """
+    for _, data in _iter_multi_chunks([stream], deadline, idle_timeout):
+        if data:
+            yield data
+
+
+def _iter_multi_line_batches(
+    streams, keepends=False, deadline=None, idle_timeout=None
+):
+    """Read ``streams`` (pipes from subprocess.Popen) until EOF on all of them.
+
+    Each chunk from ``_iter_multi_chunks`` is decoded incrementally.  For each chunk
+    this yields ``(index, lines)`` with the index of the stream in ``streams`` and
+    the list of complete lines (without newlines) that the chunk finished.  A final
+    line without a newline is yielded at EOF of each stream.
+
+    :param streams: list of binary or text file objects from subprocess.Popen
+    :param keepends: keep the newline at the end of each line
+    :param deadline: ``time.monotonic()`` value at which to stop reading and raise
+        ``TimeoutError("timeout")`` (default: no limit)
+    :param idle_timeout: raise ``TimeoutError("idle_timeout")`` if no data are read
+        for this many seconds (default: no limit)
+    """
+    splitters = []
+    for stream in streams:
+        # Text mode pipe uses its encoding and universal newlines
+        encoding = getattr(stream, "encoding", None)
+        splitters.append(_LineSplitter(encoding, encoding is not None, keepends))
+
+    for index, data in _iter_multi_chunks(streams, deadline, idle_timeout):
+        splitter = splitters[index]
+        lines = splitter.feed(data) if data else splitter.close()
+        if lines:
+            yield index, lines
+
+
+def _iter_line_batches(stream, keepends=False, deadline=None, idle_timeout=None):
+    """Read ``stream`` (a pipe from subprocess.Popen) until EOF and yield lists of
+    lines.  See ``_iter_multi_line_batches`` for parameters.
+    """
+    for _, lines in _iter_multi_line_batches([stream], keepends, deadline, idle_timeout):
+        yield lines
+
+
+class ResourceUsage:
+    """
+    Resources used by a command, filled in when the command exits.
+
+    Pass an instance as the ``usage`` argument of ``run_shell()`` and its wrappers,
+    or read ``Spawn.usage`` after ``Spawn.run()``.  CPU time and memory include the
+    processes started by the command that it waited for.
+
+    Example::
+
+      >>> from ska_shell import ResourceUsage, bash
+      >>> usage = ResourceUsage()
+      >>> outlines = bash("make all", usage=usage)
+      >>> usage.wall_time, usage.max_rss
+
+    Attributes (None until the command exits):
+     - wall_time: elapsed time in seconds from start to exit
+     - user_time: user CPU time in seconds
+     - sys_time: system CPU time in seconds
+     - max_rss: maximum resident set size in bytes
+     - cached: True if the result came from a ``CommandCache`` so no command was
+       run (the times are then zero and ``max_rss`` is None)
+    """
+
+    def __init__(self):
+        self._start = None
+        self.wall_time = None
+        self.user_time = None
+        self.sys_time = None
+        self.max_rss = None
+        self.cached = False
+
+    def __repr__(self):
+        if self.wall_time is None:
+            return "<ResourceUsage>"
+        rss = f" max_rss={self.max_rss / 1e6:.1f}MB" if self.max_rss is not None else ""
+        cached = " cached" if self.cached else ""
+        return (
+            f"<ResourceUsage wall_time={self.wall_time:.3f}s "
+            f"user_time={self.user_time or 0:.3f}s sys_time={self.sys_time or 0:.3f}s"
+            f"{rss}{cached}>"
+        )
+
+    def _begin(self):
+        self._start = time.monotonic()
+        self.wall_time = self.user_time = self.sys_time = self.max_rss = None
+        self.cached = False
+
+    def _from_cache(self):
+        """Fill in for a result that came from a cache"""
+        self._start = None
+        self.wall_time = self.user_time = self.sys_time = 0.0
+        self.max_rss = None
+        self.cached = True
+
+    def _end(self, rusage=None):
+        self.wall_time = time.monotonic() - self._start
+        self._start = None
+        if rusage is not None:
+            self.user_time = rusage.ru_utime
+            self.sys_time = rusage.ru_stime
+            # ru_maxrss is in kilobytes except on macOS
+            scale = 1 if sys.platform == "darwin" else 1024
+            self.max_rss = rusage.ru_maxrss * scale
+
+
+# Functions called with each finished ``Span`` (see ``add_trace_hook()``)
+_hooks = []
+_local = threading.local()
+
+
+class Span:
+    """
+    Record of one call of ``run_shell()`` (or a wrapper such as ``bash()``),
+    ``run_shell_result()``, ``getenv()``, ``pipeline()`` or ``Spawn.run()``, passed
+    to trace hooks when the call returns.
+
+    Attributes:
+     - kind: "run_shell", "run_shell_result", "getenv", "pipeline" or "Spawn.run"
+     - cmd: command string or argument list (for a pipeline the stages joined with
+       " | ")
+     - shell: shell that ran the command ("bash", "tcsh", ...), "sh" for
+       ``Spawn`` with ``shell=True`` or None
+     - pid: process id of the command (None if no process was started).  For a
+       pipeline, the last command that was started.
+     - start: ``time.time()`` at the start of the call
+     - end: ``time.time()`` at the end of the call
+     - returncode: exit status (None if not known)
+     - nbytes: size of the output including newlines (in characters, which is the
+       number of bytes for ASCII output)
+     - thread_id: ``threading.get_ident()`` of the calling thread
+     - thread_name: name of the calling thread
+     - cached: True if the result came from a cache
+     - error: exception raised by the call, or caught by ``Spawn.run()`` with
+       ``catch=True`` (else None)
+     - parent: ``Span`` of the call that made this one (e.g. ``getenv()`` for its
+       ``run_shell()``) or None
+    """
+
+    __slots__ = (
+        "kind",
+        "cmd",
+        "shell",
+        "pid",
+        "start",
+        "end",
+        "returncode",
+        "nbytes",
+        "thread_id",
+        "thread_name",
+        "cached",
+        "error",
+        "parent",
+    )
+
+    def __init__(self, kind, cmd, parent=None):
+        self.kind = kind
+        self.cmd = cmd
+        self.shell = None
+        self.pid = None
+        self.returncode = None
+        self.nbytes = 0
+        thread = threading.current_thread()
+        self.thread_id = thread.ident
+        self.thread_name = thread.name
+        self.cached = False
+        self.error = None
+        self.parent = parent
+        self.end = None
+        self.start = time.time()
+
+    def __repr__(self):
+        return (
+            f"<Span {self.kind} pid={self.pid} returncode={self.returncode} "
+            f"duration={self.duration:.3f}s cmd={self.cmd!r}>"
+        )
+
+    @property
+    def duration(self):
+        """Duration of the call in seconds (0 until it returns)"""
+        return self.end - self.start if self.end is not None else 0.0
+
+
+def add_trace_hook(hook):
+    """Call ``hook(span)`` with a ``Span`` at the end of every ``run_shell()``,
+    ``getenv()`` and ``Spawn.run()`` call in any thread.
+
+    Hooks are called in the thread that made the call, so they should be fast and
+    thread-safe.  Exceptions raised by a hook are ignored.  Without hooks tracing
+    costs one check per call.  See ``ska_shell.tracing`` for hooks that collect
+    spans in memory or write a Chrome trace file.
+
+    :param hook: callable taking a ``Span``
+    """
+    if hook not in _hooks:
+        _hooks.append(hook)
+
+
+def remove_trace_hook(hook):
+    """Stop calling ``hook`` (see ``add_trace_hook()``).
+
+    :param hook: callable passed to ``add_trace_hook()``
+    """
+    try:
+        _hooks.remove(hook)
+    except ValueError:
+        pass
+
+
+def _traced(kind, cmd_index, cmd_name):
+    """Decorator that records a ``Span`` for each call of the function if there
+    are trace hooks.  The command is argument ``cmd_index`` or keyword
+    ``cmd_name``."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _hooks:
+                return func(*args, **kwargs)
+            cmd = args[cmd_index] if len(args) > cmd_index else kwargs.get(cmd_name)
+            spans = _local.__dict__.setdefault("spans", [])
+            span = Span(kind, cmd, spans[-1] if spans else None)
+            spans.append(span)
+            try:
+                return func(*args, **kwargs)
+            except BaseException as err:
+                span.error = err
+                if span.returncode is None:
+                    span.returncode = getattr(err, "return_code", None)
+                raise
+            finally:
+                span.end = time.time()
+                spans.pop()
+                parent = span.parent
+                if parent is not None and parent.pid is None:
+                    # e.g. getenv() reports the process of its run_shell()
+                    parent.pid = span.pid
+                    parent.returncode = span.returncode
+                    parent.shell = span.shell
+                for hook in list(_hooks):
+                    try:
+                        hook(span)
+                    except Exception:
+                        pass
+
+        return wrapper
+
+    return decorator
+
+
+def _span_update(**attrs):
+    """Set ``attrs`` of the innermost ``Span`` of this thread, if any"""
+    spans = getattr(_local, "spans", None)
+    if spans:
+        span = spans[-1]
+        for name, value in attrs.items():
+            setattr(span, name, value)
+
+
+def _popen(args, **kwargs):
+    """Start a process with ``subprocess.Popen``, or with the fork server if it is
+    running (see ``start_forkserver()``).
+
+    :param args: program arguments
+    :param kwargs: ``subprocess.Popen`` keyword arguments
+    :rtype: subprocess.Popen or ForkServerProcess
+    """
+    # The fork server can only be running if its module was imported, so a plain
+    # command does not pay for importing it
+    forkserver = sys.modules.get(f"{__package__}.forkserver")
+    server = forkserver._get_server() if forkserver is not None else None
+    if server is not None:
+        return server.popen(args, **kwargs)
+    return subprocess.Popen(args, **kwargs)
+
+
+def _wait(process, usage=None, timeout=None):
+    """Wait for ``process`` to exit and fill in ``usage`` if it is given.
+
+    The process is reaped with ``os.wait4`` to get its resource usage, polling if
+    there is a ``timeout``.  For a process started by the fork server the resource
+    usage comes from the fork server.
+
+    :param process: subprocess.Popen or ForkServerProcess object
+    :param usage: ``ResourceUsage`` or None
+    :param timeout: seconds to wait (raises ``subprocess.TimeoutExpired``)
+    :rtype: process exit status
+    """
+    if hasattr(process, "wait_rusage"):
+        returncode, rusage = process.wait_rusage(timeout)
+        if usage is not None and usage._start is not None:
+            usage._end(rusage)
+        return returncode
+
+    if usage is None or not hasattr(os, "wait4") or process.returncode is not None:
+        process.wait(timeout)
+        if usage is not None and usage._start is not None:
+            usage._end()
+        return process.returncode
+
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    delay = 0.0005
+    try:
+        while True:
+            pid, status, rusage = os.wait4(
+                process.pid, os.WNOHANG if deadline is not None else 0
+            )
+            if pid:
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise subprocess.TimeoutExpired(process.args, timeout)
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 0.05)
+    except ChildProcessError:
+        # Already reaped elsewhere, so resource usage is not available
+        process.wait()
+        usage._end()
+        return process.returncode
+
+    process.returncode = os.waitstatus_to_exitcode(status)
+    usage._end(rusage)
+    return process.returncode
+
+
+def _group_alive(pgid):
+    """True if process group ``pgid`` has a process that is not a zombie"""
+    try:
+        # Signal 0 only checks that the group exists
+        os.killpg(pgid, 0)
+    except (ProcessLookupError, PermissionError):
+        return False
+    if not os.path.isdir("/proc/self"):
+        return True
+    # Orphaned zombies stay in the group until init reaps them, which the init of
+    # some containers never does
+    for name in os.listdir("/proc"):
+        if name.isdigit():
+            try:
+                with open(f"/proc/{name}/stat", "rb") as fh:
+                    # Fields after the command name: state, ppid, pgrp, ...
+                    fields = fh.read().rsplit(b")", 1)[1].split()
+            except (OSError, IndexError):
+                continue
+            if int(fields[2]) == pgid and fields[0] != b"Z":
+                return True
+    return False
+
+
+def _kill_process_group(process, grace=5.0, usage=None):
+    """Terminate ``process`` and, if it was started with ``start_new_session=True``,
+    its process group.
+
+    SIGTERM is sent and then SIGKILL if the process has not exited after ``grace``
+    seconds.  For a process group SIGKILL is sent to the group if any process of
+    the group is left after ``grace`` seconds, even if ``process`` itself exited,
+    so processes that ignore SIGTERM do not outlive the command.
+
+    :param process: subprocess.Popen object
+    :param grace: seconds to wait after SIGTERM before sending SIGKILL
+    :param usage: ``ResourceUsage`` to fill in when the process exits
+    """
+    try:
+        group = os.getpgid(process.pid) == process.pid
+    except ProcessLookupError:
+        group = False
+    if not group:
+        for sig in (signal.SIGTERM, signal.SIGKILL):
+            try:
+                process.send_signal(sig)
+            except (ProcessLookupError, PermissionError):
+                pass
+            try:
+                _wait(process, usage, grace)
+                return
+            except subprocess.TimeoutExpired:
+                pass
+        return
+
+    deadline = time.monotonic() + grace
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except (ProcessLookupError, PermissionError):
+        pass
+    try:
+        _wait(process, usage, grace)
+    except subprocess.TimeoutExpired:
+        pass
+    # Wait for the rest of the group
+    while time.monotonic() < deadline:
+        if not _group_alive(process.pid):
+            return
+        time.sleep(0.02)
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+    if process.returncode is None:
+        _wait(process, usage)
+
+
+def _timeout_error(process, err, timeout, idle_timeout, lines):
+    """Return ``ShellTimeoutError`` for a ``TimeoutError`` from ``_iter_line_batches``
+    or ``TimeoutExpired`` from waiting for ``process``."""
+    if str(err) == "idle_timeout":
+        msg = f"produced no output for {idle_timeout:g} secs"
+    else:
+        msg = f"timed out after {timeout:g} secs"
+    return ShellTimeoutError(f"Process pid={process.pid} {msg}", lines)
+
+
+_STREAM_NAMES = ("stdout", "stderr")
+
+
+def communicate(
+    process,
+    logfile=None,
+    logger=None,
+    log_level=None,
+    timeout=None,
+    idle_timeout=None,
+    lines=None,
+    usage=None,
+):
     """
     Real-time reading of a subprocess stdout.
 
+    Output is read in large chunks as it becomes available (without polling) and
+    is then delivered line by line to ``logfile`` and ``logger``.
+
+    If the process was started with ``stderr=subprocess.PIPE`` then stdout and
+    stderr are read concurrently by the same reader.  In that case the output is
+    returned in a ``SeparateOutput`` (unless ``lines`` is given) with the lines of
+    each stream and the time each line was read.
+
+    If ``timeout`` or ``idle_timeout`` is exceeded then the process (and its process
+    group if it was started with ``start_new_session=True``) is killed and
+    ``ShellTimeoutError`` is raised with the output read so far in ``lines``.
+
     Parameters
     ----------
     :param process: process returned by subprocess.Popen
     :param logfile: append output to the suppplied file object
     :param logger: log output to the supplied logging.Logger
     :param log_level: log level for logger
+    :param timeout: maximum run time in seconds (default: no limit)
+    :param idle_timeout: maximum time in seconds without any output (default: no
+        limit)
+    :param lines: list or output buffer (e.g. ``TailBuffer``) to which output lines
+        are appended (default: new list, or ``SeparateOutput`` if stderr is a pipe)
+    :param usage: ``ResourceUsage`` filled in when the process exits (wall time is
+        from the call to ``communicate()``)
+
+    :rtype: list (or ``lines``) of output lines
     """
-    log_level = "INFO" if log_level is None else log_level
-    log_level = getattr(logging, log_level) if type(log_level) is str else log_level
-
-    lines = []
-    while True:
-        if process.poll() is not None:
-            break
-        line = process.stdout.readline()
-        line = line.decode() if isinstance(line, bytes) else line
-        if line:
-            if logfile:
-                logfile.write(line)
-            if logger is not None:
-                logger.log(log_level, line[:-1])
-            lines.append(line[:-1])
-
-    # in case the buffer is still not empty after the process ended
-    for line in process.stdout.readlines():
-        line = line.decode() if isinstance(line, bytes) else line
-        if line:
-            if logfile:
-                logfile.write(line)
-            if logger is not None:
-                logger.log(log_level, line[:-1])
-            lines.append(line[:-1])
-
+    log_level = _get_log_level(log_level)
+    deadline = time.monotonic() + timeout if timeout is not None else None
+
+    streams = [process.stdout]
+    separate = False
+    if process.stderr is not None:
+        from .buffers import SeparateOutput
+
+        streams.append(process.stderr)
+        if lines is None:
+            lines = SeparateOutput()
+        separate = isinstance(lines, SeparateOutput)
+    if lines is None:
+        lines = []
+    if usage is not None and usage._start is None:
+        usage._begin()
+    # Output size for the trace span of the calling function
+    tracing = bool(_hooks)
+    nbytes = 0
+    try:
+        for index, batch in _iter_multi_line_batches(
+            streams, deadline=deadline, idle_timeout=idle_timeout
+        ):
+            if logfile or logger is not None:
+                _log_lines(batch, logfile, logger, log_level)
+            if separate:
+                lines.extend(batch, _STREAM_NAMES[index], time.monotonic())
+            else:
+                lines.extend(batch)
+            if tracing:
+                nbytes += sum(map(len, batch)) + len(batch)
+        if deadline is not None:
+            _wait(process, usage, max(deadline - time.monotonic(), 0))
+    except (TimeoutError, subprocess.TimeoutExpired) as err:
+        _kill_process_group(process, usage=usage)
+        raise _timeout_error(process, err, timeout, idle_timeout, lines) from None
+    finally:
+        if tracing:
+            _span_update(nbytes=nbytes)
+
+    _wait(process, usage)
     return lines
 
 
@@ -118,6 +716,593 @@ def _shell_ok(shell):
     return p.returncode == 0
 
 
+class Environment(collections.abc.Mapping):
+    """
+    Immutable environment made of a base and layers of changes.
+
+    An ``Environment`` can be passed wherever ``env`` is accepted.  Unlike a dict
+    of updates it is the complete environment of the command, so ``os.environ`` is
+    not copied for each call: the flat dict for the child process is built once
+    and cached.  Deriving a new environment with ``updated()`` only stores the
+    changes, and ``diff()`` against an ancestor only looks at the changes.  As it
+    is never modified, one ``Environment`` can be shared by any number of
+    threads.
+
+    Given an ``Environment``, ``getenv()`` returns a new ``Environment`` with the
+    changes made by the command instead of changing ``os.environ`` with
+    ``importenv()``, which affects all threads.
+
+    Example::
+
+      >>> from ska_shell import Environment, bash, getenv
+      >>> base = Environment()  # snapshot of os.environ
+      >>> ciao = getenv(". /soft/ciao/bin/ciao.sh", env=base)
+      >>> ciao.delta  # changes made by ciao.sh
+      >>> bash("dmlist evt2.fits blocks", env=ciao)
+      >>> test = ciao.updated(ASCDS_WORK_PATH="/tmp/test")
+
+    :param base: mapping of environment vars (default: snapshot of ``os.environ``)
+    """
+
+    # Lookups go through at most this many layers before they are flattened
+    _MAX_DEPTH = 8
+
+    def __init__(self, base=None):
+        self._parent = None
+        self._delta = dict(os.environ if base is None else base)
+        self._depth = 0
+        self._flat = self._delta
+
+    @classmethod
+    def _layer(cls, parent, delta):
+        env = cls.__new__(cls)
+        env._parent = parent
+        env._delta = delta
+        env._depth = parent._depth + 1
+        env._flat = None
+        if env._depth > cls._MAX_DEPTH:
+            # Keep the parent for diff() but look up in a flat dict
+            env._environ()
+        return env
+
+    def _environ(self):
+        """Return the cached flat dict of all vars (must not be modified)"""
+        flat = self._flat
+        if flat is None:
+            flat = dict(self._parent._environ())
+            for key, value in self._delta.items():
+                if value is None:
+                    flat.pop(key, None)
+                else:
+                    flat[key] = value
+            self._flat = flat
+        return flat
+
+    def __getitem__(self, key):
+        env = self
+        while env._flat is None:
+            if key in env._delta:
+                value = env._delta[key]
+                if value is None:
+                    raise KeyError(key)
+                return value
+            env = env._parent
+        return env._flat[key]
+
+    def __iter__(self):
+        return iter(self._environ())
+
+    def __len__(self):
+        return len(self._environ())
+
+    def __repr__(self):
+        return f"<Environment nvars={len(self)} delta={self.delta!r}>"
+
+    @property
+    def parent(self):
+        """``Environment`` this one was derived from (None for a base)"""
+        return self._parent
+
+    @property
+    def delta(self):
+        """Dict of changes from ``parent``, with None for removed vars (all vars for
+        a base)"""
+        return dict(self._delta)
+
+    def updated(self, changes=None, **kwargs):
+        """Return a new ``Environment`` with ``changes`` applied.
+
+        :param changes: dict of vars to set, with None values for vars to remove
+        :param kwargs: more vars to set
+        :rtype: Environment
+        """
+        delta = dict(changes or {}, **kwargs)
+        for key, value in delta.items():
+            if value is not None and not isinstance(value, str):
+                raise TypeError(f"value of {key} must be a str or None")
+        return self._layer(self, delta)
+
+    def without(self, *names):
+        """Return a new ``Environment`` without the vars ``names``.
+
+        :rtype: Environment
+        """
+        return self._layer(self, dict.fromkeys(names))
+
+    def diff(self, other):
+        """Return the changes that turn ``other`` into this environment.
+
+        If ``other`` is an ancestor of this environment then only the layers in
+        between are compared, otherwise all vars are compared.
+
+        :param other: ``Environment`` or mapping
+        :rtype: dict with None values for vars that are not in this environment
+        """
+        layers = []
+        env = self
+        while env is not None and env is not other:
+            layers.append(env._delta)
+            env = env._parent
+        if env is other and other is not None:
+            keys = set().union(*layers) if layers else set()
+        else:
+            keys = set(self._environ()) | set(other)
+        delta = {}
+        for key in keys:
+            value = self.get(key)
+            if other.get(key) != value:
+                delta[key] = value
+        return delta
+
+    def _overrides(self):
+        """Changes from the ``os.environ`` snapshot or mapping at the root"""
+        root = self
+        while root._parent is not None:
+            root = root._parent
+        return {k: v for k, v in self.diff(root).items() if v is not None}
+
+
+def _make_environ(env):
+    """Return the environment for a child process: ``os.environ`` updated with ``env``.
+
+    :param env: dict of environment vars, ``Environment`` or None
+    :rtype: dict (for an ``Environment`` the cached dict, which must not be
+        modified)
+    """
+    if isinstance(env, Environment):
+        return env._environ()
+    environ = dict(os.environ)
+    if env is not None:
+        environ.update(env)
+    return environ
+
+
+def _updated_env(env, deltaenv):
+    """Return the result of ``getenv()``: ``deltaenv``, or ``env`` updated with
+    ``deltaenv`` if ``env`` is an ``Environment`` (``env`` itself if there are no
+    changes)"""
+    if isinstance(env, Environment):
+        return env.updated(deltaenv) if deltaenv else env
+    return deltaenv
+
+
+def _apply_deltaenv(deltaenv):
+    """Update ``os.environ`` with ``deltaenv`` (None values remove vars)"""
+    for key, value in deltaenv.items():
+        if value is None:
+            os.environ.pop(key, None)
+        else:
+            os.environ[key] = value
+
+
+def _check_shell(shell):
+    if not _shell_ok(shell):
+        raise Exception(f'Failed to find "{shell}" shell')
+
+
+def _join_cmdstr(cmdstr, envfile=None, profile=None):
+    """Join the lines of ``cmdstr`` with ``&&`` so the shell stops at the first failure.
+
+    :param cmdstr: command string, possibly with multiple lines
+    :param envfile: ``_EnvFile`` to which the environment is written after ``cmdstr``
+    :param profile: ``_ProfileFile`` to which a timestamp is written before each line
+        and after the last one
+    :rtype: str
+    """
+    if profile is not None and profile.path is None:
+        profile = None
+    cmds = []
+    if profile is not None and profile.setup:
+        cmds.append(profile.setup)
+    for lineno, line in enumerate(cmdstr.splitlines(), 1):
+        if line.strip():
+            if profile is not None:
+                cmds.append(profile.marker(lineno))
+            cmds.append(line)
+    if profile is not None:
+        cmds.append(profile.marker(0))
+    if envfile is not None and envfile.command:
+        cmds.append(envfile.command)
+    return " && ".join(cmds)
+
+
+def _log_cmdstr(logfile, shell, cmdstr=""):
+    """Write the command header (or footer if ``cmdstr`` is empty) to ``logfile``"""
+    if logfile:
+        import datetime
+
+        time = datetime.datetime.now().isoformat()[:22]
+        sep = " " if cmdstr else ""
+        logfile.write(f"{shell.capitalize()}-{time}>{sep}{cmdstr}\n")
+
+
+def _raise_nonzero(returncode, stdout, cmdstr):
+    # Use the last stderr line if stderr was captured separately
+    msg = " ".join((getattr(stdout, "stderr", None) or stdout)[-1:])
+    exc = NonZeroReturnCode(
+        f"Shell command failed with return_code={returncode}: {msg}."
+        f"Command: {cmdstr}",
+        return_code=returncode
+    )
+    exc.lines = stdout
+    raise exc
+
+
+@functools.cache
+def _env_nul_ok():
+    """True if ``env -0`` prints the environment NUL-delimited (GNU coreutils)"""
+    try:
+        p = subprocess.run(
+            ["env", "-0"],
+            env={"SKA_SHELL_ENV": "1"},
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+    except OSError:
+        return False
+    return p.returncode == 0 and p.stdout == b"SKA_SHELL_ENV=1\0"
+
+
+def _parse_env0(data):
+    """Parse NUL-delimited ``env -0`` output.
+
+    Values may contain newlines (e.g. exported bash functions).
+
+    :param data: bytes output of ``env -0``
+    :rtype: dict
+    """
+    return dict(
+        item.split("=", 1) for item in os.fsdecode(data).split("\0") if "=" in item
+    )
+
+
+class _EnvFile:
+    """Temporary file to which the shell writes its environment after the command.
+
+    The environment is written with ``env -0`` and parsed in one pass, or with
+    ``printenv`` if ``env -0`` is not supported.  Keeping it out of the command
+    output means the output does not need to be searched for it.  The file is
+    created by the shell in a new private directory, so the redirection works even
+    if the command sets ``noclobber``.  Use as a context manager to delete the
+    file.
+
+    :param enabled: create the file (otherwise ``command`` is None and ``read()``
+        returns an empty dict)
+    """
+
+    def __init__(self, enabled=True):
+        self.path = None
+        self.command = None
+        if enabled:
+            import shlex
+            import tempfile
+
+            self._dir = tempfile.mkdtemp(prefix="ska_shell_env_")
+            self.path = os.path.join(self._dir, "env")
+            self._nul = _env_nul_ok()
+            cmd = "env -0" if self._nul else "printenv"
+            self.command = f"{cmd} > {shlex.quote(self.path)}"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def read(self):
+        """Return the environment written by the shell, or None if the shell did not
+        write it (e.g. the command failed)
+
+        :rtype: dict or None
+        """
+        if self.path is None:
+            return {}
+        try:
+            with open(self.path, "rb") as fh:
+                data = fh.read()
+        except FileNotFoundError:
+            return None
+        if self._nul:
+            return _parse_env0(data)
+        return _parse_keyvals(os.fsdecode(data).splitlines())
+
+    def close(self):
+        """Delete the file"""
+        if self.path is not None:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+            os.rmdir(self._dir)
+            self.path = None
+
+
+LineTiming = collections.namedtuple(
+    "LineTiming", ["lineno", "cmd", "start", "end", "duration"]
+)
+LineTiming.__doc__ = """Run time of one line of a command string: line number (from 1),
+command, start and end as ``time.time()`` values and duration in seconds"""
+
+
+class ShellProfile:
+    """
+    Run time of each line of a multi-line command string, filled in by
+    ``run_shell(..., profile=...)`` when the shell exits.
+
+    The shell writes a timestamp before each line and after the last one, so the
+    time of a line includes everything up to the start of the next line.  Lines
+    that were not run because an earlier line failed are not included.
+
+    Example::
+
+      >>> from ska_shell import ShellProfile, bash
+      >>> profile = ShellProfile()
+      >>> outlines = bash(open("setup.sh").read(), profile=profile)
+      >>> print(profile.table(sort=True, top=5))
+       line   seconds  percent  command
+         12     3.211    81.2%  source /soft/ciao/bin/ciao.sh
+      ...
+
+    Attributes:
+     - lines: list of ``LineTiming`` for the lines that were run
+     - total: wall time in seconds from start to exit of the shell
+     - complete: True if all lines were run
+     - cached: True if the result came from a ``CommandCache`` so no line was run
+    """
+
+    def __init__(self):
+        self.lines = []
+        self.total = None
+        self.complete = False
+        self.cached = False
+
+    def __repr__(self):
+        if self.total is None:
+            return "<ShellProfile>"
+        return f"<ShellProfile nlines={len(self.lines)} total={self.total:.3f}s>"
+
+    def __str__(self):
+        return self.table()
+
+    def _fill(self, cmdstr, marks, t_start, t_end):
+        """Fill in from ``marks``, a list of (lineno, time) written by the shell"""
+        cmds = dict(enumerate(cmdstr.splitlines(), 1))
+        self.cached = False
+        self.total = t_end - t_start
+        self.complete = bool(marks) and marks[-1][0] == 0
+        self.lines = []
+        for (lineno, start), (_, end) in zip(marks, marks[1:] + [(None, t_end)]):
+            if lineno:
+                self.lines.append(
+                    LineTiming(lineno, cmds[lineno].strip(), start, end, end - start)
+                )
+
+    def _from_cache(self):
+        """Fill in for a result that came from a cache"""
+        self.lines = []
+        self.total = 0.0
+        self.complete = True
+        self.cached = True
+
+    def slowest(self, n=None):
+        """Return the ``n`` (default: all) slowest lines, slowest first
+
+        :rtype: list of ``LineTiming``
+        """
+        lines = sorted(self.lines, key=lambda line: line.duration, reverse=True)
+        return lines if n is None else lines[:n]
+
+    def table(self, sort=False, top=None):
+        """Return the timings as a text table.
+
+        :param sort: sort by duration (slowest first) instead of line number
+        :param top: only include this many lines
+        :rtype: str
+        """
+        lines = self.slowest() if sort else self.lines
+        total = self.total or 0
+        rows = [" line   seconds  percent  command"]
+        for line in lines[:top]:
+            percent = 100 * line.duration / total if total > 0 else 0
+            rows.append(
+                f"{line.lineno:5d} {line.duration:9.3f} {percent:7.1f}%  {line.cmd}"
+            )
+        if self.cached:
+            rows.append("(result from cache, no command was run)")
+        elif not self.complete:
+            rows.append("(stopped before the end of the command string)")
+        return "\n".join(rows)
+
+
+class _ProfileFile:
+    """Temporary file to which the shell writes a line number and timestamp
+    before each line of the command string.  Use as a context manager to delete
+    the file.
+
+    :param shell: shell that runs the command
+    :param enabled: create the file (otherwise ``read()`` returns an empty list)
+    """
+
+    def __init__(self, shell, enabled=True):
+        self.path = None
+        self.setup = None
+        if enabled:
+            import shlex
+            import tempfile
+
+            fd, self.path = tempfile.mkstemp(prefix="ska_shell_profile_")
+            os.close(fd)
+            self._quoted = shlex.quote(self.path)
+            self._csh = shell in ("tcsh", "csh")
+            # bash >= 5 and zsh (with zsh/datetime) have a builtin high resolution
+            # clock.  Otherwise date is run for each line.
+            if shell == "zsh":
+                self.setup = "{ zmodload zsh/datetime 2>/dev/null || true; }"
+
+    def marker(self, lineno):
+        """Return the command that writes the timestamp for line ``lineno`` (0 for
+        the end)"""
+        if self._csh:
+            return f'echo {lineno} "`date +%s.%N`" >> {self._quoted}'
+        return (
+            f"printf '%s %s\\n' {lineno} \"${{EPOCHREALTIME:-$(date +%s.%N)}}\" "
+            f">> {self._quoted}"
+        )
+
+    def read(self):
+        """Return the list of (lineno, time) written by the shell"""
+        marks = []
+        if self.path is None:
+            return marks
+        with open(self.path) as fh:
+            for line in fh:
+                try:
+                    lineno, stamp = line.split()
+                    # EPOCHREALTIME uses the decimal point of the locale
+                    marks.append((int(lineno), float(stamp.replace(",", "."))))
+                except ValueError:
+                    pass
+        return marks
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Delete the file"""
+        if self.path is not None:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+            self.path = None
+
+
+def _log_profile(profile, logfile, logger, log_level):
+    """Log the table of ``profile`` to ``logfile`` and ``logger``, or to stderr if
+    there are neither"""
+    lines = ["Line profile:"] + profile.table().splitlines()
+    if logfile or logger is not None:
+        _log_lines(lines, logfile, logger, log_level)
+    else:
+        sys.stderr.write("\n".join(lines) + "\n")
+
+
+def _get_deltaenv(newenv, expected_diff_set=(), base=None):
+    """Return the vars in ``newenv`` that differ from ``os.environ``, or from
+    ``base`` if it is an ``Environment``.
+
+    :param newenv: dict of environment vars printed by the shell
+    :param expected_diff_set: vars set by the shell itself that are ignored
+    :param base: ``Environment`` the shell was started with.  Vars that were
+        removed from it are included with value None.
+    :rtype: dict
+    """
+    deltaenv = dict()
+    currenv = base._environ() if base is not None else dict(os.environ)
+    _fix_paths(newenv)
+    for key in set(newenv) - set(expected_diff_set):
+        if key not in currenv or currenv[key] != newenv[key]:
+            deltaenv[key] = newenv[key]
+    if base is not None:
+        for key in currenv.keys() - newenv.keys() - set(expected_diff_set):
+            deltaenv[key] = None
+    return deltaenv
+
+
+# Environment vars that the shell sets itself and which are not reported in
+# deltaenv.  tcsh and csh use the same set as bash because they were formerly run
+# from a bash wrapper.
+_SHELL_ENV_VARS = {
+    "bash": ("PS1", "PS2", "_", "SHLVL"),
+    "zsh": ("PS1", "PS2", "_", "SHLVL"),
+    "tcsh": ("PS1", "PS2", "_", "SHLVL"),
+    "csh": ("PS1", "PS2", "_", "SHLVL"),
+}
+
+
+def _shell_args(cmdstr, shell, check):
+    """Return the argument list to run the joined ``cmdstr`` in ``shell``.
+
+    :param cmdstr: command string from ``_join_cmdstr``
+    :param shell: shell for command
+    :param check: abort at the first command that fails
+    :rtype: list
+    """
+    # make sure the RC file is not sourced in csh (option -f) and abort on error
+    # (option -e).  The shell is run directly so cmdstr needs no quoting.
+    if shell in ["tcsh", "csh"]:
+        return [shell] + (["-e"] if check else []) + ["-f", "-c", cmdstr]
+    elif shell in ["bash", "zsh"] and check:
+        return [shell, "-c", f"set -e; {cmdstr}"]
+    return [shell, "-c", cmdstr]
+
+
+def _finish_shell(
+    returncode,
+    stdout,
+    cmdstr,
+    actual_shell,
+    check,
+    importenv,
+    getenv,
+    newenv=None,
+    env=None,
+):
+    """Check the return code and extract environment changes after running a shell.
+
+    :param returncode: shell exit status
+    :param stdout: list of output lines
+    :param cmdstr: command string from ``_join_cmdstr``
+    :param actual_shell: name of the shell executable that was run
+    :param check: raise an exception if ``returncode`` is non-zero
+    :param importenv: import any environent changes back to python env
+    :param getenv: get the environent changes after running ``cmdstr``
+    :param newenv: environment after running ``cmdstr`` from ``_EnvFile.read()``,
+        or None if it was not captured, in which case there are no changes
+    :param env: ``env`` argument.  For an ``Environment`` the changes are relative
+        to it instead of ``os.environ``.
+    :rtype: (outlines, deltaenv)
+    """
+    if check and returncode:
+        _raise_nonzero(returncode, stdout, cmdstr)
+
+    # Update os.environ based on changes to environment made by cmdstr
+    deltaenv = dict()
+    if (importenv or getenv) and newenv is not None:
+        deltaenv = _get_deltaenv(
+            newenv,
+            _SHELL_ENV_VARS.get(actual_shell, ()),
+            env if isinstance(env, Environment) else None,
+        )
+        if importenv:
+            _apply_deltaenv(deltaenv)
+
+    return stdout, deltaenv
+
+
 def run_shell(
     cmdstr,
     shell="bash",
@@ -128,6 +1313,14 @@ def run_shell(
     logger=None,
     log_level=None,
     check=None,
+    timeout=None,
+    idle_timeout=None,
+    retain=None,
+    usage=None,
+    separate_stderr=False,
+    cache=None,
+    cache_inputs=None,
+    profile=None,
 ):
     """
     Run the command string ``cmdstr`` in a ``shell`` ('bash' or 'tcsh').  It can have
@@ -140,80 +1333,388 @@ def run_shell(
     :param logfile: append output to the suppplied file object
     :param importenv: import any environent changes back to python env
     :param getenv: get the environent changes after running ``cmdstr``
-    :param env: set environment using ``env`` dict prior to running commands
+    :param env: set environment using ``env`` dict prior to running commands, or
+        use the ``Environment`` as the complete environment
     :param check: raise an exception if any command fails
+    :param timeout: kill the shell and raise ``ShellTimeoutError`` if it runs for
+        more than ``timeout`` seconds (default: no limit)
+    :param idle_timeout: kill the shell and raise ``ShellTimeoutError`` if there is
+        no output for ``idle_timeout`` seconds (default: no limit)
+    :param retain: output buffer such as ``TailBuffer`` or ``SpillBuffer`` that is
+        cleared and then used instead of a list to keep output lines, limiting
+        memory use for commands with a lot of output (default: keep all lines in
+        a list)
+    :param usage: ``ResourceUsage`` that is filled in with the wall time, CPU time
+        and maximum memory of the shell when it exits.  If ``logger`` is given then
+        the usage is also logged at DEBUG level.
+    :param separate_stderr: read stderr separately from stdout and return the
+        output as a ``SeparateOutput``.  This is a sequence of the stdout lines with
+        the stderr lines in ``outlines.stderr`` and all lines in the order they were
+        read in ``outlines.merged``.  Cannot be used with ``retain``.
+    :param cache: ``CommandCache`` that returns the stored output of an earlier
+        successful run with the same command, options, environment and
+        ``cache_inputs`` instead of running ``cmdstr`` (default: no caching)
+    :param cache_inputs: list of files read by ``cmdstr`` whose changes invalidate
+        the cached output
+    :param profile: ``ShellProfile`` that is filled in with the run time of each
+        line of ``cmdstr``, or True to log the table of line timings to
+        ``logger`` and ``logfile`` (or stderr if neither is given).  This is also
+        filled in if the command fails or times out.
 
     :rtype: (outlines, deltaenv)
     """
-    check = check if check is not None else True
+    _, outlines, deltaenv = _run_shell(
+        cmdstr,
+        shell,
+        logfile,
+        importenv,
+        getenv,
+        env,
+        logger,
+        log_level,
+        check,
+        timeout,
+        idle_timeout,
+        retain,
+        usage,
+        separate_stderr,
+        cache,
+        cache_inputs,
+        profile,
+    )
+    return outlines, deltaenv
 
-    environ = dict(os.environ)
-    if env is not None:
-        environ.update(env)
 
-    if not _shell_ok(shell):
-        raise Exception(f'Failed to find "{shell}" shell')
+@_traced("run_shell", 0, "cmdstr")
+def _run_shell(
+    cmdstr,
+    shell="bash",
+    logfile=None,
+    importenv=False,
+    getenv=False,
+    env=None,
+    logger=None,
+    log_level=None,
+    check=None,
+    timeout=None,
+    idle_timeout=None,
+    retain=None,
+    usage=None,
+    separate_stderr=False,
+    cache=None,
+    cache_inputs=None,
+    profile=None,
+):
+    """``run_shell()`` that also returns the exit status of the shell (0 for a
+    result from ``cache``)
 
-    if importenv or getenv:
-        cmdstr += " && echo __PRINTENV__ && printenv"
+    :rtype: (returncode, outlines, deltaenv)
+    """
+    check = check if check is not None else True
+    if separate_stderr and retain is not None:
+        raise ValueError("separate_stderr cannot be used with retain")
+    if _hooks:
+        _span_update(shell=shell)
+
+    if cache is not None:
+        if separate_stderr:
+            raise ValueError("separate_stderr cannot be used with cache")
+        cache_key, cache_stamps, cached = cache._lookup(
+            cmdstr,
+            cache_inputs,
+            env,
+            shell=shell,
+            check=check,
+            getenv=importenv or getenv,
+        )
+        if cached is not None:
+            if _hooks:
+                _span_update(cached=True, returncode=0)
+            if usage is not None:
+                usage._from_cache()
+            if isinstance(profile, ShellProfile):
+                profile._from_cache()
+            return (0,) + _cached_shell(
+                cached, retain, logfile, logger, log_level, importenv
+            )
 
-    # all lines are joined so the shell exits at the first failure
-    cmdstr = " && ".join([c for c in cmdstr.splitlines() if c.strip()])
+    log_profile = profile is True
+    if log_profile:
+        profile = ShellProfile()
+
+    environ = _make_environ(env)
+    _check_shell(shell)
+
+    orig_cmdstr = cmdstr
+    with _EnvFile(importenv or getenv) as envfile, _ProfileFile(
+        shell, profile is not None
+    ) as profile_file:
+        # all lines are joined so the shell exits at the first failure
+        cmdstr = _join_cmdstr(orig_cmdstr, envfile)
+        # Timestamp markers for the profile are not shown in logs and errors
+        run_cmdstr = _join_cmdstr(orig_cmdstr, envfile, profile_file)
+
+        args = _shell_args(run_cmdstr, shell, check)
+        if usage is not None:
+            usage._begin()
+        t_start = time.time()
+        proc = _popen(
+            args,
+            env=environ,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE if separate_stderr else subprocess.STDOUT,
+            # Own process group so a timeout can kill all processes of the command
+            start_new_session=timeout is not None or idle_timeout is not None,
+        )
+        if _hooks:
+            _span_update(pid=proc.pid)
+        if retain is not None:
+            retain.clear()
+            stdout = retain
+        elif separate_stderr:
+            from .buffers import SeparateOutput
+
+            stdout = SeparateOutput()
+        else:
+            stdout = []
 
-    # make sure the RC file is not sourced in csh (option -f) and abort on error (option -e)
-    actual_shell = shell
-    actual_cmdstr = cmdstr
-    if shell in ["tcsh", "csh"]:
-        actual_cmdstr = f"{shell} {'-e' if check else ''} -f -c '{actual_cmdstr}'"
-        actual_shell = "bash"
-    elif shell in ["bash", "zsh"] and check:
-        actual_cmdstr = f"set -e; {actual_cmdstr}"
-
-    proc = subprocess.Popen(
-        [actual_cmdstr],
-        executable=actual_shell,
-        shell=True,
-        env=environ,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
+        _log_cmdstr(logfile, shell, cmdstr)
+        try:
+            communicate(
+                proc,
+                logfile=logfile,
+                logger=logger,
+                log_level=log_level,
+                timeout=timeout,
+                idle_timeout=idle_timeout,
+                lines=stdout,
+                usage=usage,
+            )
+        finally:
+            _log_cmdstr(logfile, shell)
+            if _hooks:
+                _span_update(returncode=proc.returncode)
+            if usage is not None and logger is not None:
+                logger.log(_DEBUG, f"Resource usage: {usage}")
+            if profile is not None:
+                profile._fill(orig_cmdstr, profile_file.read(), t_start, time.time())
+                if log_profile:
+                    _log_profile(profile, logfile, logger, _get_log_level(log_level))
+        newenv = envfile.read()
+
+    outlines, deltaenv = _finish_shell(
+        proc.returncode,
+        stdout,
+        cmdstr,
+        args[0],
+        check,
+        importenv,
+        getenv,
+        newenv=newenv,
+        env=env,
     )
-    if logfile:
-        time = datetime.datetime.now().isoformat()[:22]
-        logfile.write(f"{shell.capitalize()}-{time}> {cmdstr}\n")
-    stdout = communicate(proc, logfile=logfile, logger=logger, log_level=log_level)
-    if logfile:
-        time = datetime.datetime.now().isoformat()[:22]
-        logfile.write(f"{shell.capitalize()}-{time}>\n")
-    if check and proc.returncode:
-        msg = " ".join(stdout[-1:])  # stdout could be empty
-        exc = NonZeroReturnCode(
-            f"Shell command failed with return_code={proc.returncode}: {msg}."
-            f"Command: {cmdstr}",
-            return_code=proc.returncode
+    if cache is not None and proc.returncode == 0:
+        cache._save(
+            cache_key,
+            cache_stamps,
+            cache_inputs,
+            {"lines": list(outlines), "deltaenv": deltaenv},
         )
-        exc.lines = stdout
-        raise exc
+    return proc.returncode, outlines, deltaenv
+
+
+def _cached_shell(cached, retain, logfile, logger, log_level, importenv):
+    """Return (outlines, deltaenv) for a ``CommandCache`` entry from ``run_shell()``
+    as if the command had been run"""
+    lines = cached["lines"]
+    if retain is not None:
+        retain.clear()
+        retain.extend(lines)
+        lines = retain
+    if logger is not None:
+        logger.log(_DEBUG, "Using cached output")
+    if logfile or logger is not None:
+        _log_lines(lines, logfile, logger, _get_log_level(log_level))
+    if importenv:
+        _apply_deltaenv(cached["deltaenv"])
+    return lines, cached["deltaenv"]
+
+
+class ShellStream:
+    """
+    Iterator over the output lines of a shell command, returned by ``iter_shell()``.
+
+    The shell is started when iteration begins and each line is yielded as soon as
+    it is read, so output is never accumulated in memory and a slow consumer
+    throttles the command through the pipe.  Once iteration finishes the
+    ``returncode`` and ``deltaenv`` attributes are set.  If the iterator is closed
+    early (``close()``, leaving a ``with`` block, or garbage collection) then the
+    shell is killed.
+
+    With ``check=True`` a non-zero exit status raises ``NonZeroReturnCode`` at the
+    end of iteration.  Since the output is not stored, the exception ``lines``
+    contains only the last output line.
+    """
 
-    newenv = {}
-    if "__PRINTENV__" in stdout:
-        newenv = _parse_keyvals(stdout[stdout.index("__PRINTENV__") + 1 :])
-        stdout = stdout[: stdout.index("__PRINTENV__")]
+    def __init__(
+        self,
+        cmdstr,
+        shell="bash",
+        logfile=None,
+        importenv=False,
+        getenv=False,
+        env=None,
+        logger=None,
+        log_level=None,
+        check=None,
+        timeout=None,
+        idle_timeout=None,
+    ):
+        self.cmdstr = cmdstr
+        self.shell = shell
+        self.returncode = None
+        self.deltaenv = None
+        self.process = None
+        self._lines = self._iter_lines(
+            logfile,
+            importenv,
+            getenv,
+            env,
+            logger,
+            log_level,
+            check,
+            timeout,
+            idle_timeout,
+        )
 
-    # Update os.environ based on changes to environment made by cmdstr
-    deltaenv = dict()
-    if importenv or getenv:
-        expected_diff_set = (
-            set(("PS1", "PS2", "_", "SHLVL")) if actual_shell in ["bash", "zsh"] else set()
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._lines)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Stop iteration and kill the shell if it is still running"""
+        self._lines.close()
+
+    def _iter_lines(
+        self,
+        logfile,
+        importenv,
+        getenv,
+        env,
+        logger,
+        log_level,
+        check,
+        timeout,
+        idle_timeout,
+    ):
+        check = check if check is not None else True
+        log_level = _get_log_level(log_level)
+        deadline = time.monotonic() + timeout if timeout is not None else None
+
+        environ = _make_environ(env)
+        _check_shell(self.shell)
+        envfile = _EnvFile(importenv or getenv)
+        cmdstr = _join_cmdstr(self.cmdstr, envfile)
+        args = _shell_args(cmdstr, self.shell, check)
+        try:
+            proc = self.process = _popen(
+                args,
+                env=environ,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                start_new_session=timeout is not None or idle_timeout is not None,
+            )
+        except BaseException:
+            envfile.close()
+            raise
+        _log_cmdstr(logfile, self.shell, cmdstr)
+
+        last_line = []
+        finished = False
+        try:
+            for batch in _iter_line_batches(
+                proc.stdout, deadline=deadline, idle_timeout=idle_timeout
+            ):
+                _log_lines(batch, logfile, logger, log_level)
+                last_line[:] = batch[-1:]
+                yield from batch
+            if deadline is not None:
+                proc.wait(max(deadline - time.monotonic(), 0))
+            finished = True
+        except (TimeoutError, subprocess.TimeoutExpired) as err:
+            raise _timeout_error(proc, err, timeout, idle_timeout, last_line) from None
+        finally:
+            if not finished:
+                # Timeout, consumer stopped early or another exception
+                _kill_process_group(proc)
+            proc.stdout.close()
+            _log_cmdstr(logfile, self.shell)
+            newenv = envfile.read() if finished else None
+            envfile.close()
+
+        self.returncode = proc.wait()
+        _, self.deltaenv = _finish_shell(
+            self.returncode,
+            last_line,
+            cmdstr,
+            args[0],
+            check,
+            importenv,
+            getenv,
+            newenv=newenv,
+            env=env,
         )
-        currenv = dict(os.environ)
-        _fix_paths(newenv)
-        for key in set(newenv) - expected_diff_set:
-            if key not in currenv or currenv[key] != newenv[key]:
-                deltaenv[key] = newenv[key]
-        if importenv:
-            os.environ.update(deltaenv)
 
-    return stdout, deltaenv
+
+def iter_shell(
+    cmdstr,
+    shell="bash",
+    logfile=None,
+    importenv=False,
+    getenv=False,
+    env=None,
+    logger=None,
+    log_level=None,
+    check=None,
+    timeout=None,
+    idle_timeout=None,
+):
+    """
+    Run the command string ``cmdstr`` in a ``shell`` and iterate over output lines
+    as they arrive.  See ``run_shell`` for options.
+
+    Example::
+
+      >>> stream = iter_shell("find /data -name '*.fits'")
+      >>> for line in stream:
+      ...     process_file(line)
+      >>> stream.returncode
+      0
+
+    :returns: ``ShellStream`` iterator of output lines with ``returncode`` and
+        ``deltaenv`` attributes set after iteration
+    """
+    return ShellStream(
+        cmdstr,
+        shell=shell,
+        logfile=logfile,
+        importenv=importenv,
+        getenv=getenv,
+        env=env,
+        logger=logger,
+        log_level=log_level,
+        check=check,
+        timeout=timeout,
+        idle_timeout=idle_timeout,
+    )
 
 
 def bash_shell(
@@ -224,7 +1725,15 @@ def bash_shell(
     env=None,
     logger=None,
     log_level=None,
-    check=None
+    check=None,
+    timeout=None,
+    idle_timeout=None,
+    retain=None,
+    usage=None,
+    separate_stderr=False,
+    cache=None,
+    cache_inputs=None,
+    profile=None,
 ):
     """
     Run the command string ``cmdstr`` in a bash shell.  It can have
@@ -239,6 +1748,16 @@ def bash_shell(
     :param env: set environment using ``env`` dict prior to running commands
     :param logger: log output to the supplied logging.Logger
     :param log_level: log level for logger
+    :param check: raise an exception if any command fails
+    :param timeout: maximum run time in seconds (default: no limit)
+    :param idle_timeout: maximum time in seconds without any output (default: no
+        limit)
+    :param retain: output buffer such as ``TailBuffer`` used to keep output lines
+    :param usage: ``ResourceUsage`` filled in with the resources used by the shell
+    :param separate_stderr: read stderr separately and return a ``SeparateOutput``
+    :param cache: ``CommandCache`` for the output of ``cmdstr``
+    :param cache_inputs: list of files read by ``cmdstr``
+    :param profile: ``ShellProfile`` for line timings, or True to log them
 
     :rtype: (outlines, deltaenv)
     """
@@ -252,11 +1771,35 @@ def bash_shell(
         logger=logger,
         log_level=log_level,
         check=check,
+        timeout=timeout,
+        idle_timeout=idle_timeout,
+        retain=retain,
+        usage=usage,
+        separate_stderr=separate_stderr,
+        cache=cache,
+        cache_inputs=cache_inputs,
+        profile=profile,
     )
     return outlines, newenv
 
 
-def bash(cmdstr, logfile=None, importenv=False, env=None, logger=None, log_level=None, check=None):
+def bash(
+    cmdstr,
+    logfile=None,
+    importenv=False,
+    env=None,
+    logger=None,
+    log_level=None,
+    check=None,
+    timeout=None,
+    idle_timeout=None,
+    retain=None,
+    usage=None,
+    separate_stderr=False,
+    cache=None,
+    cache_inputs=None,
+    profile=None,
+):
     """Run the ``cmdstr`` string in a bash shell.  See ``run_shell`` for options.
 
     :returns: bash output
@@ -270,10 +1813,34 @@ def bash(cmdstr, logfile=None, importenv=False, env=None, logger=None, log_level
         logger=logger,
         log_level=log_level,
         check=check,
+        timeout=timeout,
+        idle_timeout=idle_timeout,
+        retain=retain,
+        usage=usage,
+        separate_stderr=separate_stderr,
+        cache=cache,
+        cache_inputs=cache_inputs,
+        profile=profile,
     )[0]
 
 
-def tcsh(cmdstr, logfile=None, importenv=False, env=None, logger=None, log_level=None, check=None):
+def tcsh(
+    cmdstr,
+    logfile=None,
+    importenv=False,
+    env=None,
+    logger=None,
+    log_level=None,
+    check=None,
+    timeout=None,
+    idle_timeout=None,
+    retain=None,
+    usage=None,
+    separate_stderr=False,
+    cache=None,
+    cache_inputs=None,
+    profile=None,
+):
     """Run the ``cmdstr`` string in a tcsh shell.  See ``run_shell`` for options.
 
     :returns: tcsh output
@@ -287,6 +1854,14 @@ def tcsh(cmdstr, logfile=None, importenv=False, env=None, logger=None, log_level
         logger=logger,
         log_level=log_level,
         check=check,
+        timeout=timeout,
+        idle_timeout=idle_timeout,
+        retain=retain,
+        usage=usage,
+        separate_stderr=separate_stderr,
+        cache=cache,
+        cache_inputs=cache_inputs,
+        profile=profile,
     )[0]
 
 
@@ -299,6 +1874,14 @@ def tcsh_shell(
     logger=None,
     log_level=None,
     check=None,
+    timeout=None,
+    idle_timeout=None,
+    retain=None,
+    usage=None,
+    separate_stderr=False,
+    cache=None,
+    cache_inputs=None,
+    profile=None,
 ):
     """
     Run the command string ``cmdstr`` in a tcsh shell.  It can have
@@ -313,6 +1896,16 @@ def tcsh_shell(
     :param env: set environment using ``env`` dict prior to running commands
     :param logger: log output to the supplied logging.Logger
     :param log_level: log level for logger
+    :param check: raise an exception if any command fails
+    :param timeout: maximum run time in seconds (default: no limit)
+    :param idle_timeout: maximum time in seconds without any output (default: no
+        limit)
+    :param retain: output buffer such as ``TailBuffer`` used to keep output lines
+    :param usage: ``ResourceUsage`` filled in with the resources used by the shell
+    :param separate_stderr: read stderr separately and return a ``SeparateOutput``
+    :param cache: ``CommandCache`` for the output of ``cmdstr``
+    :param cache_inputs: list of files read by ``cmdstr``
+    :param profile: ``ShellProfile`` for line timings, or True to log them
 
     :rtype: (outlines, deltaenv)
     """
@@ -326,29 +1919,89 @@ def tcsh_shell(
         logger=logger,
         log_level=log_level,
         check=check,
+        timeout=timeout,
+        idle_timeout=idle_timeout,
+        retain=retain,
+        usage=usage,
+        separate_stderr=separate_stderr,
+        cache=cache,
+        cache_inputs=cache_inputs,
+        profile=profile,
     )
     return outlines, newenv
 
 
-def getenv(cmdstr, shell="bash", importenv=False, env=None):
+@_traced("getenv", 0, "cmdstr")
+def getenv(
+    cmdstr,
+    shell="bash",
+    importenv=False,
+    env=None,
+    cache=None,
+    timeout=None,
+    idle_timeout=None,
+):
     """Run the ``cmdstr`` string in ``shell``.  See ``run_shell`` for options.
 
-    :returns: Dict of environment vars update produced by ``cmdstr``
-    """
+    If an ``EnvCache`` is supplied as ``cache`` then a valid cached result is used
+    instead of running ``cmdstr``, and the result of a successful run is stored in
+    the cache.
 
-    _, newenv = run_shell(
-        cmdstr, shell=shell, importenv=importenv, env=env, getenv=True, check=False
+    If ``env`` is an ``Environment`` then the result is a new ``Environment`` with
+    the changes made by ``cmdstr`` (see ``Environment.delta``), including vars
+    that were removed.
+
+    :param cache: ``EnvCache`` object (default: no caching)
+
+    :returns: Dict of environment vars update produced by ``cmdstr``, or
+        ``Environment`` if ``env`` is an ``Environment``
+    """
+    if cache is not None:
+        # Key is computed before running cmdstr, which may change os.environ
+        key = cache.key(cmdstr, shell=shell, env=env)
+        newenv = cache.load(key)
+        if newenv is not None:
+            if _hooks:
+                _span_update(cached=True)
+            if importenv:
+                _apply_deltaenv(newenv)
+            return _updated_env(env, newenv)
+
+    returncode, _, newenv = _run_shell(
+        cmdstr,
+        shell=shell,
+        importenv=importenv,
+        env=env,
+        getenv=True,
+        check=False,
+        timeout=timeout,
+        idle_timeout=idle_timeout,
     )
-    return newenv
+    # A failure (e.g. a setup script that could not be read) is not cached
+    if cache is not None and returncode == 0:
+        cache.store(key, newenv)
+    return _updated_env(env, newenv)
 
 
-def importenv(cmdstr, shell="bash", env=None):
+def importenv(
+    cmdstr, shell="bash", env=None, cache=None, timeout=None, idle_timeout=None
+):
     """Run ``cmdstr`` in a bash shell and import the environment updates into the
     current python environment (os.environ).  See ``bash_shell`` for options.
 
+    :param cache: ``EnvCache`` object (default: no caching)
+
     :returns: Dict of environment vars update produced by ``cmdstr``
     """
-    return getenv(cmdstr, importenv=True, env=env, shell=shell)
+    return getenv(
+        cmdstr,
+        importenv=True,
+        env=env,
+        shell=shell,
+        cache=cache,
+        timeout=timeout,
+        idle_timeout=idle_timeout,
+    )
 
 
 # Null file-like object.  Needed because pyfits spews warnings to stdout
@@ -368,10 +2021,6 @@ class _NullFile:
         pass
 
 
-class RunTimeoutError(RuntimeError):
-    pass
-
-
 class Spawn(object):
     """
     Provide methods to run subprocesses in a controlled and simple way.  Features:
@@ -435,15 +2084,6 @@ class Spawn(object):
             )  # Store open file objects created by this object
             return openfile
 
-    @staticmethod
-    def _timeout_handler(pid, timeout):
-        def handler(signum, frame):
-            raise RunTimeoutError(
-                "Process pid=%d timed out after %d secs" % (pid, timeout)
-            )
-
-        return handler
-
     def __init__(
         self,
         stdout=sys.stdout,
@@ -451,6 +2091,8 @@ class Spawn(object):
         catch=False,
         stderr=subprocess.STDOUT,
         shell=False,
+        kill_grace=5.0,
+        retain=None,
     ):
         """Create a Spawn object to run shell processes in a controlled way.
 
@@ -460,7 +2102,13 @@ class Spawn(object):
         :param catch: catch exceptions and just log a warning message
         :param stderr: destination for process stderr.  Can be None, a file object,
              or subprocess.STDOUT (default).  The latter merges stderr into stdout.
+             With None, stderr is read together with stdout and kept in
+             ``errlines``.
         :param shell: send run() cmd to shell (subprocess Popen shell parameter)
+        :param kill_grace: seconds between SIGTERM and SIGKILL when a command times
+             out
+        :param retain: output buffer such as ``TailBuffer`` or ``SpillBuffer`` used
+             for ``outlines`` instead of a list.  It is cleared at each run().
 
         :rtype: Spawn object
         """
@@ -469,6 +2117,8 @@ class Spawn(object):
         self.catch = catch
         self.stderr = stderr
         self.shell = shell
+        self.kill_grace = kill_grace
+        self.retain = retain
         self.openfiles = []  # Newly opened file objects for stdout
 
         # stdout can be None, <file>, 'filename', or sequence(..) of these
@@ -477,25 +2127,105 @@ class Spawn(object):
         except TypeError:
             self.outfiles = [self._open_for_write(f) for f in self.stdout]
 
-    def _write(self, line):
+    def _write_files(self, data):
         for f in self.outfiles:
-            f.write(line)
+            f.write(data)
+
+    def _write(self, line):
+        self._write_files(line)
         self.outlines.append(line)
 
-    def run(self, cmd, timeout=None, catch=None, shell=None):
+    @_traced("Spawn.run", 1, "cmd")
+    def run(
+        self, cmd, timeout=None, catch=None, shell=None, cache=None, cache_inputs=None
+    ):
         """Run the command ``cmd`` and abort if timeout is exceeded.
 
+        On timeout the process group of the command is sent SIGTERM, followed by
+        SIGKILL after ``kill_grace`` seconds, and ``RunTimeoutError`` is raised.
+        Timeouts do not use signals so any number of Spawn objects can run timed
+        commands concurrently in any threads.
+
         Attributes after run():
          - outlines: list of output lines from process
+         - errlines: list of stderr lines if ``stderr`` is None (else empty)
          - exitstatus: process exit status or None if an exception occurred
+         - usage: ``ResourceUsage`` with the wall time, CPU time and maximum memory
+           of the process
 
         :param cmd: list of strings or a string(see Popen docs)
         :param timeout: command timeout (default: ``self.timeout``)
         :param catch: catch exceptions (default: ``self.catch``)
         :param shell: run cmd in shell (default: ``self.shell``)
+        :param cache: ``CommandCache`` that returns the stored output of an earlier
+            successful run of ``cmd`` with unchanged ``cache_inputs`` instead of
+            running it.  The output is still written to the ``stdout`` destinations
+            (default: no caching)
+        :param cache_inputs: list of files read by ``cmd``
 
         :rtype: process exit value
         """
+        if self.retain is not None:
+            self.retain.clear()
+        outlines = self.retain if self.retain is not None else []
+        if _hooks:
+            _span_update(shell="sh" if (self.shell if shell is None else shell) else None)
+
+        if cache is not None:
+            cache_key, cache_stamps, cached = cache._lookup(
+                cmd,
+                cache_inputs,
+                shell=self.shell if shell is None else shell,
+                merge_stderr=self.stderr == subprocess.STDOUT,
+            )
+            if cached is not None:
+                self._write_files("".join(cached["lines"]))
+                outlines.extend(cached["lines"])
+                self.outlines = outlines
+                self.errlines = cached["errlines"]
+                self.exitstatus = 0
+                self.usage = ResourceUsage()
+                self.usage._from_cache()
+                if _hooks:
+                    _span_update(cached=True, returncode=0)
+                return self.exitstatus
+
+        lines = self.iter_run(cmd, timeout=timeout, catch=catch, shell=shell)
+        if _hooks:
+            nbytes = 0
+            for line in lines:
+                outlines.append(line)
+                nbytes += len(line)
+            _span_update(nbytes=nbytes, returncode=self.exitstatus)
+        else:
+            for line in lines:
+                outlines.append(line)
+        self.outlines = outlines
+        if cache is not None and self.exitstatus == 0:
+            cache._save(
+                cache_key,
+                cache_stamps,
+                cache_inputs,
+                {"lines": list(outlines), "errlines": self.errlines},
+            )
+        return self.exitstatus
+
+    def iter_run(self, cmd, timeout=None, catch=None, shell=None):
+        """Run the command ``cmd`` and yield output lines as they arrive.
+
+        This is the same as ``run()`` except that output lines (including warnings
+        for caught exceptions) are yielded instead of being stored in ``outlines``.
+        They are still written to the ``stdout`` destinations.  ``exitstatus`` is
+        set when iteration finishes.  If iteration is stopped early then the
+        process is killed.
+
+        :param cmd: list of strings or a string(see Popen docs)
+        :param timeout: command timeout (default: ``self.timeout``)
+        :param catch: catch exceptions (default: ``self.catch``)
+        :param shell: run cmd in shell (default: ``self.shell``)
+
+        :returns: iterator of output lines
+        """
 
         # Use object defaults if params not supplied
         if timeout is None:
@@ -505,42 +2235,80 @@ class Spawn(object):
         if shell is None:
             shell = self.shell
 
-        # stderr = None is taken to imply catching stderr, done with PIPE
+        # stderr = None is taken to imply catching stderr, done with PIPE.  It is
+        # read along with stdout so a command writing a lot to stderr cannot
+        # block on a full pipe.
         stderr = self.stderr or subprocess.PIPE
 
         self.outlines = []
+        self.errlines = []
         self.exitstatus = None
+        self.usage = ResourceUsage()
 
         try:
-            self.process = subprocess.Popen(
+            # A timed command runs in its own process group so that all of its
+            # processes can be killed.  The timeout is enforced by the read loop
+            # rather than a signal, so it works in any thread.
+            deadline = time.monotonic() + timeout if timeout else None
+            self.usage._begin()
+            self.process = _popen(
                 cmd,
                 stdout=subprocess.PIPE,
                 stderr=stderr,
                 shell=shell,
                 universal_newlines=True,
+                start_new_session=deadline is not None,
             )
-
-            prev_alarm_handler = signal.signal(
-                signal.SIGALRM, Spawn._timeout_handler(self.process.pid, timeout)
-            )
-            signal.alarm(self.timeout)
-            for line in self.process.stdout:
-                self._write(line)
-            self.exitstatus = self.process.wait()
-            signal.alarm(0)
-
-            signal.signal(signal.SIGALRM, prev_alarm_handler)
+            if _hooks:
+                _span_update(pid=self.process.pid)
+            streams = [self.process.stdout]
+            if self.process.stderr is not None:
+                streams.append(self.process.stderr)
+            finished = False
+            try:
+                for index, lines in _iter_multi_line_batches(
+                    streams, keepends=True, deadline=deadline
+                ):
+                    if index:
+                        self.errlines.extend(lines)
+                    else:
+                        # One write of each chunk to each destination
+                        self._write_files("".join(lines))
+                        yield from lines
+                if deadline is not None:
+                    _wait(
+                        self.process,
+                        self.usage,
+                        max(deadline - time.monotonic(), 0),
+                    )
+                finished = True
+            except (TimeoutError, subprocess.TimeoutExpired):
+                raise RunTimeoutError(
+                    "Process pid=%d timed out after %g secs" % (self.process.pid, timeout)
+                ) from None
+            finally:
+                if not finished:
+                    _kill_process_group(self.process, self.kill_grace, self.usage)
+                for stream in streams:
+                    stream.close()
+            self.exitstatus = _wait(self.process, self.usage)
 
         except RunTimeoutError as e:
+            if _hooks:
+                _span_update(error=e)
             if catch:
-                self._write("Warning - RunTimeoutError: %s\n" % e)
+                line = "Warning - RunTimeoutError: %s\n" % e
+                self._write_files(line)
+                yield line
             else:
                 raise
 
         except OSError as e:
+            if _hooks:
+                _span_update(error=e)
             if catch:
-                self._write("Warning - OSError: %s\n" % e)
+                line = "Warning - OSError: %s\n" % e
+                self._write_files(line)
+                yield line
             else:
                 raise
-
-        return self.exitstatus
@@ -0,0 +1,213 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Output sinks that batch writes to slow log destinations.
+
+A sink wraps a file-like object or a ``logging.Logger`` and can be passed as the
+``logfile`` or ``logger`` argument of ``run_shell()`` and its wrappers, or as a
+``Spawn`` stdout destination.  ``BufferedSink`` collects output and writes it in
+batches.  ``BackgroundSink`` hands output to a writer thread through a bounded
+queue so that reading output from a command never waits on a slow destination
+such as a file on NFS or a network log handler.
+"""
+
+import queue
+import threading
+import time
+
+__all__ = ["BufferedSink", "BackgroundSink"]
+
+
+def _deliver(target, items):
+    """Write ``items`` (strings for a file, (level, msg) for a logger) to
+    ``target``"""
+    if hasattr(target, "write"):
+        target.write("".join(items))
+    else:
+        for level, msg in items:
+            target.log(level, msg)
+
+
+def _item_size(item):
+    return len(item) if isinstance(item, str) else len(item[1]) + 1
+
+
+class _Sink:
+    """Base class providing the file and logger interfaces of a sink"""
+
+    def write(self, data):
+        """Write string ``data`` (file interface)"""
+        self._put(data)
+
+    def log(self, level, msg):
+        """Log ``msg`` at ``level`` (logger interface)"""
+        self._put((level, msg))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class BufferedSink(_Sink):
+    """
+    Collect output and pass it on to ``target`` in batches.
+
+    Output is written when more than ``max_bytes`` characters are buffered or when
+    ``flush_interval`` seconds have passed since the last write to ``target``
+    (checked at each write).  Call ``flush()`` or ``close()``, or use the sink as a
+    context manager, to write the remaining output.
+
+    Example::
+
+      >>> from ska_shell import BufferedSink, bash
+      >>> with open("make.log", "w") as fh, BufferedSink(fh) as logfile:
+      ...     bash("make all", logfile=logfile)
+
+    :param target: file-like object or ``logging.Logger``
+    :param flush_interval: maximum seconds to hold output (default: 1)
+    :param max_bytes: maximum characters to hold (default: 65536)
+    :param close_target: close ``target`` in ``close()``
+    """
+
+    def __init__(
+        self, target, flush_interval=1.0, max_bytes=65536, close_target=False
+    ):
+        self.target = target
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.close_target = close_target
+        self._items = []
+        self._nbytes = 0
+        self._last_write = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _put(self, item):
+        with self._lock:
+            self._items.append(item)
+            self._nbytes += _item_size(item)
+            if (
+                self._nbytes >= self.max_bytes
+                or time.monotonic() - self._last_write >= self.flush_interval
+            ):
+                self._write_items()
+
+    def _write_items(self):
+        items, self._items, self._nbytes = self._items, [], 0
+        self._last_write = time.monotonic()
+        if items:
+            _deliver(self.target, items)
+
+    def flush(self):
+        """Write buffered output to ``target`` and flush it"""
+        with self._lock:
+            self._write_items()
+            if hasattr(self.target, "flush"):
+                self.target.flush()
+
+    def close(self):
+        """Flush and, if ``close_target`` is set, close ``target``"""
+        self.flush()
+        if self.close_target:
+            self.target.close()
+
+
+_STOP = object()
+
+
+class BackgroundSink(_Sink):
+    """
+    Pass output to ``target`` from a background writer thread.
+
+    ``write()`` and ``log()`` never block: output goes into a queue of at most
+    ``max_queue`` items, and if the queue is full the output is dropped and
+    counted in ``dropped``.  The writer thread writes all queued output in one batch
+    and flushes ``target`` at most every ``flush_interval`` seconds.  An exception
+    from ``target`` is kept in ``error`` and the output is counted as dropped.
+
+    Example::
+
+      >>> from ska_shell import BackgroundSink, Spawn
+      >>> logfile = open("/nfs/logs/job.log", "w")
+      >>> with BackgroundSink(logfile, close_target=True) as log:
+      ...     Spawn(stdout=log).run(["make", "all"])
+      >>> log.dropped
+
+    :param target: file-like object or ``logging.Logger``
+    :param max_queue: maximum number of queued writes (default: 10000)
+    :param flush_interval: seconds between flushes of ``target`` (default: 1)
+    :param close_target: close ``target`` in ``close()``
+    """
+
+    def __init__(
+        self, target, max_queue=10000, flush_interval=1.0, close_target=False
+    ):
+        self.target = target
+        self.flush_interval = flush_interval
+        self.close_target = close_target
+        self.dropped = 0
+        self.error = None
+        self._queue = queue.Queue(max_queue)
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(
+            target=self._run, name="ska_shell-BackgroundSink", daemon=True
+        )
+        self._thread.start()
+
+    def _put(self, item):
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+    def _flush_target(self):
+        if hasattr(self.target, "flush"):
+            try:
+                self.target.flush()
+            except Exception as err:
+                self.error = err
+
+    def _run(self):
+        last_flush = time.monotonic()
+        while True:
+            try:
+                items = [self._queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                items = []
+            while True:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = _STOP in items
+            output = [item for item in items if item is not _STOP]
+            if output:
+                try:
+                    _deliver(self.target, output)
+                except Exception as err:
+                    self.error = err
+                    with self._lock:
+                        self.dropped += len(output)
+            if stop or time.monotonic() - last_flush >= self.flush_interval:
+                self._flush_target()
+                last_flush = time.monotonic()
+            for _ in items:
+                self._queue.task_done()
+            if stop:
+                return
+
+    def flush(self):
+        """Wait until queued output has been written to ``target`` and flush it"""
+        self._queue.join()
+        self._flush_target()
+
+    def close(self):
+        """Write queued output, stop the writer thread and, if ``close_target`` is
+        set, close ``target``"""
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+        if self.close_target:
+            self.target.close()
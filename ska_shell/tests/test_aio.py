@@ -0,0 +1,106 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+import asyncio
+import os
+import time
+
+import pytest
+from six.moves import cStringIO as StringIO
+
+from ska_shell import Environment, NonZeroReturnCode, RunTimeoutError
+from ska_shell import aio
+
+from .test_shell import _process_gone
+
+pytestmark = pytest.mark.skipif(
+    os.name == "nt", reason="ska_shell not supported on Windows"
+)
+
+
+def test_bash():
+    assert asyncio.run(aio.bash("echo line1; echo line2")) == ["line1", "line2"]
+
+
+def test_concurrent():
+    async def main():
+        return await asyncio.gather(*(aio.bash(f"sleep 0.5; echo {i}") for i in range(50)))
+
+    t0 = time.time()
+    outputs = asyncio.run(main())
+    assert outputs == [[str(i)] for i in range(50)]
+    assert time.time() - t0 < 5
+
+
+def test_env_and_check():
+    envs = asyncio.run(aio.getenv('export TEST_AIO_VAR="hello"'))
+    assert envs["TEST_AIO_VAR"] == "hello"
+    assert "TEST_AIO_VAR" not in os.environ
+    assert asyncio.run(aio.bash("echo $TEST_AIO_VAR", env=envs)) == ["hello"]
+
+    base = Environment()
+    envs = asyncio.run(aio.getenv("export TEST_AIO_VAR=1; unset HOME", env=base))
+    assert envs.delta == {"TEST_AIO_VAR": "1", "HOME": None}
+    assert asyncio.run(aio.bash("echo $TEST_AIO_VAR${HOME}", env=envs)) == ["1"]
+
+    out = asyncio.run(aio.bash("lsd; echo DONE", check=False))
+    assert out[-1] == "DONE"
+    with pytest.raises(NonZeroReturnCode):
+        asyncio.run(aio.bash("lsd; echo DONE"))
+
+
+def test_cancel_kills_child(tmpdir):
+    pidfile = tmpdir.join("pid")
+
+    async def main():
+        task = asyncio.create_task(aio.bash(f"echo $$ > {pidfile}; sleep 30"))
+        await asyncio.sleep(0.5)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
+    with pytest.raises(ProcessLookupError):
+        os.kill(int(pidfile.read()), 0)
+
+
+def test_cancel_kills_group(tmpdir):
+    pidfile = tmpdir.join("pid")
+
+    async def main():
+        task = asyncio.create_task(aio.bash(f"sleep 30 & echo $! > {pidfile}; wait"))
+        await asyncio.sleep(0.5)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    t0 = time.time()
+    asyncio.run(main())
+    # Cancelling does not wait for the background sleep to finish
+    assert time.time() - t0 < 5
+    assert _process_gone(int(pidfile.read()))
+
+
+class TestAsyncSpawn:
+    def test_ok(self):
+        f = StringIO()
+        spawn = aio.AsyncSpawn(stdout=f)
+        assert asyncio.run(spawn.run(["echo", "hello world"])) == 0
+        assert spawn.outlines == ["hello world\n"]
+        assert f.getvalue() == "hello world\n"
+        assert spawn.errlines == []
+        assert spawn.usage.wall_time > 0
+
+    def test_os_error(self):
+        spawn = aio.AsyncSpawn(stdout=None)
+        with pytest.raises(OSError):
+            asyncio.run(spawn.run("bad command"))
+        assert spawn.exitstatus is None
+
+    def test_timeout_error(self):
+        spawn = aio.AsyncSpawn(shell=True, stdout=None)
+        t0 = time.time()
+        with pytest.raises(RunTimeoutError, match="after 0.5 secs"):
+            asyncio.run(spawn.run("sleep 5", timeout=0.5))
+        # The sleep is killed so its stdout pipe is closed
+        assert time.time() - t0 < 3
+        assert spawn.exitstatus is None
+        assert spawn.process.returncode is not None
@@ -0,0 +1,59 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+import logging
+import os
+import time
+
+import pytest
+from six.moves import cStringIO as StringIO
+
+from ska_shell import NonZeroReturnCode, iter_many, run_many
+
+pytestmark = pytest.mark.skipif(
+    os.name == "nt", reason="ska_shell not supported on Windows"
+)
+
+
+def test_run_many_order():
+    cmds = [f"sleep {0.05 * (5 - i)}; echo {i}" for i in range(5)]
+    t0 = time.time()
+    results = run_many(cmds, max_workers=5)
+    assert time.time() - t0 < 1
+    assert [result.outlines for result in results] == [[str(i)] for i in range(5)]
+    assert all(result.ok for result in results)
+    assert all(result.usage.wall_time > 0 for result in results)
+
+
+def test_iter_many_completion_order():
+    cmds = [f"sleep {0.2 * (2 - i)}; echo {i}" for i in range(3)]
+    results = list(iter_many(cmds, max_workers=3))
+    assert [result.index for result in results] == [2, 1, 0]
+
+
+def test_failure():
+    results = run_many(["echo one", "lsd", "echo three"], max_workers=2)
+    assert [result.ok for result in results] == [True, False, True]
+    assert isinstance(results[1].exception, NonZeroReturnCode)
+    assert results[2].outlines == ["three"]
+
+    with pytest.raises(NonZeroReturnCode):
+        run_many(["lsd"] + ["sleep 0.1"] * 20, max_workers=1, fail_fast=True)
+
+
+def test_shared_logfile():
+    logfile = StringIO()
+    cmds = [f"for j in 1 2 3; do echo {i}-$j; sleep 0.01; done" for i in range(4)]
+    run_many(cmds, max_workers=4, logfile=logfile)
+    lines = [line for line in logfile.getvalue().splitlines() if "-" in line[:3]]
+    # Lines from each job are contiguous
+    for idx in range(0, 12, 3):
+        assert len({line.split("-")[0] for line in lines[idx : idx + 3]}) == 1
+
+
+def test_logfile_pattern_and_logger(tmpdir, caplog):
+    pattern = str(tmpdir.join("job{index}.log"))
+    logger = logging.getLogger("test_batch")
+    with caplog.at_level(logging.INFO, logger="test_batch"):
+        run_many(["echo a", "echo b"], logfile=pattern, logger=logger)
+    assert "a" in tmpdir.join("job0.log").read().splitlines()
+    assert "b" in tmpdir.join("job1.log").read().splitlines()
+    assert sorted(rec.message for rec in caplog.records) == ["a", "b"]
@@ -0,0 +1,91 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+import os
+
+import pytest
+
+from ska_shell import (
+    NonZeroReturnCode,
+    SpillBuffer,
+    Spawn,
+    TailBuffer,
+    bash,
+    bash_shell,
+)
+
+pytestmark = pytest.mark.skipif(
+    os.name == "nt", reason="ska_shell not supported on Windows"
+)
+
+
+def test_tail_lines():
+    outlines = bash("seq 1000", retain=TailBuffer(max_lines=10))
+    assert outlines == [str(i) for i in range(991, 1001)]
+    assert outlines.nlines == 1000
+    assert outlines.dropped == 990
+    assert outlines[-1:] == ["1000"]
+
+
+def test_tail_bytes():
+    buf = TailBuffer(max_bytes=10)
+    buf.extend(["aaaa", "bbbb", "cccc"])
+    assert list(buf) == ["bbbb", "cccc"]
+    buf.append("x" * 20)
+    assert list(buf) == ["x" * 20]
+
+    buf = TailBuffer(max_lines=0, max_bytes=10)
+    buf.extend(["aaaa", "bbbb"])
+    assert list(buf) == []
+    assert buf.nlines == 2
+
+
+def test_spill(tmpdir):
+    buf = SpillBuffer(max_bytes=100, tail_lines=5, dir=tmpdir)
+    outlines = bash("seq 1000", retain=buf)
+    assert outlines is buf
+    assert buf.spilled
+    assert len(buf) == 1000
+    assert list(buf) == [str(i) for i in range(1, 1001)]
+    assert buf[0] == "1"
+    assert buf[-1] == "1000"
+    assert buf[-3:] == ["998", "999", "1000"]
+    assert buf[10:12] == ["11", "12"]
+    buf.close()
+    assert not buf.spilled
+    assert len(buf) == 0
+    assert list(buf) == []
+
+
+def test_getenv_and_error():
+    # printenv output does not push command output out of the buffer
+    outlines, env = bash_shell(
+        "echo one; echo two; export TEST_BUF_VAR=x",
+        getenv=True,
+        retain=TailBuffer(max_lines=2),
+    )
+    assert outlines == ["one", "two"]
+    assert env["TEST_BUF_VAR"] == "x"
+
+    with pytest.raises(NonZeroReturnCode, match="lsd"):
+        bash("seq 100; lsd", retain=TailBuffer(max_lines=2))
+    with pytest.raises(NonZeroReturnCode, match="lsd"):
+        bash("seq 100; lsd", retain=SpillBuffer(max_bytes=10))
+
+
+def test_spawn():
+    spawn = Spawn(stdout=None, shell=True, retain=TailBuffer(max_lines=2))
+    spawn.run("seq 10")
+    assert spawn.outlines == ["9\n", "10\n"]
+    spawn.run("echo a")
+    assert spawn.outlines == ["a\n"]
+
+
+def test_spawn_spill(tmpdir):
+    buf = SpillBuffer(max_bytes=20, tail_lines=3, dir=tmpdir)
+    spawn = Spawn(stdout=None, shell=True, retain=buf)
+    spawn.run("seq 20; printf last")
+    assert buf.spilled
+    expected = [f"{i}\n" for i in range(1, 21)] + ["last"]
+    assert list(spawn.outlines) == expected
+    assert buf[3] == "4\n"
+    assert buf[-2:] == ["20\n", "last"]
+    assert len(buf) == 21
@@ -0,0 +1,184 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+import os
+import time
+
+import pytest
+
+from ska_shell import (
+    CommandCache,
+    EnvCache,
+    NonZeroReturnCode,
+    ResourceUsage,
+    ShellProfile,
+    Spawn,
+    TailBuffer,
+    bash,
+    bash_shell,
+    getenv,
+    importenv,
+)
+
+pytestmark = pytest.mark.skipif(
+    os.name == "nt", reason="ska_shell not supported on Windows"
+)
+
+
+def test_getenv_cache(tmpdir):
+    script = tmpdir.join("setup.sh")
+    script.write('export TEST_CACHE_VAR="one"\n')
+    cache = EnvCache(tmpdir.join("cache"))
+    cmdstr = f". {script}"
+
+    assert getenv(cmdstr, cache=cache)["TEST_CACHE_VAR"] == "one"
+    assert len(cache) == 1
+
+    # Served from the cache: corrupt the stored value to prove it is used
+    key = cache.key(cmdstr)
+    cache.store(key, {"TEST_CACHE_VAR": "cached"})
+    assert getenv(cmdstr, cache=cache)["TEST_CACHE_VAR"] == "cached"
+
+    # Changing the sourced file changes the key
+    script.write('export TEST_CACHE_VAR="two"\n')
+    os.utime(script, ns=(0, 10**9))
+    assert cache.key(cmdstr) != key
+    assert getenv(cmdstr, cache=cache)["TEST_CACHE_VAR"] == "two"
+
+    # Different input env is a different entry
+    envs = getenv(cmdstr, env={"TEST_CACHE_OTHER": "x"}, cache=cache)
+    assert envs["TEST_CACHE_OTHER"] == "x"
+
+    cache.invalidate(cmdstr)
+    assert cache.get(cmdstr) is None
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_getenv_cache_failure(tmpdir):
+    # A failed setup is not cached, so it is retried on the next call
+    script = tmpdir.join("missing.sh")
+    cache = EnvCache(tmpdir.join("cache"))
+    cmdstr = f". {script}"
+    assert getenv(cmdstr, cache=cache) == {}
+    assert len(cache) == 0
+
+    script.write('export TEST_CACHE_VAR="one"\n')
+    assert getenv(cmdstr, cache=cache)["TEST_CACHE_VAR"] == "one"
+    assert len(cache) == 1
+
+
+def test_importenv_cache(tmpdir):
+    cache = EnvCache(tmpdir)
+    cmdstr = 'export TEST_CACHE_IMPORT="hello"'
+    importenv(cmdstr, cache=cache)
+    del os.environ["TEST_CACHE_IMPORT"]
+    importenv(cmdstr, cache=cache)
+    assert os.environ["TEST_CACHE_IMPORT"] == "hello"
+
+
+def test_max_age_and_eviction(tmpdir):
+    cache = EnvCache(tmpdir, max_age=0.1, max_entries=2)
+    for idx in range(3):
+        cache.set(f"echo {idx}", {"IDX": str(idx)})
+        time.sleep(0.01)
+    assert len(cache) == 2
+    assert cache.get("echo 0") is None
+    assert cache.get("echo 2") == {"IDX": "2"}
+    time.sleep(0.15)
+    assert cache.get("echo 2") is None
+
+
+def test_sourced_files():
+    files = EnvCache.sourced_files(
+        "source /home/ascds/.ascrc -r release; . ~/setup.sh && echo done"
+    )
+    assert files == ["/home/ascds/.ascrc", os.path.expanduser("~/setup.sh")]
+
+
+def test_command_cache(tmpdir):
+    data = tmpdir.join("data.txt")
+    data.write("one\n")
+    counter = tmpdir.join("counter")
+    cache = CommandCache(tmpdir.join("cache"))
+    cmdstr = f"echo run >> {counter}; cat {data}"
+
+    assert bash(cmdstr, cache=cache, cache_inputs=[data]) == ["one"]
+    assert bash(cmdstr, cache=cache, cache_inputs=[data]) == ["one"]
+    assert counter.read() == "run\n"
+
+    # Different options and env are different entries
+    assert bash(cmdstr, cache=cache, cache_inputs=[data], check=False) == ["one"]
+    bash(cmdstr, cache=cache, cache_inputs=[data], env={"TEST_CC": "1"})
+    assert counter.read() == "run\n" * 3
+
+    # Changing an input reruns the command
+    data.write("two\n")
+    os.utime(data, ns=(0, 10**9))
+    assert bash(cmdstr, cache=cache, cache_inputs=[data]) == ["two"]
+    assert counter.read() == "run\n" * 4
+
+    retain = TailBuffer(1)
+    bash("echo a; echo b", cache=cache, retain=retain)
+    assert list(bash("echo a; echo b", cache=cache, retain=retain)) == ["b"]
+
+    # Usage and profile of a cached result
+    usage = ResourceUsage()
+    profile = ShellProfile()
+    bash(cmdstr, cache=cache, cache_inputs=[data], usage=usage, profile=profile)
+    assert usage.cached
+    assert usage.wall_time == 0
+    assert profile.cached
+    assert profile.lines == []
+    bash(f"echo ran >> {counter}", cache=cache, usage=usage, profile=profile)
+    assert not usage.cached
+    assert usage.wall_time > 0
+    assert not profile.cached
+
+    # Failures are not cached
+    for _ in range(2):
+        with pytest.raises(NonZeroReturnCode):
+            bash(f"echo fail >> {counter}; false", cache=cache)
+    assert counter.read().count("fail") == 2
+
+
+def test_command_cache_getenv(tmpdir):
+    cache = CommandCache(tmpdir)
+    cmdstr = "echo hi; export TEST_CC_VAR=cached"
+    outlines, deltaenv = bash_shell(cmdstr, getenv=True, cache=cache)
+    assert deltaenv["TEST_CC_VAR"] == "cached"
+    assert bash_shell(cmdstr, getenv=True, cache=cache) == (outlines, deltaenv)
+    assert len(cache) == 1
+    bash(cmdstr, importenv=True, cache=cache)
+    assert os.environ.pop("TEST_CC_VAR") == "cached"
+
+
+def test_command_cache_spawn(tmpdir):
+    data = tmpdir.join("data.txt")
+    data.write("hello\n")
+    cache = CommandCache(tmpdir.join("cache"), hash_inputs=True)
+    spawn = Spawn(stdout=None, stderr=None)
+    cmd = ["sh", "-c", f"cat {data}; echo warn >&2; echo ran >> {tmpdir}/ran"]
+
+    for cached in (False, True):
+        assert spawn.run(cmd, cache=cache, cache_inputs=[data]) == 0
+        assert spawn.outlines == ["hello\n"]
+        assert spawn.errlines == ["warn\n"]
+        assert spawn.usage.cached is cached
+        assert spawn.usage.wall_time is not None
+    assert tmpdir.join("ran").read() == "ran\n"
+
+    # Same mtime but different contents is detected with hash_inputs
+    stat = os.stat(data)
+    data.write("HELLO\n")
+    os.utime(data, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    spawn.run(cmd, cache=cache, cache_inputs=[data])
+    assert spawn.outlines == ["HELLO\n"]
+
+
+def test_command_cache_max_bytes(tmpdir):
+    cache = CommandCache(tmpdir, max_bytes=2000)
+    for idx in range(10):
+        bash(f"printf '%0200d' {idx}", cache=cache)
+        time.sleep(0.01)
+    sizes = [os.path.getsize(path) for path in tmpdir.listdir()]
+    assert sum(sizes) <= 2000
+    assert 0 < len(cache) < 10
@@ -0,0 +1,69 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+import os
+
+import pytest
+
+from ska_shell import (
+    ResourceUsage,
+    ShellTimeoutError,
+    Spawn,
+    bash,
+    bash_shell,
+    iter_shell,
+    run_shell_result,
+    start_forkserver,
+    stop_forkserver,
+)
+
+pytestmark = pytest.mark.skipif(
+    os.name == "nt", reason="ska_shell not supported on Windows"
+)
+
+
+@pytest.fixture
+def server_pid():
+    pid = start_forkserver()
+    yield pid
+    stop_forkserver()
+
+
+def test_forkserver_bash(server_pid):
+    assert start_forkserver() == server_pid
+    assert bash("echo $PPID") == [str(server_pid)]
+
+    usage = ResourceUsage()
+    outlines, deltaenv = bash_shell(
+        "echo hello; export TEST_FS_VAR=world", getenv=True, usage=usage
+    )
+    assert outlines == ["hello"]
+    assert deltaenv["TEST_FS_VAR"] == "world"
+    assert usage.max_rss > 0
+
+    assert list(iter_shell("echo one; echo two")) == ["one", "two"]
+    assert run_shell_result("echo $PPID").lines == [str(server_pid)]
+
+    with pytest.raises(ShellTimeoutError) as err:
+        bash("echo start; sleep 10", timeout=0.5)
+    assert err.value.lines == ["start"]
+
+
+def test_forkserver_spawn(server_pid, tmpdir):
+    spawn = Spawn(stdout=None, shell=True)
+    assert spawn.run("echo $PPID; exit 3") == 3
+    assert spawn.outlines == [f"{server_pid}\n"]
+    assert spawn.usage.wall_time is not None
+
+    tmp = tmpdir.join("test.out")
+    spawn = Spawn(stderr=tmp.open("w"), stdout=None, shell=True)
+    spawn.run("echo out; echo err >&2")
+    assert spawn.outlines == ["out\n"]
+    assert tmp.read() == "err\n"
+
+    spawn = Spawn(stdout=None)
+    with pytest.raises(FileNotFoundError):
+        spawn.run(["ska_shell_no_such_command"])
+
+
+def test_forkserver_stop(server_pid):
+    stop_forkserver()
+    assert bash("echo $PPID") == [str(os.getpid())]
@@ -0,0 +1,77 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+import os
+import subprocess
+import sys
+
+import pytest
+
+import ska_shell
+
+pytestmark = pytest.mark.skipif(
+    os.name == "nt", reason="ska_shell not supported on Windows"
+)
+
+# Modules that are only needed by some features and must not be imported by
+# ``import ska_shell``
+LAZY_MODULES = {
+    "ska_helpers",
+    "concurrent.futures",
+    "datetime",
+    "hashlib",
+    "json",
+    "logging",
+    "socket",
+    "tempfile",
+    "uuid",
+    "ska_shell.batch",
+    "ska_shell.cache",
+    "ska_shell.forkserver",
+    "ska_shell.metrics",
+    "ska_shell.pipelines",
+    "ska_shell.pool",
+    "ska_shell.result",
+    "ska_shell.session",
+    "ska_shell.sinks",
+    "ska_shell.tracing",
+}
+
+
+def test_import_time():
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import ska_shell"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    modules = {
+        line.split("|")[-1].strip()
+        for line in proc.stderr.splitlines()
+        if line.startswith("import time:")
+    }
+    assert "ska_shell.shell" in modules
+    assert modules & LAZY_MODULES == set()
+
+
+def test_run_imports():
+    # Running a plain command does not import the optional features either
+    code = (
+        "import sys, ska_shell; ska_shell.bash('true'); "
+        "print(' '.join(sorted(sys.modules)))"
+    )
+    proc = subprocess.run(
+        [sys.executable, "-c", code],
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    assert set(proc.stdout.split()) & LAZY_MODULES == set()
+
+
+def test_lazy_attributes():
+    assert isinstance(ska_shell.__version__, str)
+    for name in ska_shell._LAZY_ATTRS:
+        assert getattr(ska_shell, name).__name__ == name
+        assert name in dir(ska_shell)
+    with pytest.raises(AttributeError):
+        ska_shell.no_such_attribute
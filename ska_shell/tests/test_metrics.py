@@ -0,0 +1,97 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+import os
+import stat
+
+import pytest
+
+from ska_shell import NonZeroReturnCode, ShellTimeoutError, Spawn, bash, getenv
+from ska_shell.metrics import MetricsCollector, MetricsRegistry, TextfileWriter
+
+pytestmark = pytest.mark.skipif(
+    os.name == "nt", reason="ska_shell not supported on Windows"
+)
+
+
+def test_registry_render():
+    registry = MetricsRegistry()
+    jobs = registry.counter("jobs_total", 'Jobs "run"', ["status"])
+    jobs.inc(status="ok")
+    jobs.inc(2, status='a"b')
+    latency = registry.histogram("latency_seconds", "Latency", [], buckets=[0.1, 1])
+    latency.observe(0.05)
+    latency.observe(0.5)
+    latency.observe(5)
+
+    assert registry.render().splitlines() == [
+        '# HELP jobs_total Jobs \\"run\\"',
+        "# TYPE jobs_total counter",
+        'jobs_total{status="a\\"b"} 2',
+        'jobs_total{status="ok"} 1',
+        "# HELP latency_seconds Latency",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{le="0.1"} 1',
+        'latency_seconds_bucket{le="1"} 2',
+        'latency_seconds_bucket{le="+Inf"} 3',
+        "latency_seconds_sum 5.55",
+        "latency_seconds_count 3",
+    ]
+    assert latency.get() == (3, 5.55)
+
+    with pytest.raises(ValueError):
+        jobs.inc(other="x")
+    with pytest.raises(ValueError):
+        registry.counter("jobs_total", "Again")
+
+
+def test_metrics_collector():
+    with MetricsCollector() as collector:
+        bash("echo hello")
+        getenv("export TEST_METRICS_VAR=1")
+        with pytest.raises(NonZeroReturnCode):
+            bash("exit 2")
+        with pytest.raises(ShellTimeoutError):
+            bash("sleep 5", timeout=0.1)
+        Spawn(stdout=None, catch=True).run(["ska_shell_no_such_command"])
+        Spawn(stdout=None).run(["echo", "spawn"])
+
+    commands = collector.commands
+    assert commands.get(entry_point="bash", shell="bash", outcome="ok") == 1
+    # getenv is counted once, not also as its run_shell
+    assert commands.get(entry_point="getenv", shell="bash", outcome="ok") == 1
+    assert (
+        commands.get(entry_point="bash", shell="bash", outcome="NonZeroReturnCode")
+        == 1
+    )
+    assert (
+        commands.get(entry_point="bash", shell="bash", outcome="RunTimeoutError") == 1
+    )
+    assert commands.get(entry_point="Spawn", shell="none", outcome="OSError") == 1
+    assert commands.get(entry_point="Spawn", shell="none", outcome="ok") == 1
+
+    count, total = collector.duration.get(entry_point="bash", shell="bash")
+    assert count == 3
+    assert total >= 0.1
+    assert collector.output_bytes.get(entry_point="bash", shell="bash") == 6
+
+    # Not counted once uninstalled
+    bash("echo hello")
+    assert commands.get(entry_point="bash", shell="bash", outcome="ok") == 1
+
+
+def test_textfile_writer(tmpdir):
+    path = str(tmpdir.join("ska_shell.prom"))
+    collector = MetricsCollector().install()
+    try:
+        with TextfileWriter(collector.registry, path, interval=0.05):
+            bash("echo hello")
+    finally:
+        collector.uninstall()
+
+    with open(path) as fh:
+        text = fh.read()
+    assert (
+        'ska_shell_commands_total{entry_point="bash",shell="bash",outcome="ok"} 1'
+        in text
+    )
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o644
+    assert os.listdir(tmpdir) == ["ska_shell.prom"]
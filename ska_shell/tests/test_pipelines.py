@@ -0,0 +1,107 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+import os
+import signal
+import time
+
+import pytest
+from six.moves import cStringIO as StringIO
+
+from ska_shell import (
+    NonZeroReturnCode,
+    ShellTimeoutError,
+    pipeline,
+    start_forkserver,
+    stop_forkserver,
+    tee,
+)
+
+pytestmark = pytest.mark.skipif(
+    os.name == "nt", reason="ska_shell not supported on Windows"
+)
+
+
+def upper(lines):
+    for line in lines:
+        yield line.upper()
+
+
+def test_pipeline():
+    result = pipeline(["printf", "b\\na\\nc\\nb\\n"], ["sort", "-u"])
+    assert result.ok
+    assert result.lines == ["a", "b", "c"]
+    assert result.returncodes == [0, 0]
+    assert result.returncode == 0
+    assert result.duration > 0
+
+
+def test_pipeline_python_stages():
+    copy = StringIO()
+    result = pipeline(["seq", "3"], tee(copy), upper, ["tac"])
+    assert copy.getvalue() == "1\n2\n3\n"
+    assert result.lines == ["3", "2", "1"]
+    assert len(result.stages) == 4
+
+    result = pipeline(upper, ["cat"], input=["a\n", "b\n"])
+    assert result.lines == ["A", "B"]
+    assert result.returncodes == [0, 0]
+
+    result = pipeline(["wc", "-l"], input="one\ntwo\n")
+    assert result.lines == ["2"]
+
+
+def test_pipeline_pipefail():
+    result = pipeline(["sh", "-c", "echo boom >&2; exit 3"], ["cat"], check=False)
+    assert not result.ok
+    assert result.returncodes == [3, 0]
+    assert result.failed is result.stages[0]
+    assert result.stages[0].stderr == ["boom"]
+
+    # Upstream stage gets SIGPIPE when the downstream one exits early
+    result = pipeline(["yes"], ["head", "-2"], check=False)
+    assert result.lines == ["y", "y"]
+    assert result.returncodes == [-signal.SIGPIPE, 0]
+
+    with pytest.raises(NonZeroReturnCode, match=r"stage 1 \(ls /nonexistent\)") as err:
+        pipeline(["ls", "/nonexistent"], ["cat"])
+    assert err.value.result.returncodes[1] == 0
+
+
+def test_pipeline_python_error():
+    def bad(lines):
+        raise ValueError("bad stage")
+        yield
+
+    with pytest.raises(NonZeroReturnCode, match="ValueError: bad stage") as err:
+        pipeline(["seq", "3"], bad)
+    assert isinstance(err.value.result.stages[1].error, ValueError)
+
+
+def test_pipeline_stdout_logfile(tmpdir):
+    out = tmpdir.join("out.txt")
+    with out.open("w") as fh:
+        result = pipeline(["seq", "3"], ["tac"], stdout=fh)
+    assert result.lines == []
+    assert out.read() == "3\n2\n1\n"
+
+    logfile = StringIO()
+    pipeline(["seq", "2"], logfile=logfile)
+    lines = logfile.getvalue().splitlines()
+    assert lines[0].startswith("Pipeline-")
+    assert lines[0].endswith("> seq 2")
+    assert lines[1:3] == ["1", "2"]
+
+
+def test_pipeline_timeout():
+    t0 = time.monotonic()
+    with pytest.raises(ShellTimeoutError, match="timed out after 0.5 secs"):
+        pipeline(["sleep", "10"], ["cat"], timeout=0.5)
+    assert time.monotonic() - t0 < 5
+
+
+def test_pipeline_forkserver():
+    start_forkserver()
+    try:
+        result = pipeline(["seq", "1000"], upper, ["tail", "-1"])
+    finally:
+        stop_forkserver()
+    assert result.lines == ["1000"]
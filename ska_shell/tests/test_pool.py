@@ -0,0 +1,102 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+import os
+import threading
+import time
+
+import pytest
+
+from ska_shell import NonZeroReturnCode, ShellError, ShellPool
+
+pytestmark = pytest.mark.skipif(
+    os.name == "nt", reason="ska_shell not supported on Windows"
+)
+
+
+def test_run_threads():
+    results = {}
+    with ShellPool(2, init='export TEST_POOL_VAR="warm"') as pool:
+
+        def work(idx):
+            results[idx] = pool.run(f"echo $TEST_POOL_VAR {idx}")[0]
+
+        threads = [threading.Thread(target=work, args=(idx,)) for idx in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    assert results == {idx: [f"warm {idx}"] for idx in range(8)}
+
+
+def test_recycle():
+    with ShellPool(1, max_commands=2) as pool:
+        pids = [pool.run("echo $$")[0][0] for _ in range(4)]
+    assert pids[0] == pids[1]
+    assert pids[1] != pids[2]
+    assert pids[2] == pids[3]
+
+
+def test_recycle_threads():
+    # Waiting threads must get the slot of a session discarded by max_commands
+    results = {}
+    with ShellPool(1, max_commands=1) as pool:
+
+        def work(idx):
+            results[idx] = pool.run(f"echo {idx}")[0]
+
+        threads = [
+            threading.Thread(target=work, args=(idx,), daemon=True) for idx in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=10)
+            assert not thread.is_alive()
+
+    assert results == {idx: [str(idx)] for idx in range(4)}
+
+
+def test_unhealthy():
+    with ShellPool(1) as pool:
+        with pytest.raises(NonZeroReturnCode):
+            with pool.session() as session:
+                pid = session.pid
+                session.run("false")
+        # A failed command does not discard the session
+        with pool.session() as session:
+            assert session.pid == pid
+
+        with pytest.raises(KeyboardInterrupt):
+            with pool.session() as session:
+                raise KeyboardInterrupt
+        with pool.session() as session:
+            assert session.pid != pid
+
+
+def test_timeout():
+    with ShellPool(1) as pool:
+        with pool.session():
+            with pytest.raises(ShellError, match="no free bash session"):
+                pool.checkout(timeout=0.1)
+
+
+def test_close_wakes_waiters():
+    errors = []
+    pool = ShellPool(1)
+    session = pool.checkout()
+
+    def work():
+        try:
+            pool.checkout()
+        except ShellError as err:
+            errors.append(err)
+
+    thread = threading.Thread(target=work, daemon=True)
+    thread.start()
+    time.sleep(0.2)
+    pool.close()
+    thread.join(timeout=10)
+    assert not thread.is_alive()
+    assert "closed" in str(errors[0])
+    pool.checkin(session)
+    assert not session.alive
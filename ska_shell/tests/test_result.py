@@ -0,0 +1,73 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+import os
+
+import pytest
+from six.moves import cStringIO as StringIO
+
+from ska_shell import (
+    NonZeroReturnCode,
+    ResourceUsage,
+    ShellTimeoutError,
+    run_shell,
+    run_shell_result,
+)
+
+pytestmark = pytest.mark.skipif(
+    os.name == "nt", reason="ska_shell not supported on Windows"
+)
+
+
+def test_result():
+    cmdstr = "echo hello; printf 'été\\nlast'"
+    result = run_shell_result(cmdstr)
+    assert result.ok
+    assert result.returncode == 0
+    assert result.cmdstr == cmdstr
+    assert result.duration > 0
+    assert result.last_line == "last"
+    assert result.raw == "hello\nété\nlast".encode()
+    assert bytes(result.view) == result.raw
+    assert result.text == "hello\nété\nlast"
+    assert result.lines == run_shell(cmdstr)[0]
+
+    result = run_shell_result("echo one; echo two")
+    assert result.last_line == "two"
+    assert result.lines == ["one", "two"]
+
+    result = run_shell_result("true")
+    assert result.lines == []
+    assert result.last_line == ""
+
+
+def test_result_check():
+    with pytest.raises(NonZeroReturnCode) as err:
+        run_shell_result("echo failed; exit 3")
+    assert err.value.lines == ["failed"]
+
+    result = run_shell_result("echo failed; exit 3", check=False)
+    assert not result.ok
+    assert result.returncode == 3
+
+
+def test_result_getenv():
+    result = run_shell_result("echo hello; export TEST_RESULT_VAR=world", getenv=True)
+    assert result.lines == ["hello"]
+    assert result.raw == b"hello\n"
+    assert result.last_line == "hello"
+    assert result.deltaenv["TEST_RESULT_VAR"] == "world"
+
+    result = run_shell_result("export TEST_RESULT_VAR=world", getenv=True)
+    assert result.lines == []
+    assert result.deltaenv["TEST_RESULT_VAR"] == "world"
+
+
+def test_result_logfile_timeout():
+    logfile = StringIO()
+    usage = ResourceUsage()
+    run_shell_result("echo hello; echo world", logfile=logfile, usage=usage)
+    assert logfile.getvalue().splitlines()[1:3] == ["hello", "world"]
+    assert usage.wall_time > 0
+
+    with pytest.raises(ShellTimeoutError) as err:
+        run_shell_result("echo start; sleep 10", timeout=0.5)
+    assert err.value.lines == ["start"]
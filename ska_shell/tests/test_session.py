@@ -0,0 +1,93 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+import os
+
+import pytest
+from six.moves import cStringIO as StringIO
+
+from ska_shell import Environment, NonZeroReturnCode, ShellError, ShellSession
+
+pytestmark = pytest.mark.skipif(
+    os.name == "nt", reason="ska_shell not supported on Windows"
+)
+
+
+@pytest.fixture
+def session():
+    with ShellSession(init='export TEST_SESSION_INIT="init"') as sess:
+        yield sess
+
+
+def test_run(session):
+    outlines, env = session.run("echo line1; echo line2")
+    assert outlines == ["line1", "line2"]
+    assert env == {}
+    assert session.ncommands == 1
+
+
+def test_no_trailing_newline(session):
+    outlines, _ = session.run("printf abc")
+    assert outlines == ["abc"]
+
+
+def test_env(session):
+    assert session.run("echo $TEST_SESSION_INIT")[0] == ["init"]
+    assert session.run("echo $TEST_SESSION_A", env={"TEST_SESSION_A": "it's"})[0] == [
+        "it's"
+    ]
+    # Changes made by one command are not seen by the next one
+    session.run("export TEST_SESSION_B=1")
+    assert session.run("echo x${TEST_SESSION_B}")[0] == ["x"]
+
+    _, env = session.run("export TEST_SESSION_C=hello", getenv=True)
+    assert env == {"TEST_SESSION_INIT": "init", "TEST_SESSION_C": "hello"}
+    assert "TEST_SESSION_C" not in os.environ
+
+    # Changes are relative to an Environment, including vars that were removed
+    base = Environment().updated(TEST_SESSION_D="1")
+    _, env = session.run(
+        "export TEST_SESSION_E=2; unset TEST_SESSION_D", env=base, getenv=True
+    )
+    assert env == {
+        "TEST_SESSION_INIT": "init",
+        "TEST_SESSION_E": "2",
+        "TEST_SESSION_D": None,
+    }
+
+
+def test_check(session):
+    out, _ = session.run("lsd; echo DONE", check=False)
+    assert len(out) == 2
+    assert out[-1] == "DONE"
+
+    with pytest.raises(NonZeroReturnCode):
+        session.run("lsd; echo DONE", check=True)
+
+    # Session is still usable after a failure
+    assert session.run("echo ok")[0] == ["ok"]
+
+
+def test_read_error(session):
+    # An error while reading output stops the session instead of leaving the
+    # rest of the output to be read by the next command
+    with pytest.raises(UnicodeDecodeError):
+        session.run(r"printf '\377\n'; echo after")
+    assert not session.alive
+    with pytest.raises(ShellError, match="not running"):
+        session.run("echo next")
+
+
+def test_logfile(session):
+    logfile = StringIO()
+    cmd = "echo line1; echo line2"
+    session.run(cmd, logfile=logfile)
+    outlines = logfile.getvalue().splitlines()
+    assert outlines[0].endswith(cmd)
+    assert outlines[1:3] == ["line1", "line2"]
+    assert outlines[3].startswith("Bash")
+
+
+def test_close():
+    session = ShellSession()
+    assert session.alive
+    session.close()
+    assert not session.alive
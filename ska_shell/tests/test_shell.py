@@ -1,18 +1,29 @@
 # Licensed under a 3-clause BSD style license - see LICENSE.rst
+import logging
 import os
+import signal
+import sys
+import threading
+import time
 
 import pytest
 from six.moves import cStringIO as StringIO
 
+import ska_shell.shell
 from ska_shell import (
+    Environment,
     NonZeroReturnCode,
+    ResourceUsage,
     RunTimeoutError,
     ShellError,
+    ShellProfile,
+    ShellTimeoutError,
     Spawn,
     bash,
     bash_shell,
     getenv,
     importenv,
+    iter_shell,
     run_shell,
     tcsh,
     tcsh_shell,
@@ -29,6 +40,25 @@ pytestmark = pytest.mark.skipif(
 )
 
 
+def _process_gone(pid, timeout=2):
+    """True if ``pid`` exits (or is a zombie waiting to be reaped) within
+    ``timeout`` seconds"""
+    t0 = time.monotonic()
+    while time.monotonic() - t0 < timeout:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return True
+        try:
+            with open(f"/proc/{pid}/stat") as fh:
+                if fh.read().rsplit(")", 1)[1].split()[0] == "Z":
+                    return True
+        except OSError:
+            pass
+        time.sleep(0.05)
+    return False
+
+
 class TestSpawn:
     def setup_method(self):
         self.f = StringIO()
@@ -53,6 +83,74 @@ class TestSpawn:
             spawn.run("sleep 5")
         assert spawn.exitstatus is None
 
+    def test_timeout_per_call(self):
+        spawn = Spawn(shell=True, stdout=None)
+        with pytest.raises(RunTimeoutError):
+            spawn.run("sleep 5", timeout=0.5)
+        assert spawn.process.returncode is not None
+
+    def test_timeout_threads(self):
+        results = {}
+
+        def work(idx):
+            spawn = Spawn(shell=True, stdout=None, timeout=0.5, catch=True)
+            results[idx] = (spawn.run(f"echo {idx}; sleep {idx * 10}"), spawn.outlines)
+
+        threads = [threading.Thread(target=work, args=(idx,)) for idx in range(4)]
+        t0 = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert time.time() - t0 < 3
+        assert results[0] == (0, ["0\n"])
+        for idx in range(1, 4):
+            assert results[idx][0] is None
+            assert results[idx][1][0] == f"{idx}\n"
+            assert "RunTimeoutError" in results[idx][1][1]
+
+    def test_timeout_kill(self):
+        # Process ignores SIGTERM so SIGKILL is needed
+        spawn = Spawn(shell=True, stdout=None, timeout=0.5, kill_grace=0.5)
+        t0 = time.time()
+        with pytest.raises(RunTimeoutError):
+            spawn.run("trap '' TERM; sleep 10")
+        assert time.time() - t0 < 3
+        assert spawn.process.returncode == -signal.SIGKILL
+
+    def test_iter_run(self):
+        spawn = Spawn(stdout=self.f, shell=True)
+        lines = []
+        for line in spawn.iter_run("echo one; echo two"):
+            lines.append(line)
+            assert spawn.exitstatus is None
+        assert lines == ["one\n", "two\n"]
+        assert spawn.outlines == []
+        assert spawn.exitstatus == 0
+        assert self.f.getvalue() == "one\ntwo\n"
+
+    def test_iter_run_close(self):
+        spawn = Spawn(stdout=None, shell=True)
+        lines = spawn.iter_run("echo one; sleep 10")
+        t0 = time.time()
+        assert next(lines) == "one\n"
+        lines.close()
+        assert time.time() - t0 < 3
+        assert spawn.process.poll() is not None
+        assert spawn.exitstatus is None
+
+    def test_usage(self):
+        spawn = Spawn(stdout=None)
+        spawn.run(
+            [sys.executable, "-c", "b = bytearray(100_000_000); sum(range(10**7))"]
+        )
+        assert spawn.usage.wall_time > 0
+        assert spawn.usage.user_time > 0
+        assert spawn.usage.max_rss > 100_000_000
+
+        spawn.run(["true"])
+        assert spawn.usage.max_rss < 100_000_000
+
     def test_grab_stderr(self, tmpdir):
         tmp = tmpdir.join("test.out")
         spawn = Spawn(stderr=tmp.open("w"), stdout=None)
@@ -61,6 +159,15 @@ class TestSpawn:
         assert tmp.read() == "123456"
         assert spawn.exitstatus == 0
 
+    def test_capture_stderr(self):
+        # Lots of stderr output must not fill the pipe and block the command
+        spawn = Spawn(stdout=None, stderr=None, timeout=20)
+        cmd = "import sys; sys.stderr.write('x' * 99 + '\\n' * 20000); print('done')"
+        spawn.run([sys.executable, "-c", cmd])
+        assert spawn.exitstatus == 0
+        assert spawn.outlines == ["done\n"]
+        assert len(spawn.errlines) == 20000
+
     def test_multi_stdout(self):
         spawn = Spawn(stdout=[self.f, self.g])
         spawn.run('perl -e "print 123456"', shell=True)
@@ -115,6 +222,93 @@ class TestBash:
         outlines = bash("echo 'hello'", env={"PS1": "(hello) \\s-\\v\\$"})
         assert outlines == ["hello"]
 
+    def test_env_multiline(self):
+        # Values with newlines and output that looks like the old env marker
+        outlines, envs = bash_shell(
+            "echo __PRINTENV__; export TEST_ENV_VARD=$'one\\ntwo=2'", getenv=True
+        )
+        assert outlines == ["__PRINTENV__"]
+        assert envs["TEST_ENV_VARD"] == "one\ntwo=2"
+        assert "two" not in envs
+
+        stream = iter_shell("export TEST_ENV_VARD=$'one\\ntwo'", getenv=True)
+        assert list(stream) == []
+        assert stream.deltaenv["TEST_ENV_VARD"] == "one\ntwo"
+
+    def test_env_printenv_fallback(self, monkeypatch):
+        monkeypatch.setattr(ska_shell.shell, "_env_nul_ok", lambda: False)
+        envs = getenv('export TEST_ENV_VARE="hello"')
+        assert envs["TEST_ENV_VARE"] == "hello"
+
+    def test_env_noclobber(self):
+        envs = getenv('set -o noclobber; export TEST_ENV_VARE="hello"')
+        assert envs["TEST_ENV_VARE"] == "hello"
+        outlines, envs = bash_shell(
+            'set -o noclobber; export TEST_ENV_VARE="hello"', getenv=True
+        )
+        assert envs["TEST_ENV_VARE"] == "hello"
+
+    def test_environment(self):
+        base = Environment(
+            {"PATH": os.environ["PATH"], "PWD": os.getcwd(), "TEST_ENV_VARF": "base"}
+        )
+        env = base.updated(TEST_ENV_VARG="one")
+        assert env["TEST_ENV_VARG"] == "one"
+        assert env["TEST_ENV_VARF"] == "base"
+        assert "TEST_ENV_VARG" not in base
+        assert env.diff(base) == {"TEST_ENV_VARG": "one"}
+        assert env.without("TEST_ENV_VARF").diff(env) == {"TEST_ENV_VARF": None}
+        # Not an ancestor: compare all vars
+        assert env.diff(dict(env, TEST_ENV_VARF="x", TEST_ENV_VARH="y")) == {
+            "TEST_ENV_VARF": "base",
+            "TEST_ENV_VARH": None,
+        }
+        with pytest.raises(TypeError):
+            base.updated(TEST_ENV_VARG=1)
+
+        # Deep chains are flattened but keep their delta
+        deep = base
+        for idx in range(20):
+            deep = deep.updated(TEST_ENV_VARG=str(idx))
+        assert deep["TEST_ENV_VARG"] == "19"
+        assert deep.diff(base) == {"TEST_ENV_VARG": "19"}
+        assert deep.delta == {"TEST_ENV_VARG": "19"}
+
+        # The Environment is the complete environment of the command
+        assert bash("echo $TEST_ENV_VARG; env | grep -c TEST_ENV_VAR", env=env) == [
+            "one",
+            "2",
+        ]
+
+        # getenv returns an Environment with the changes, including removed vars
+        newenv = getenv('export TEST_ENV_VARG="two"; unset TEST_ENV_VARF', env=env)
+        assert isinstance(newenv, Environment)
+        assert newenv.parent is env
+        assert newenv.delta == {"TEST_ENV_VARG": "two", "TEST_ENV_VARF": None}
+        assert "TEST_ENV_VARG" not in os.environ
+
+        # A failed command changes nothing
+        failed = getenv('export TEST_ENV_VARG="three"; false', env=newenv)
+        assert failed is newenv
+        failed = getenv("false", env=Environment())
+        assert failed["PATH"] == os.environ["PATH"]
+        assert len(failed) == len(os.environ)
+
+        # Share between threads
+        results = {}
+
+        def run(idx):
+            results[idx] = bash(
+                "echo $TEST_ENV_VARG", env=newenv.updated(TEST_ENV_VARH=str(idx))
+            )
+
+        threads = [threading.Thread(target=run, args=(idx,)) for idx in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert results == {idx: ["two"] for idx in range(4)}
+
     def test_importenv(self):
         importenv('export TEST_ENV_VARC="hello"', env={"TEST_ENV_VARB": "world"})
         assert os.environ["TEST_ENV_VARC"] == "hello"
@@ -152,12 +346,143 @@ class TestBash:
         with pytest.raises(NonZeroReturnCode):
             out = bash("lsd; echo DONE", check=True)
 
+    def test_iter_shell(self):
+        stream = iter_shell("echo line1; sleep 0.5; echo line2")
+        t0 = time.time()
+        assert next(stream) == "line1"
+        assert time.time() - t0 < 0.4
+        assert stream.returncode is None
+        assert list(stream) == ["line2"]
+        assert stream.returncode == 0
+        assert stream.deltaenv == {}
+
+        stream = iter_shell('echo hello; export TEST_ITER_VAR="world"', getenv=True)
+        assert list(stream) == ["hello"]
+        assert stream.deltaenv["TEST_ITER_VAR"] == "world"
+
+        stream = iter_shell("echo line1; lsd; echo line2")
+        with pytest.raises(NonZeroReturnCode):
+            list(stream)
+
+        with iter_shell("echo line1; sleep 10") as stream:
+            assert next(stream) == "line1"
+        assert stream.process.poll() is not None
+
+    def test_timeout(self):
+        t0 = time.time()
+        with pytest.raises(ShellTimeoutError, match="timed out after 0.5 secs") as err:
+            bash("echo start; sleep 10; echo end", timeout=0.5)
+        assert time.time() - t0 < 3
+        assert err.value.lines == ["start"]
+        assert isinstance(err.value, RunTimeoutError)
+
+        assert bash("echo fast", timeout=5) == ["fast"]
+
+    def test_idle_timeout(self):
+        t0 = time.time()
+        with pytest.raises(ShellTimeoutError, match="no output for 0.5 secs") as err:
+            bash("for i in 1 2 3; do echo $i; sleep 0.2; done; sleep 10", idle_timeout=0.5)
+        assert time.time() - t0 < 3
+        assert err.value.lines == ["1", "2", "3"]
+
+    def test_usage(self, caplog):
+        usage = ResourceUsage()
+        logger = logging.getLogger("ska_shell_test_usage")
+        with caplog.at_level(logging.DEBUG, logger=logger.name):
+            bash("sleep 0.2; echo done", usage=usage, logger=logger)
+        assert 0.2 < usage.wall_time < 3
+        assert usage.user_time is not None
+        assert usage.max_rss > 0
+        assert caplog.messages[0] == "done"
+        assert caplog.messages[1].startswith("Resource usage: <ResourceUsage wall_time=")
+
+        # Filled in when the command fails or times out
+        with pytest.raises(NonZeroReturnCode):
+            bash("exit 1", usage=usage)
+        assert usage.wall_time < 0.2
+        with pytest.raises(ShellTimeoutError):
+            bash("sleep 10", timeout=0.2, usage=usage)
+        assert 0.2 < usage.wall_time < 3
+
+    def test_timeout_kills_group(self, tmpdir):
+        pidfile = tmpdir.join("pid")
+        with pytest.raises(ShellTimeoutError):
+            bash(f"sleep 30 & echo $! > {pidfile}; wait", timeout=0.5)
+        assert _process_gone(int(pidfile.read()))
+
+    def test_timeout_kills_term_ignored(self, tmpdir):
+        # The shell exits on SIGTERM but the background job does not
+        pidfile = tmpdir.join("pid")
+        spawn = Spawn(shell=True, stdout=None, kill_grace=0.5)
+        with pytest.raises(RunTimeoutError):
+            spawn.run(
+                f"(trap '' TERM; sleep 30) & echo $! > {pidfile}; wait", timeout=0.5
+            )
+        assert _process_gone(int(pidfile.read()))
+
+    def test_separate_stderr(self):
+        outlines = bash(
+            "echo out1; echo err1 >&2; sleep 0.1; echo out2; echo err2 >&2",
+            separate_stderr=True,
+        )
+        assert list(outlines) == ["out1", "out2"]
+        assert outlines.stdout == ["out1", "out2"]
+        assert outlines.stderr == ["err1", "err2"]
+        assert [rec.line for rec in outlines.merged][2:] == ["out2", "err2"]
+        assert sorted(rec.line for rec in outlines.merged) == [
+            "err1", "err2", "out1", "out2"
+        ]
+        times = [rec.time for rec in outlines.merged]
+        assert times == sorted(times)
+
+        with pytest.raises(NonZeroReturnCode, match="oops") as err:
+            bash("echo line; echo oops >&2; false", separate_stderr=True)
+        assert err.value.lines.stdout == ["line"]
+
+        with pytest.raises(ValueError):
+            bash("echo", separate_stderr=True, retain=[])
+
+    def test_profile(self, capsys):
+        profile = ShellProfile()
+        logfile = StringIO()
+        outlines = bash(
+            "echo one\n\nsleep 0.2\nexport X=1", profile=profile, logfile=logfile
+        )
+        assert outlines == ["one"]
+        assert profile.complete
+        assert [line.lineno for line in profile.lines] == [1, 3, 4]
+        assert profile.lines[1].cmd == "sleep 0.2"
+        assert profile.slowest(1)[0].lineno == 3
+        assert 0.2 <= profile.lines[1].duration < profile.total
+        assert "sleep 0.2" in profile.table()
+        assert "ska_shell_profile" not in logfile.getvalue()
+
+        # Stops at the failing line and logs to stderr without logger or logfile
+        with pytest.raises(NonZeroReturnCode):
+            bash("echo one\nfalse\necho three", profile=True)
+        err = capsys.readouterr().err
+        assert "false" in err
+        assert "echo three" not in err
+        assert "stopped before the end" in err
+
+    def test_output_chunks(self):
+        # Final line without a newline is kept intact
+        assert bash("printf 'line1\\nline2'") == ["line1", "line2"]
+
+        # Output spanning many reads, including multi-byte characters
+        outlines = bash("for i in $(seq 20000); do echo \"$i \u00e9\u00e9\"; done")
+        assert outlines == [f"{i} \u00e9\u00e9" for i in range(1, 20001)]
+
 
 class TestTcsh:
     def test_tcsh(self):
         outlines = tcsh("echo line1; echo line2")
         assert outlines == ["line1", "line2"]
 
+    def test_quotes(self):
+        outlines = tcsh("echo 'single quoted'; echo \"it's\"")
+        assert outlines == ["single quoted", "it's"]
+
     def test_tcsh_shell(self):
         outlines, env = tcsh_shell("echo line1; echo line2")
         assert outlines == ["line1", "line2"]
@@ -204,6 +529,13 @@ class TestTcsh:
         assert outlines[2] == "line2"
         assert outlines[3].startswith("Tcsh")
 
+    def test_profile(self):
+        profile = ShellProfile()
+        tcsh("echo one\nsleep 0.2\nsetenv X 1", profile=profile)
+        assert profile.complete
+        assert [line.lineno for line in profile.lines] == [1, 2, 3]
+        assert profile.slowest(1)[0].cmd == "sleep 0.2"
+
     @pytest.mark.skipif("not HAS_HEAD_ASCDS", reason="Test requires /home/ascds/.ascrc")
     def test_ascds(self):
         envs = getenv("source /home/ascds/.ascrc -r release", shell="tcsh")
@@ -0,0 +1,78 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+import logging
+import os
+import threading
+import time
+
+import pytest
+
+from ska_shell import BackgroundSink, BufferedSink, Spawn, bash
+
+pytestmark = pytest.mark.skipif(
+    os.name == "nt", reason="ska_shell not supported on Windows"
+)
+
+
+class SlowFile:
+    """File that records each write and takes ``delay`` secs to write"""
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.writes = []
+        self.thread_ids = set()
+
+    def write(self, data):
+        time.sleep(self.delay)
+        self.thread_ids.add(threading.get_ident())
+        self.writes.append(data)
+
+    def getvalue(self):
+        return "".join(self.writes)
+
+
+def test_buffered_sink():
+    target = SlowFile()
+    with BufferedSink(target, max_bytes=100, flush_interval=100) as sink:
+        for _ in range(1000):
+            sink.write("line\n")
+        assert len(target.writes) == 50
+    assert target.getvalue() == "line\n" * 1000
+
+    target = SlowFile()
+    with BufferedSink(target) as sink:
+        bash("for i in $(seq 1000); do echo $i; done", logfile=sink)
+    lines = target.getvalue().splitlines()
+    assert lines[1:-1] == [str(i) for i in range(1, 1001)]
+
+
+def test_buffered_sink_logger(caplog):
+    logger = logging.getLogger("ska_shell_test_sinks")
+    with caplog.at_level(logging.INFO, logger=logger.name):
+        with BufferedSink(logger) as sink:
+            bash("echo one; echo two", logger=sink)
+            assert caplog.messages == []
+    assert caplog.messages == ["one", "two"]
+
+
+def test_background_sink():
+    target = SlowFile()
+    sink = BackgroundSink(target)
+    spawn = Spawn(stdout=[sink], shell=True)
+    spawn.run("for i in $(seq 1000); do echo $i; done")
+    sink.close()
+    assert target.getvalue() == "".join(f"{i}\n" for i in range(1, 1001))
+    assert target.thread_ids == {sink._thread.ident}
+    assert sink.dropped == 0
+
+
+def test_background_sink_slow():
+    # Output is dropped rather than waiting for a slow destination
+    target = SlowFile(delay=0.5)
+    sink = BackgroundSink(target, max_queue=2)
+    t0 = time.time()
+    for i in range(20):
+        bash("echo hello", logfile=sink)
+    assert time.time() - t0 < 2
+    sink.close()
+    assert sink.dropped > 0
+    assert len(target.getvalue().splitlines()) == 3 * 20 - sink.dropped
@@ -0,0 +1,114 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+import json
+import os
+import threading
+
+import pytest
+
+import ska_shell.shell
+from ska_shell import (
+    NonZeroReturnCode,
+    Spawn,
+    add_trace_hook,
+    bash,
+    getenv,
+    pipeline,
+    remove_trace_hook,
+    run_shell_result,
+)
+from ska_shell.tracing import ChromeTraceWriter, MemoryCollector
+
+pytestmark = pytest.mark.skipif(
+    os.name == "nt", reason="ska_shell not supported on Windows"
+)
+
+
+def test_memory_collector():
+    with MemoryCollector() as collector:
+        bash("echo hello")
+        getenv("export TEST_TRACE_VAR=1")
+        Spawn(stdout=None).run(["echo", "spawn"])
+        with pytest.raises(NonZeroReturnCode):
+            bash("echo fail; exit 3")
+    assert ska_shell.shell._hooks == []
+
+    spans = list(collector.spans)
+    assert [span.kind for span in spans] == [
+        "run_shell",
+        "run_shell",
+        "getenv",
+        "Spawn.run",
+        "run_shell",
+    ]
+    run, getenv_run, getenv_span, spawn, fail = spans
+    assert run.cmd == "echo hello"
+    assert run.returncode == 0
+    assert run.nbytes == 6
+    assert run.pid > 0
+    assert run.end >= run.start
+    assert run.thread_id == threading.get_ident()
+
+    assert getenv_run.parent is getenv_span
+    assert getenv_span.pid == getenv_run.pid
+
+    assert spawn.cmd == ["echo", "spawn"]
+    assert spawn.nbytes == 6
+
+    assert fail.returncode == 3
+    assert isinstance(fail.error, NonZeroReturnCode)
+
+
+def test_result_and_pipeline_spans():
+    with MemoryCollector() as collector:
+        run_shell_result("echo hello")
+        pipeline(["echo", "a b"], ["tr", " ", "\\n"])
+        with pytest.raises(NonZeroReturnCode):
+            pipeline(["echo", "x"], ["false"])
+
+    result, piped, failed = collector.spans
+    assert result.kind == "run_shell_result"
+    assert result.cmd == "echo hello"
+    assert result.shell == "bash"
+    assert result.returncode == 0
+    assert result.nbytes == 6
+    assert result.pid > 0
+
+    assert piped.kind == "pipeline"
+    assert piped.cmd == "echo 'a b' | tr ' ' '\\n'"
+    assert piped.returncode == 0
+    assert piped.nbytes == 4
+    assert piped.pid > 0
+
+    assert failed.returncode == 1
+    assert isinstance(failed.error, NonZeroReturnCode)
+
+
+def test_trace_hook_errors_ignored():
+    def bad_hook(span):
+        raise RuntimeError
+
+    add_trace_hook(bad_hook)
+    try:
+        assert bash("echo ok") == ["ok"]
+    finally:
+        remove_trace_hook(bad_hook)
+
+
+def test_chrome_trace(tmpdir):
+    path = str(tmpdir.join("trace.json"))
+    with ChromeTraceWriter(path):
+        bash("echo main")
+        thread = threading.Thread(target=bash, args=("echo worker",), name="worker")
+        thread.start()
+        thread.join()
+
+    with open(path) as fh:
+        events = json.load(fh)
+    names = {ev["args"]["name"] for ev in events if ev["ph"] == "M"}
+    assert names == {threading.current_thread().name, "worker"}
+    spans = [ev for ev in events if ev["ph"] == "X"]
+    assert [ev["name"] for ev in spans] == ["echo main", "echo worker"]
+    assert spans[0]["cat"] == "run_shell"
+    assert spans[0]["args"]["returncode"] == 0
+    assert spans[0]["dur"] > 0
+    assert spans[0]["tid"] != spans[1]["tid"]
@@ -0,0 +1,189 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Collect trace spans of all shell commands run by ska_shell.
+
+While a collector is installed, every call of ``run_shell()`` (and wrappers such as
+``bash()``), ``run_shell_result()``, ``getenv()``, ``pipeline()`` and
+``Spawn.run()`` in any thread is recorded as a ``Span`` with the command, process
+id, start and end time, exit status, output size and thread.
+``ChromeTraceWriter`` writes the spans to a file that can be opened in
+``chrome://tracing`` or https://ui.perfetto.dev to see a timeline of the commands
+in each thread::
+
+  >>> from ska_shell.tracing import ChromeTraceWriter
+  >>> with ChromeTraceWriter("trace.json"):
+  ...     run_pipeline()
+
+``MemoryCollector`` keeps the spans in memory for analysis in Python.
+"""
+
+import collections
+import json
+import os
+import threading
+
+from .shell import add_trace_hook, remove_trace_hook
+
+__all__ = ["SpanCollector", "MemoryCollector", "ChromeTraceWriter", "chrome_event"]
+
+
+class SpanCollector:
+    """
+    Base class for collectors of ``Span`` objects.
+
+    A subclass implements ``collect(span)``.  ``install()`` starts collecting spans
+    and ``uninstall()`` stops.  Used as a context manager the collector is
+    installed on entry and uninstalled (and closed) on exit.
+    """
+
+    def collect(self, span):
+        """Handle a finished ``span``"""
+        raise NotImplementedError
+
+    def __call__(self, span):
+        self.collect(span)
+
+    def install(self):
+        """Start collecting spans"""
+        add_trace_hook(self)
+        return self
+
+    def uninstall(self):
+        """Stop collecting spans"""
+        remove_trace_hook(self)
+
+    def close(self):
+        """Uninstall the collector"""
+        self.uninstall()
+
+    def __enter__(self):
+        return self.install()
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class MemoryCollector(SpanCollector):
+    """
+    Keep spans in memory.
+
+    Example::
+
+      >>> from ska_shell.tracing import MemoryCollector
+      >>> with MemoryCollector() as collector:
+      ...     bash("sleep 1")
+      >>> list(collector.spans)
+      [<Span run_shell pid=1234 returncode=0 duration=1.004s cmd='sleep 1'>]
+
+    :param max_spans: maximum number of spans to keep, dropping the oldest
+        (default: no limit)
+    """
+
+    def __init__(self, max_spans=None):
+        self.spans = collections.deque(maxlen=max_spans)
+        self._lock = threading.Lock()
+
+    def collect(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def clear(self):
+        """Remove all spans"""
+        with self._lock:
+            self.spans.clear()
+
+
+def _jsonable(value):
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(item) for item in value]
+    return repr(value)
+
+
+def chrome_event(span, pid=None):
+    """Return ``span`` as a complete ("X") event of the Chrome trace event format.
+
+    :param span: ``Span``
+    :param pid: process id for the event (default: this process)
+    :rtype: dict
+    """
+    cmd = span.cmd if isinstance(span.cmd, str) else " ".join(map(str, span.cmd or []))
+    return {
+        "name": cmd if len(cmd) <= 80 else cmd[:77] + "...",
+        "cat": span.kind,
+        "ph": "X",
+        "ts": span.start * 1e6,
+        "dur": span.duration * 1e6,
+        "pid": os.getpid() if pid is None else pid,
+        "tid": span.thread_id,
+        "args": {
+            "cmd": _jsonable(span.cmd),
+            "pid": span.pid,
+            "returncode": span.returncode,
+            "nbytes": span.nbytes,
+            "cached": span.cached,
+            "error": _jsonable(span.error),
+        },
+    }
+
+
+class ChromeTraceWriter(SpanCollector):
+    """
+    Write spans to a file in the Chrome trace event format.
+
+    Each span is written when it finishes, so the file is useful even if the
+    program does not exit cleanly (the JSON array format allows a missing closing
+    bracket).  ``close()`` finishes the file.  Viewers show one row per thread with
+    the commands as bars on a timeline.
+
+    :param path: output file name
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fh = None
+        self._threads = set()
+        self._lock = threading.Lock()
+
+    def install(self):
+        with self._lock:
+            if self._fh is None:
+                self._fh = open(self.path, "w")
+                self._fh.write("[\n")
+                self._first = True
+        return super().install()
+
+    def _write(self, event):
+        if not self._first:
+            self._fh.write(",\n")
+        self._first = False
+        json.dump(event, self._fh)
+
+    def collect(self, span):
+        event = chrome_event(span)
+        with self._lock:
+            if self._fh is None:
+                return
+            if span.thread_id not in self._threads:
+                self._threads.add(span.thread_id)
+                self._write(
+                    {
+                        "name": "thread_name",
+                        "ph": "M",
+                        "pid": event["pid"],
+                        "tid": span.thread_id,
+                        "args": {"name": span.thread_name},
+                    }
+                )
+            self._write(event)
+            self._fh.flush()
+
+    def close(self):
+        """Uninstall the writer and finish the file"""
+        self.uninstall()
+        with self._lock:
+            if self._fh is not None:
+                self._fh.write("\n]\n")
+                self._fh.close()
+                self._fh = None